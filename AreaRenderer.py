@@ -0,0 +1,339 @@
+## AreaRenderer draws a dataset's entire area with its labels, at any zoom level, on screen or to PNG.
+import os
+import math
+import argparse
+import numpy as np
+from PIL import Image
+from LabelStore import LabelIndex
+from Dataset import Dataset
+from Pyramid import level_path
+
+from matplotlib import cm
+from matplotlib import collections as mc
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# Scales (1/n) at which PIL can decode a JPEG without decoding it at full resolution.
+JPEG_DRAFT_SCALES = (8, 4, 2)
+
+# Rows of the area decoded from `Entire_Area.jpg` written to its memmap at a time.
+CONVERT_BLOCK_ROWS = 1024
+
+
+class AreaRenderer:
+  """
+  The 'AreaRenderer' class renders a window (in pixels of the entire area) of a
+  Dataset's `raw_data/Entire_Area` with its labels, downsampled by an integer factor
+  so that the rendered image is at most `max_size` pixels wide and high.
+
+  Only the raster window being drawn is read, at the resolution it is drawn at: from
+  the coarsest pyramid level (see `Pyramid.py`) or `Entire_Area.npy` memmap whose
+  factor divides the rendered one, or from `Entire_Area.jpg` decoded at the largest
+  reduced scale (1/2, 1/4 or 1/8) up to the downsampling factor. A dataset with only
+  the JPEG has it converted once to an `Entire_Area.npy` memmap when a window is first
+  drawn at full resolution, so the full resolution area is never kept in memory.
+  The labels overlapping the window are found with a LabelIndex, simplified for the
+  zoom level (nodes are snapped to the rendered pixels, and labels smaller than a
+  rendered pixel are dropped), and all the labels of a class are drawn as a single
+  PolyCollection (closed ways, eg: buildings) and LineCollection (open ways, eg:
+  roads).
+
+  `save` renders to a PNG without a display (eg: to batch-generate overviews), and
+  `show` renders interactively, rendering the window again after each zoom or pan.
+  """
+
+  def __init__(self, ds, cell_size=1024):
+    self.ds = ds
+    self.labels = ds.load_label_store()
+    self.index = LabelIndex(self.labels, cell_size)
+    self.levels = self.load_levels()
+    self._jpeg_drafts = {}
+
+    if 1 in self.levels:
+      self.shape = self.levels[1].shape[:2]
+    else:
+      with Image.open(self.jpeg_path()) as im:
+        self.shape = (im.height, im.width)
+
+    self.colours = {}
+    for super_class, sub_classes in self.labels.classes.items():
+      for sub_class in sub_classes:
+        self.colours[(super_class, sub_class)] = cm.tab20(len(self.colours) % 20)
+
+  def jpeg_path(self):
+    return os.path.join(self.ds.raw_data_path, 'Entire_Area.jpg')
+
+  def load_levels(self):
+    """
+    Helper method only.
+    Returns the dictionary of factor -> memmap of the area downsampled by factor, of
+    the `Entire_Area.npy` files of the dataset (factor 1) and of its pyramid levels.
+    """
+    levels = {}
+    area_path = os.path.join(self.ds.raw_data_path, 'Entire_Area.npy')
+    if os.path.isfile(area_path):
+      levels[1] = np.load(area_path, mmap_mode='r')
+
+    pyramid_path = os.path.join(self.ds.data_path, 'pyramid')
+    if os.path.isdir(pyramid_path):
+      for name in os.listdir(pyramid_path):
+        factor = int(name[:-1]) if name.endswith('x') and name[:-1].isdigit() else None
+        path = os.path.join(level_path(self.ds.data_path, factor or 1), 'raw_data',
+                            'Entire_Area.npy')
+        if factor and os.path.isfile(path):
+          levels[factor] = np.load(path, mmap_mode='r')
+    return levels
+
+  def convert_jpeg(self):
+    """
+    Helper method only.
+    Converts `Entire_Area.jpg` to an `Entire_Area.npy` memmap (once, in blocks of rows),
+    so that full resolution windows are sliced from disk instead of from the decoded
+    JPEG kept in memory, and frees the reduced scale decodes (the memmap serves every
+    factor from then on).
+    Returns:
+      The memmap of the area (also the level of factor 1).
+    """
+    path = os.path.join(self.ds.raw_data_path, 'Entire_Area.npy')
+    with Image.open(self.jpeg_path()) as im:
+      im = im if im.mode == 'RGB' else im.convert('RGB')
+      area = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.uint8,
+                                       shape=(im.height, im.width, 3))
+      for row_start in range(0, im.height, CONVERT_BLOCK_ROWS):
+        row_end = min(row_start + CONVERT_BLOCK_ROWS, im.height)
+        area[row_start:row_end] = np.asarray(im.crop((0, row_start, im.width, row_end)))
+      area.flush()
+      del area
+    os.replace(path + '.tmp', path)
+
+    self.levels[1] = np.load(path, mmap_mode='r')
+    self._jpeg_drafts = {}
+    return self.levels[1]
+
+  def clip_window(self, window=None):
+    """
+    Returns the [col_start, col_end, row_start, row_end] window clipped to the area
+    (the entire area if [window] is None).
+    """
+    height, width = self.shape
+    if window is None:
+      return [0, width, 0, height]
+    col_start, col_end, row_start, row_end = [int(round(x)) for x in window]
+    col_start, col_end = max(0, min(col_start, col_end)), min(width, max(col_start, col_end))
+    row_start, row_end = max(0, min(row_start, row_end)), min(height, max(row_start, row_end))
+    assert col_start < col_end and row_start < row_end, "Window doesn't overlap the area."
+    return [col_start, col_end, row_start, row_end]
+
+  @staticmethod
+  def zoom_factor(window, max_size):
+    """
+    Returns the smallest downsampling factor rendering [window] in at most [max_size]
+    pixels per side.
+    """
+    col_start, col_end, row_start, row_end = window
+    return max(1, math.ceil(max(col_end - col_start, row_end - row_start) / max_size))
+
+  def read_window(self, window, factor):
+    """
+    Reads the raster [window] (clipped to the area) downsampled by [factor], decoding
+    as little of the area as possible.
+    Returns:
+      The (h, w, 3) uint8 image of the window, every pixel covering factor x factor
+      pixels of the area.
+    """
+    col_start, col_end, row_start, row_end = window
+    # The coarsest level dividing the factor, so its pixels can be strided.
+    level = max(level for level in list(self.levels) + [1] if factor % level == 0)
+    if level in self.levels:
+      area = self.levels[level]
+    elif factor == 1:
+      area = self.convert_jpeg()
+    else:
+      # Only a JPEG: decoded once per reduced scale, the largest up to the factor.
+      level = max(s for s in JPEG_DRAFT_SCALES if s <= factor)
+      if level not in self._jpeg_drafts:
+        height, width = self.shape
+        size = (-(-width // level), -(-height // level))
+        with Image.open(self.jpeg_path()) as im:
+          im.draft('RGB', size)
+          im = im.convert('RGB')
+          # Drafts only reduce by some scales (not at all for progressive JPEGs).
+          self._jpeg_drafts[level] = np.array(im if im.size == size else im.resize(size))
+      area = self._jpeg_drafts[level]
+      if factor % level:
+        # The scale doesn't divide the factor (eg: 3): sample the nearest draft pixels.
+        rows = np.minimum(np.arange(row_start, row_end, factor) // level, area.shape[0] - 1)
+        cols = np.minimum(np.arange(col_start, col_end, factor) // level, area.shape[1] - 1)
+        return area[rows[:, None], cols]
+    step = factor // level
+    return np.asarray(area[row_start // level:row_end // level:step,
+                           col_start // level:col_end // level:step])
+
+  def simplified_labels(self, window, factor):
+    """
+    Returns the dictionary of (super_class, sub_class) -> (closed ways, open ways) of
+    the labels overlapping [window], as lists of (n, 2) node arrays in area pixels,
+    simplified for rendering downsampled by [factor].
+    """
+    ids = self.index.query(window)
+    if not len(ids):
+      return {}
+    store = self.labels.take(ids)
+    nodes, offsets = np.asarray(store.nodes, dtype=np.float64), np.asarray(store.offsets)
+    lengths = np.diff(offsets)
+    way_of_node = np.repeat(np.arange(len(store)), lengths)
+    first, last = nodes[offsets[:-1][lengths > 0]], nodes[offsets[1:][lengths > 0] - 1]
+    closed = np.zeros(len(store), dtype=bool)
+    closed[lengths > 0] = np.all(first == last, axis=1)
+
+    # Snap nodes to the rendered pixels, and drop consecutive nodes in the same pixel.
+    if factor > 1:
+      nodes = np.round(nodes / factor) * factor
+    keep = np.ones(len(nodes), dtype=bool)
+    keep[1:] = np.any(nodes[1:] != nodes[:-1], axis=1) | (way_of_node[1:] != way_of_node[:-1])
+    nodes, way_of_node = nodes[keep], way_of_node[keep]
+    counts = np.bincount(way_of_node, minlength=len(store))
+    new_offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    labels = {}
+    for i in np.flatnonzero(counts >= 2):
+      way = nodes[new_offsets[i]:new_offsets[i + 1]]
+      is_polygon = closed[i] or store.super_classes[store.super_ids[i]] == 'building'
+      # Polygons collapsed into fewer than 3 rendered pixels aren't drawn.
+      if is_polygon and len(way) < 3:
+        continue
+      closed_ways, open_ways = labels.setdefault(store.class_names(i), ([], []))
+      (closed_ways if is_polygon else open_ways).append(way)
+    return labels
+
+  def draw(self, ax, window=None, factor=None, max_size=2048):
+    """
+    Draws [window] of the area (all of it if None) and its labels on the axes [ax],
+    downsampled by [factor] (or by the factor fitting it in [max_size] pixels).
+    Returns:
+      The list of drawn artists.
+    """
+    window = self.clip_window(window)
+    factor = factor or AreaRenderer.zoom_factor(window, max_size)
+    image = self.read_window(window, factor)
+    col_start, _, row_start, _ = window
+    extent = (col_start, col_start + image.shape[1] * factor,
+              row_start + image.shape[0] * factor, row_start)
+    artists = [ax.imshow(image, extent=extent, interpolation='nearest' if factor == 1 else 'antialiased')]
+
+    for class_name, (closed_ways, open_ways) in self.simplified_labels(window, factor).items():
+      colour = self.colours[class_name]
+      label = ':'.join(class_name)
+      if closed_ways:
+        artists.append(ax.add_collection(mc.PolyCollection(
+          closed_ways, facecolors=[colour[:3] + (0.25,)], edgecolors=[colour], linewidths=0.8,
+          label=label)))
+        label = None
+      if open_ways:
+        artists.append(ax.add_collection(mc.LineCollection(
+          open_ways, colors=[colour], linewidths=1.0, label=label)))
+    return artists
+
+  def save(self, out_path, window=None, max_size=2048):
+    """
+    Renders [window] of the area (all of it if None) in at most [max_size] pixels per
+    side to the PNG [out_path], without needing a display.
+    """
+    window = self.clip_window(window)
+    factor = AreaRenderer.zoom_factor(window, max_size)
+    col_start, col_end, row_start, row_end = window
+    dpi = 100
+    fig = Figure(figsize=((col_end - col_start) / factor / dpi, (row_end - row_start) / factor / dpi),
+                 dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    self.draw(ax, window, factor)
+    ax.set_xlim(col_start, col_end)
+    ax.set_ylim(row_end, row_start)
+    fig.savefig(out_path, dpi=dpi)
+
+  def show(self, window=None, max_size=2048):
+    """
+    Shows [window] of the area (all of it if None) with matplotlib. After each zoom or
+    pan, the visible window is rendered again at the resolution it is shown at.
+    """
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()
+    window = self.clip_window(window)
+    artists = self.draw(ax, window, max_size=max_size)
+    ax.set_xlim(window[0], window[1])
+    ax.set_ylim(window[3], window[2])
+    ax.grid()
+    if len(artists) > 1:
+      ax.legend(loc='upper right', fontsize='small')
+
+    # Renders again once the view stops changing (eg: at the end of a pan).
+    timer = fig.canvas.new_timer(interval=200)
+    timer.single_shot = True
+    drawn = {'view': (ax.get_xlim(), ax.get_ylim())}
+
+    def redraw():
+      (x0, x1), (y0, y1) = ax.get_xlim(), ax.get_ylim()
+      for artist in artists:
+        artist.remove()
+      artists[:] = self.draw(ax, [x0, x1, y0, y1], max_size=max_size)
+      ax.set_xlim(x0, x1)
+      ax.set_ylim(y0, y1)
+      drawn['view'] = (ax.get_xlim(), ax.get_ylim())
+      fig.canvas.draw_idle()
+
+    def on_view_changed(_):
+      if (ax.get_xlim(), ax.get_ylim()) != drawn['view']:
+        timer.stop()
+        timer.start()
+
+    timer.add_callback(redraw)
+    ax.callbacks.connect('xlim_changed', on_view_changed)
+    ax.callbacks.connect('ylim_changed', on_view_changed)
+    plt.show()
+
+
+def passed_arguments():
+  parser = argparse.ArgumentParser(
+    description="Script to render the entire area of datasets with their labels.")
+  parser.add_argument('-d', '--data_paths',
+                      nargs='+',
+                      type=str,
+                      required=True,
+                      help='Paths to the directories of the datasets to render.')
+  parser.add_argument('-c', '--classes_path',
+                      type=str,
+                      default='classes.json',
+                      help='Path to .json file denoting classes of labels used in dataset.')
+  parser.add_argument('-o', '--out_dir',
+                      type=str,
+                      default=None,
+                      help='Directory to write a [dataset name]_overview.png to for each' +\
+                           ' dataset, instead of showing them.')
+  parser.add_argument('--window',
+                      nargs=4,
+                      type=int,
+                      default=None,
+                      help='Window of the area to render, in pixels: col_start col_end' +\
+                           ' row_start row_end (the entire area by default).')
+  parser.add_argument('--max_size',
+                      type=int,
+                      default=2048,
+                      help='Maximum width and height of the rendered image in pixels.')
+  args = parser.parse_args()
+  return args
+
+
+if __name__ == "__main__":
+  args = passed_arguments()
+  for data_path in args.data_paths:
+    renderer = AreaRenderer(Dataset(data_path, classes_path=args.classes_path))
+    if args.out_dir:
+      os.makedirs(args.out_dir, exist_ok=True)
+      name = os.path.basename(os.path.normpath(data_path))
+      out_path = os.path.join(args.out_dir, f'{name}_overview.png')
+      renderer.save(out_path, window=args.window, max_size=args.max_size)
+      print(f"Rendered {data_path} to {out_path}")
+    else:
+      renderer.show(window=args.window, max_size=args.max_size)
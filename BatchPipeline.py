@@ -0,0 +1,235 @@
+## BatchPipeline runs DataPipeline.py over a whole directory (or glob) of PAIRS queries.
+import os
+import re
+import sys
+import json
+import glob
+import time
+import argparse
+import threading
+import subprocess
+import concurrent.futures
+from Dataset import Dataset
+
+
+class BatchStatus:
+  """
+  The 'BatchStatus' class keeps track of every query of a batch in the
+  `batch_status.json` file of the batch's data path, so that a rerun of the batch
+  skips the queries that are already done and only retries the failed ones.
+
+  Each query name maps to a dictionary with its `query_path`, `data_path`, `status`
+  ("running", "done" or "failed"), run time in `seconds` and number of `tiles`.
+  """
+
+  def __init__(self, data_path):
+    self.path = os.path.join(data_path, 'batch_status.json')
+    self.lock = threading.Lock()
+    self.queries = {}
+    if os.path.isfile(self.path):
+      with open(self.path, 'r') as f:
+        self.queries = json.load(f)
+
+  def is_done(self, name):
+    return self.queries.get(name, {}).get('status') == 'done'
+
+  def update(self, name, **info):
+    """
+    Updates the entry of query `name` with `info` and rewrites the status file.
+    """
+    with self.lock:
+      self.queries.setdefault(name, {}).update(info)
+      tmp_path = self.path + '.tmp'
+      with open(tmp_path, 'w') as f:
+        json.dump(self.queries, f, indent=2)
+      os.replace(tmp_path, self.path)
+
+
+def query_paths(queries):
+  """
+  Returns the sorted list of .json PAIRS query files in the directory [queries],
+  or matching the glob pattern [queries] (eg: `PAIRS_Queries/Large_NYC_Queries/*.json`).
+  """
+  pattern = os.path.join(queries, '*.json') if os.path.isdir(queries) else queries
+  paths = [p for p in glob.glob(pattern) if p.endswith('.json')]
+  # Natural sort, so that Query_NYC_2 comes before Query_NYC_10.
+  return sorted(paths, key=lambda p: [int(t) if t.isdigit() else t for t in re.split('([0-9]+)', p)])
+
+
+def query_name(query_path):
+  """
+  Returns the name of the query at [query_path], also used as its data path.
+  """
+  return os.path.splitext(os.path.basename(query_path))[0]
+
+
+def run_query(query_path, data_path, status, pipeline_args, classes_path='classes.json'):
+  """
+  Runs `DataPipeline.py` for one query in its own process, so that a failing (or
+  crashing) query doesn't affect the others. Its output goes to `pipeline.log` in
+  its data path. The number of tiles it wrote is recorded in the batch status.
+
+  Returns:
+  (name, succeeded, seconds)
+  """
+  name = query_name(query_path)
+  os.makedirs(data_path, exist_ok=True)
+  status.update(name, query_path=query_path, data_path=data_path, status='running')
+
+  cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'DataPipeline.py'),
+         '--data_path', data_path, '--query_path', query_path] + pipeline_args
+
+  start = time.time()
+  with open(os.path.join(data_path, 'pipeline.log'), 'w') as log:
+    returncode = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+  seconds = round(time.time() - start, 1)
+
+  succeeded = returncode == 0
+  tiles = len(Dataset(data_path, classes_path=classes_path)) if succeeded else 0
+  status.update(name, status='done' if succeeded else 'failed', seconds=seconds, tiles=tiles)
+  return name, succeeded, seconds
+
+
+def run_batch(queries, data_path, workers=1, parallel=None, merge_path=None,
+              classes_path='classes.json', rerun=False, pipeline_args=()):
+  """
+  Runs the full pipeline (PAIRS query, OSM query and tiling) for each query in
+  [queries] (a directory or glob), with at most [parallel] queries at a time.
+
+  The [workers] tiling processes are split evenly between the concurrently running
+  queries, and so are their OSM request budgets (in [pipeline_args]). Each query is
+  stored in `data_path/<query name>`. Queries already done in an earlier run are
+  skipped (unless [rerun]), so rerunning a batch only retries the failed queries.
+
+  If [merge_path] is given and all queries succeeded, their tiles are hard linked
+  into one dataset there, with globally unique indices in query order.
+
+  Returns:
+  True if all queries succeeded.
+  """
+  paths = query_paths(queries)
+  assert paths, f"No .json queries found in {queries}"
+  os.makedirs(data_path, exist_ok=True)
+  status = BatchStatus(data_path)
+
+  todo = [p for p in paths if rerun or not status.is_done(query_name(p))]
+  print(f"{len(paths)} queries in batch, {len(paths) - len(todo)} already done.")
+
+  if todo:
+    parallel = min(parallel or workers, len(todo))
+    args = budget_pipeline_args(list(pipeline_args), workers, parallel)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as ex:
+      futures = [ex.submit(run_query, p, os.path.join(data_path, query_name(p)), status, args,
+                           classes_path)
+                 for p in todo]
+      for future in concurrent.futures.as_completed(futures):
+        name, succeeded, seconds = future.result()
+        print(f"{name}: {'done' if succeeded else 'FAILED'} in {seconds}s")
+
+  print_report(status, paths)
+  failed = [query_name(p) for p in paths if not status.is_done(query_name(p))]
+  if failed:
+    print(f"{len(failed)} queries failed, rerun the batch to retry them: {', '.join(failed)}")
+    if merge_path:
+      print("Not merging the dataset until all queries succeed.")
+    return False
+
+  if merge_path:
+    merge_datasets(merge_path, [status.queries[query_name(p)]['data_path'] for p in paths],
+                   classes_path)
+  return True
+
+
+def budget_pipeline_args(pipeline_args, workers, parallel):
+  """
+  Helper function that splits the global worker and OSM request budgets between
+  [parallel] concurrently running queries, by adding (or rewriting) the
+  `--workers`, `--osm_workers` and `--osm_rpm` arguments of each DataPipeline run.
+  """
+  def split(flag, total):
+    if flag in pipeline_args:
+      i = pipeline_args.index(flag)
+      total = int(pipeline_args[i+1])
+      del pipeline_args[i:i+2]
+    pipeline_args.extend([flag, str(max(1, total // parallel))])
+
+  split('--workers', workers)
+  split('--osm_workers', 4)
+  split('--osm_rpm', 30)
+  return pipeline_args
+
+
+def merge_datasets(merge_path, data_paths, classes_path='classes.json'):
+  """
+  Links the tiles of all datasets in [data_paths] into one dataset in [merge_path].
+  Any tiles of an earlier merge are removed first.
+  """
+  merged = Dataset(merge_path, classes_path=classes_path)
+  for path, names in [(merged.images_path, merged.img_list),
+                      (merged.annotations_path, merged.annotation_list)]:
+    for f in names:
+      os.remove(os.path.join(path, f))
+
+  total = Dataset._combine_datasets(merge_path, classes_path, *data_paths, link=True)
+  print(f"Merged {len(data_paths)} datasets into {merge_path} ({total} tiles).")
+
+
+def print_report(status, paths):
+  """
+  Prints the status, run time and number of tiles of every query in the batch.
+  """
+  print(f"\n{'query':<40}{'status':<10}{'seconds':>10}{'tiles':>10}")
+  for p in paths:
+    info = status.queries.get(query_name(p), {})
+    print(f"{query_name(p):<40}{info.get('status', '-'):<10}"
+          f"{info.get('seconds', '-'):>10}{info.get('tiles', '-'):>10}")
+  print()
+
+
+def passed_arguments():
+  parser = argparse.ArgumentParser(
+    description="Script to run DataPipeline.py over a directory (or glob) of PAIRS queries.")
+  parser.add_argument("-q", "--queries",
+                      type=str,
+                      required=True,
+                      help="Directory of .json PAIRS queries, or a glob pattern matching them.")
+  parser.add_argument("-d", "--data_path",
+                      type=str,
+                      required=True,
+                      help="Directory where each query's dataset is stored (in a sub directory).")
+  parser.add_argument("-w", "--workers",
+                      type=int,
+                      default=1,
+                      help="Total number of tiling processes, shared by all running queries.")
+  parser.add_argument("-p", "--parallel",
+                      type=int,
+                      default=None,
+                      help="Maximum number of queries run at the same time (default: workers).")
+  parser.add_argument("-m", "--merge_path",
+                      type=str,
+                      default=None,
+                      help="Merge all queries into one dataset with unique tile indices here.")
+  parser.add_argument("-c", "--classes",
+                      type=str,
+                      default=os.path.join(".", "classes.json"),
+                      help="Path to json file determining OSM classes. Should not be changed.")
+  parser.add_argument("--rerun",
+                      action="store_true",
+                      default=False,
+                      help="Rerun queries that are already done too.")
+  args, pipeline_args = parser.parse_known_args()
+  return args, pipeline_args
+
+
+if __name__ == "__main__":
+  args, pipeline_args = passed_arguments()
+
+  # Any other arguments (eg: --tile_size, --streaming) are passed on to DataPipeline.py
+  pipeline_args += ['--classes', args.classes]
+  succeeded = run_batch(args.queries, args.data_path, workers=args.workers,
+                        parallel=args.parallel, merge_path=args.merge_path,
+                        classes_path=args.classes, rerun=args.rerun,
+                        pipeline_args=pipeline_args)
+  if not succeeded:
+    sys.exit(1)
@@ -0,0 +1,87 @@
+## BatchPrefetcher loads the next batches of a dataset in the background while the current one is used.
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+
+# Per-process state of a batch loading worker: the function loading a batch.
+_batch_worker = {}
+
+def _init_batch_worker(load_batch):
+  """
+  Helper function only.
+  Initialises a batch loading worker process with the function loading a batch, so
+  that it (and the dataset it belongs to) is only sent to each worker once.
+  """
+  _batch_worker['load_batch'] = load_batch
+
+
+def _load_batch_worker(item):
+  """
+  Helper function only. Loads one batch (or item) in a worker process.
+  """
+  return _batch_worker['load_batch'](item)
+
+
+def split_batches(indices, batch_size, drop_last=False):
+  """
+  Returns the list of consecutive batches of [batch_size] of [indices], without the
+  last smaller batch if [drop_last].
+  """
+  assert batch_size > 0, "Batch size must be positive."
+  indices = list(indices)
+  end = len(indices) - len(indices) % batch_size if drop_last else len(indices)
+  return [indices[i:i + batch_size] for i in range(0, end, batch_size)]
+
+
+def prefetch_batches(load_batch, indices, batch_size, workers=4, prefetch=2,
+                     processes=False, drop_last=False):
+  """
+  Yields `load_batch(batch_indices)` for the consecutive batches of [batch_size] of
+  [indices], in order, while loading the following batches in the background.
+  Requires:
+    load_batch: function loading (reading and decoding the files of) a list of indices\n
+    workers: number of batches loaded at the same time (0 to load them on the caller's
+             thread when they are needed, like calling `load_batch` directly)\n
+    prefetch: number of loaded batches kept ready ahead of the one being used, on top
+              of the ones being loaded\n
+    processes: load batches in worker processes instead of threads (for loading that
+               holds the GIL, eg: parsing json labels). `load_batch` must then be
+               picklable, eg: a method of a Dataset.\n
+  Returns:
+    A generator of the loaded batches. Closing it early stops the workers, and an
+    exception raised loading a batch is raised when that batch is reached.
+  """
+  return prefetch_map(load_batch, split_batches(indices, batch_size, drop_last),
+                      workers=workers, prefetch=prefetch, processes=processes)
+
+
+def prefetch_map(load, items, workers=4, prefetch=2, processes=False):
+  """
+  Yields `load(item)` for every item of the iterable [items], in order, while loading
+  the following items in the background (see `prefetch_batches`). [items] is only
+  consumed as far ahead as the items being loaded, so it can be a stream.
+  """
+  if workers == 0:
+    for item in items:
+      yield load(item)
+    return
+
+  if processes:
+    pool = multiprocessing.Pool(workers, initializer=_init_batch_worker, initargs=(load,))
+    load = _load_batch_worker
+  else:
+    pool = ThreadPool(workers)
+
+  pending = collections.deque()
+  try:
+    for item in items:
+      # At most workers + prefetch items are loading or loaded ahead of the consumer.
+      if len(pending) == workers + prefetch:
+        yield pending.popleft().get()
+      pending.append(pool.apply_async(load, (item,)))
+    while pending:
+      yield pending.popleft().get()
+  finally:
+    pool.terminate()
+    pool.join()
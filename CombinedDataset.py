@@ -0,0 +1,249 @@
+## CombinedDataset serves the tiles of several datasets as one, without copying any tile.
+import bisect
+import functools
+import argparse
+import numpy as np
+from Dataset import Dataset
+from BatchPrefetcher import prefetch_batches
+from SampleCache import SampleCache
+
+
+class CombinedDataset:
+  """
+  The 'CombinedDataset' class provides the same interface as 'Dataset' (length, tile
+  size, getting tiles with their labels and batches of them, finding and visualizing
+  tiles) over several existing datasets, eg: NYC + LA + Dallas, without copying their
+  tiles into a new directory.
+
+  The tiles of the datasets are indexed one after the other: global index `i` is
+  tile `i - offsets[s]` of dataset `s`, where `offsets` are the cumulative sizes of
+  the datasets. Each dataset can be given a sampling weight, so that training draws
+  its tiles in proportion to the weights (eg: to stop the largest city from
+  dominating), rather than in proportion to the dataset sizes.
+
+  Copying (or hard linking) the tiles into one dataset is only needed to move them
+  elsewhere, with `export`.
+  """
+
+  def __init__(self, datasets, weights=None):
+    """
+    Initializes a view over the list of Dataset objects [datasets] (all with the same
+    classes), sampled in proportion to [weights] (one non-negative weight per dataset,
+    proportional to the dataset sizes if None).
+    """
+    assert datasets, "Can't combine an empty list of datasets."
+    for ds in datasets[1:]:
+      assert ds.classes == datasets[0].classes, "Combined datasets must have the same classes."
+    if weights is not None:
+      assert len(weights) == len(datasets), "There must be one weight per dataset."
+      assert all(w >= 0 for w in weights) and sum(weights) > 0,\
+        "Weights must be non-negative and not all 0."
+
+    self.datasets = datasets
+    self.weights = weights
+    self.classes = datasets[0].classes
+    self.offsets = self.cumulative_sizes([len(ds) for ds in datasets])
+
+  @classmethod
+  def from_paths(cls, data_paths, classes_path='classes.json', weights=None,
+                 dataset_class=Dataset, **kwargs):
+    """
+    Returns the combination of the datasets in [data_paths], opened as [dataset_class]
+    objects (with the keyword arguments [kwargs]).
+    """
+    return cls([dataset_class(path, classes_path=classes_path, **kwargs)
+                for path in data_paths], weights=weights)
+
+  @staticmethod
+  def cumulative_sizes(sizes):
+    """
+    Helper method only. Returns the global index of the first tile of each dataset,
+    followed by the total number of tiles.
+    """
+    return [0] + np.cumsum(sizes).tolist()
+
+  def __len__(self):
+    """
+    Updates the offsets of the datasets and returns the total number of tiles.
+    """
+    self.offsets = self.cumulative_sizes([len(ds) for ds in self.datasets])
+    return self.offsets[-1]
+
+  def locate(self, index, offsets=None):
+    """
+    Maps a global [index] to (number of the dataset, index in that dataset), using
+    the cumulative sizes [offsets] (of the whole datasets by default).
+    """
+    offsets = self.offsets if offsets is None else offsets
+    if not 0 <= index < offsets[-1]:
+      raise IndexError(f"Index {index} out of range for {offsets[-1]} tiles.")
+    source = bisect.bisect_right(offsets, index) - 1
+    return source, index - offsets[source]
+
+  def global_index(self, source, index, offsets=None):
+    """
+    Maps tile [index] of dataset number [source] to its global index.
+    """
+    offsets = self.offsets if offsets is None else offsets
+    return offsets[source] + index
+
+  def get_img_size(self):
+    """
+    Gets the size of images as (h, w, d), assumed to be the same in every dataset.
+    """
+    return self.datasets[0].get_img_size()
+
+  def get_tile_and_label(self, index):
+    """
+    Gets the tile and label of global [index] from the dataset it belongs to.
+
+    Returns:
+    (tile_array, dictionary_of_buildings)
+    """
+    source, local = self.locate(index)
+    return self.datasets[source].get_tile_and_label(local)
+
+  def get_batch(self, start_index, batch_size):
+    """
+    Gets batch of tiles and labels from global start_index (which may span datasets).
+
+    Returns:
+    [(tile_array, list_of_buildings), ...]
+    """
+    return [self.get_tile_and_label(i) for i in range(start_index, start_index + batch_size)]
+
+  def enable_cache(self, max_bytes, spill_path=None, spill_bytes=0):
+    """
+    Caches decoded samples of all the datasets in one SampleCache of [max_bytes]
+    bytes (see `Dataset.enable_cache`).
+    Returns:
+      The SampleCache.
+    """
+    cache = SampleCache(max_bytes, spill_path, spill_bytes)
+    for ds in self.datasets:
+      ds.enable_cache(max_bytes, cache=cache)
+    return cache
+
+  def load_batch(self, indices):
+    """
+    Helper method only. Gets the tiles and labels of the list of global [indices].
+    """
+    return [self.get_tile_and_label(i) for i in indices]
+
+  def iter_batches(self, indices, batch_size, workers=4, prefetch=2, processes=False,
+                   drop_last=False, **kwargs):
+    """
+    Iterates over the batches of [batch_size] of global [indices], in order, loading
+    the next ones in the background (see `Dataset.iter_batches`).
+    """
+    load_batch = functools.partial(self.load_batch, **kwargs) if kwargs else self.load_batch
+    return prefetch_batches(load_batch, indices, batch_size, workers=workers, prefetch=prefetch,
+                            processes=processes, drop_last=drop_last)
+
+  def sample_indices(self, num_samples, sizes=None, seed=None):
+    """
+    Returns a shuffled list of [num_samples] global indices, drawn from the datasets
+    (with [sizes] tiles each, the whole datasets by default) in proportion to their
+    weights. Within a dataset the tiles are drawn without replacement, and only repeat
+    once all of its tiles were drawn. Without weights, all tiles are drawn (each once
+    if [num_samples] is the total number of tiles) as by shuffling the indices.
+    """
+    sizes = [len(ds) for ds in self.datasets] if sizes is None else sizes
+    offsets = self.cumulative_sizes(sizes)
+    rng = np.random.RandomState(seed)
+    if self.weights is None:
+      weights = np.array(sizes, dtype=np.float64)
+    else:
+      # Datasets without tiles can't be drawn from, whatever their weight.
+      weights = np.array([w if size else 0 for w, size in zip(self.weights, sizes)],
+                         dtype=np.float64)
+    if num_samples == 0 or weights.sum() == 0:
+      return []
+
+    if self.weights is None and num_samples == offsets[-1]:
+      counts = sizes
+    else:
+      counts = rng.multinomial(num_samples, weights / weights.sum())
+
+    indices = []
+    for source, count in enumerate(counts):
+      repeats = -(-count // sizes[source]) if count else 0
+      local = np.concatenate([rng.permutation(sizes[source]) for _ in range(repeats)] +\
+                             [np.zeros(0, dtype=np.int64)])[:count]
+      indices.extend((local + offsets[source]).tolist())
+    rng.shuffle(indices)
+    return indices
+
+  def tiles_in_bbox(self, lat_min, lon_min, lat_max, lon_max):
+    """
+    Returns the sorted global indices of the tiles of every dataset intersecting the
+    geographic bounding box [lat_min, lon_min, lat_max, lon_max] (see `Dataset.tiles_in_bbox`).
+    """
+    len(self)
+    return [self.global_index(source, index)
+            for source, ds in enumerate(self.datasets)
+            for index in ds.tiles_in_bbox(lat_min, lon_min, lat_max, lon_max)]
+
+  def visualize_tile(self, index):
+    """
+    Visualizes the tile of global [index] with its labels.
+    """
+    source, local = self.locate(index)
+    self.datasets[source].visualize_tile(local)
+
+  def export(self, new_data_path, classes_path='classes.json', link=True):
+    """
+    Writes the combined tiles as one dataset in [new_data_path] (see
+    `Dataset._combine_datasets`), hard linking them unless [link] is False.
+    Returns:
+      The number of tiles in the new dataset.
+    """
+    return Dataset._combine_datasets(new_data_path, classes_path,
+                                     *[ds.data_path for ds in self.datasets], link=link)
+
+
+def passed_arguments():
+  parser = argparse.ArgumentParser(
+    description="Script to use several datasets as one, without copying their tiles.")
+  parser.add_argument('-d', '--data_paths',
+                      nargs='+',
+                      type=str,
+                      required=True,
+                      help='Paths to the directories of the datasets to combine.')
+  parser.add_argument('-c', '--classes_path',
+                      type=str,
+                      default='classes.json',
+                      help='Path to .json file denoting classes of labels used in dataset.')
+  parser.add_argument('-w', '--weights',
+                      nargs='+',
+                      type=float,
+                      default=None,
+                      help='Sampling weight of each dataset (proportional to their sizes by default).')
+  parser.add_argument('-t', '--tile',
+                      type=int,
+                      default=0,
+                      help='Visualize t tiles sampled from the datasets by their weights.')
+  parser.add_argument('--export',
+                      type=str,
+                      default=None,
+                      help='Path to write the combined tiles to as one dataset.')
+  parser.add_argument('--copy',
+                      action='store_true',
+                      default=False,
+                      help='Copy the tiles when exporting instead of hard linking them.')
+  args = parser.parse_args()
+  return args
+
+
+if __name__ == "__main__":
+  args = passed_arguments()
+  combined = CombinedDataset.from_paths(args.data_paths, args.classes_path, weights=args.weights)
+  for path, start, end in zip(args.data_paths, combined.offsets, combined.offsets[1:]):
+    print(f"{path}: tiles {start} to {end - 1}")
+
+  if args.export:
+    total = combined.export(args.export, args.classes_path, link=not args.copy)
+    print(f"Exported {total} tiles to {args.export}")
+  if args.tile:
+    for i in combined.sample_indices(args.tile):
+      combined.visualize_tile(i)
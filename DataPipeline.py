@@ -1,21 +1,40 @@
 ## DataPipeline fetches image and bounding box data from the source APIs in pixel format.
 ## Minimal processing is done.
+import sys
 import json
 import os
 import numpy as np
 import zipfile, io
+import copy
+import hashlib
 from ibmpairs import paw
+import time
 from time import sleep
-import overpy
-import pickle 
+import threading
+import concurrent.futures
+import requests
 import math
 import argparse
+import multiprocessing
 from PIL import Image
 from Dataset import Dataset
+from LabelStore import LabelStore, LabelIndex
+from OSMCache import OSMCache
+from Manifest import Manifest
+from TileCatalog import TileCatalog
+from TileFilter import TileFilter
+import Pyramid
+import TileEncoder
+
+# Overpass API endpoint used to query OpenStreetMap.
+OVERPASS_URL = os.environ.get("OVERPASS_URL", "https://overpass-api.de/api/interpreter")
 
 
 class DataInfo:
-  def __init__(self, data_path, tile_size, overlap, pairs_query_path, classes_path):
+  def __init__(self, data_path, tile_size, overlap, pairs_query_path, classes_path, 
+               workers=1, streaming=False, osm_cache=True, osm_cache_dir=None,
+               osm_grid=1, osm_workers=4, osm_rpm=30, restart=False, tile_filter=None,
+               pyramid=None, image_encoder=None, label_encoder=None):
     # A Dataset object handling directory names and paths
     # It will also create directories for the data if they don't exist.
     self.ds = Dataset(data_path, classes_path=classes_path)
@@ -32,11 +51,47 @@ class DataInfo:
     # Path to the file where json PAIRS query is stored.
     self.pairs_query_path = pairs_query_path
 
+    # Name of the query, recorded as the source of every tile in the TileCatalog.
+    self.source = os.path.splitext(os.path.basename(pairs_query_path))[0]
+
+    # [LAT_MIN, LON_MIN, LAT_MAX, LON_MAX] of the entire image, set from the query
+    # by create_dataset, to catalog the geographic bounds of every tile.
+    self.coords = None
+
     # Path to json file containing the OSM classes.
     self.classes_path = classes_path
 
-    # Name of file where raw OSM data will be dumped as a dictionary.
-    self.osm_filename = 'OSM_bbox.pkl'
+    # Name of file where raw OSM data will be dumped as a LabelStore.
+    self.osm_filename = 'OSM_bbox.npz'
+
+    # Number of worker processes used to tile the image.
+    self.workers = workers
+
+    # Whether to clean the entire image in row blocks into an on-disk memmap.
+    self.streaming = streaming
+
+    # Whether to reuse OSM query results from the on-disk OSMCache (and where it is).
+    self.osm_cache = osm_cache
+    self.osm_cache_dir = osm_cache_dir
+
+    # Grid of sub boxes to split the OSM query into, fetched concurrently by at most
+    # osm_workers threads, starting at most osm_rpm requests per minute.
+    self.osm_grid = osm_grid
+    self.osm_workers = osm_workers
+    self.osm_rpm = osm_rpm
+
+    # Whether to ignore the stages recorded in raw_data/manifest.json and start over.
+    self.restart = restart
+
+    # TileFilter rejecting tiles (eg: nodata or without labels) before they are saved.
+    self.tile_filter = tile_filter
+
+    # Factors by which coarser levels of the dataset are downsampled (eg: [2, 4]).
+    self.pyramid = sorted(set(pyramid or []) - {1})
+
+    # Formats the tiles and their labels are saved in (see TileEncoder).
+    self.image_encoder = image_encoder or TileEncoder.JpegEncoder()
+    self.label_encoder = label_encoder or TileEncoder.JsonLabelEncoder(indent=2)
 
   
 def create_dataset(data_info, source="IBM"):
@@ -49,6 +104,14 @@ def create_dataset(data_info, source="IBM"):
 
   [source] is the source API of the data (eg. IBM, Google, etc.)
   If [source=="IBM"], then [(user, password)] is also required.
+
+  Each completed stage (raster fetched, OSM fetched, projected, tiles written) is 
+  recorded in `raw_data/manifest.json` (see `Manifest`), so that a rerun after a
+  failure skips the finished stages and only writes missing or stale tiles, unless
+  [data_info.restart].
+
+  Returns:
+  True if the dataset was created, False if the query or classes file is invalid.
   """
 
   # Read the query file, exit if wrong format
@@ -59,13 +122,14 @@ def create_dataset(data_info, source="IBM"):
       query = json.load(query_file)
     except:
       print("Your query file is not in proper json format (or is empty).")
-      return
+      return False
   
   # Extract coordinates from query [lat_min, lon_min, lat_max, lon_max]
   try:
     coords = query['spatial']['coordinates']
   except:
     print("Your .json query does not have coordinates specified in the right manner.")
+    return False
 
   # Extract dictionary of OSM label classes from file.
   with open(data_info.classes_path, 'r') as classes_file:
@@ -73,25 +137,74 @@ def create_dataset(data_info, source="IBM"):
       classes = json.load(classes_file)
     except:
       print("Your classes .json file is not in the right json format (or is empty)")
-      return
-
-  print("Querying raw image from PAIRS using coordinates given:\n")
-  images = query_PAIRS(query, data_info.ds.raw_data_path)
-
-  print("\nConverting raw image to numpy array.\nDeleting raw images, saving jpeg instead.")
-  im_arr = image_to_array(data_info.ds.raw_data_path, images)
-
-  print("Querying raw bounding box data from OpenStreetMap using coordinates given. ")
-  raw_OSM = query_OSM(coords, classes)
+      return False
+
+  raw_data_path = data_info.ds.raw_data_path
+  manifest = Manifest(raw_data_path)
+  if data_info.restart:
+    manifest.reset()
+
+  # The cleaned image is kept losslessly in Entire_Area.npy, so that it can be reused.
+  area_path = os.path.join(raw_data_path, 'Entire_Area.npy')
+  raster_key = Manifest.key(query)
+  if manifest.is_done('raster', raster_key):
+    print("Raw image already fetched, loading it from raw_data/Entire_Area.npy")
+    im_arr = np.load(area_path, mmap_mode='r')
+  else:
+    print("Querying raw image from PAIRS using coordinates given:\n")
+    images = query_PAIRS(query, raw_data_path)
+
+    print("\nConverting raw image to numpy array.\nDeleting raw images, saving jpeg instead.")
+    im_arr = image_to_array(raw_data_path, images, 
+                            streaming=data_info.streaming)
+    if not isinstance(im_arr, np.memmap):
+      np.save(area_path, im_arr)
+      im_arr = np.load(area_path, mmap_mode='r')
+    manifest.complete('raster', raster_key, area_path)
+
+  osm_path = os.path.join(raw_data_path, data_info.osm_filename)
+  osm_key = Manifest.key(coords, classes)
+  if manifest.is_done('osm', osm_key):
+    print(f"OpenStreetMap data already fetched, loading it from raw_data/{data_info.osm_filename}")
+    raw_OSM = LabelStore.load(osm_path)
+  else:
+    print("Querying raw bounding box data from OpenStreetMap using coordinates given. ")
+    cache = OSMCache(data_info.osm_cache_dir) if data_info.osm_cache else None
+    raw_OSM = query_OSM(coords, classes, cache=cache, grid=data_info.osm_grid, 
+                        max_workers=data_info.osm_workers, 
+                        requests_per_minute=data_info.osm_rpm)
+    raw_OSM.save(osm_path)
+    manifest.complete('osm', osm_key, osm_path)
 
   # Bounding box data in pixel format
   im_size = im_arr.shape
-  label_coords = coords_to_pixels(raw_OSM, coords, im_size, data_info.ds.raw_data_path)
-
-  print("Tiling image and saving .jpeg files (for tile) and .json files (for bounding boxes)")
-  tile_image(label_coords, im_arr, im_size, data_info)
+  labels_path = os.path.join(raw_data_path, 'annotations.npz')
+  projected_key = Manifest.key(manifest.output_hash('osm'), coords, im_size)
+  if manifest.is_done('projected', projected_key):
+    label_coords = LabelStore.load(labels_path)
+  else:
+    label_coords = coords_to_pixels(raw_OSM, coords, im_size, raw_data_path)
+    manifest.complete('projected', projected_key, labels_path)
+
+  data_info.coords = coords
+  print(f"Tiling image and saving {data_info.image_encoder.ext} files (for tile) and" +\
+        f" {data_info.label_encoder.ext} files (for bounding boxes)")
+  tile_filter = data_info.tile_filter
+  manifest.start_tiles(Manifest.key(manifest.output_hash('raster'), 
+                                    manifest.output_hash('projected'),
+                                    data_info.tile_size, data_info.overlap,
+                                    tile_filter.config() if tile_filter else None,
+                                    data_info.image_encoder.config(),
+                                    data_info.label_encoder.config()))
+  tile_image(label_coords, im_arr, im_size, data_info, manifest=manifest)
+  manifest.complete_tiles()
+
+  if data_info.pyramid:
+    print(f"Building pyramid levels downsampled by {data_info.pyramid}")
+    tile_pyramid(label_coords, im_arr, data_info, manifest)
 
   print("Success! Your raw dataset is now ready!")
+  return True
 
 
 def query_PAIRS(query_json, raw_data_path, path_to_credentials='./ibmpairspass.txt'):
@@ -134,16 +247,28 @@ def query_PAIRS(query_json, raw_data_path, path_to_credentials='./ibmpairspass.t
   return images
     
 
-def image_to_array(raw_data_path, images):
+def image_to_array(raw_data_path, images, streaming=False, block_rows=1024):
   """
   Takes the list of raw image(s) downloaded from the query in RGB order, and converts 
   them to an np array. Stores the entire area's image in raw_data_path.
+  If [streaming], the image is instead cleaned in blocks of [block_rows] rows and 
+  written to an on-disk `Entire_Area.npy` memmap (see `image_to_memmap`).
 
   Returns: 
-  A numpy array of the entire image.
+  A numpy array (or read-only memmap if [streaming]) of the entire image.
   """
   # If query doesn't return list of images, then extract images from download folder.
   if images is None or images == []:
+    if streaming:
+      bands, raw_paths = raw_tiff_bands(raw_data_path)
+      im_arr = image_to_memmap(raw_data_path, bands, block_rows)
+
+      # Remove the raw .tiff images
+      del bands
+      for path_to_file in raw_paths:
+        os.remove(path_to_file)
+      return im_arr
+
     images = []
     file_names = sorted(os.listdir(raw_data_path), reverse=True)
 
@@ -165,6 +290,10 @@ def image_to_array(raw_data_path, images):
         # Remove the raw .tiff image
         os.remove(path_to_file)
         os.remove(path_to_file + '.json')
+
+  elif streaming:
+    bands = [(image.shape, lambda r0, r1, image=image: image[r0:r1]) for image in images]
+    return image_to_memmap(raw_data_path, bands, block_rows)
   
   # Return rgb image in np array format
   im_arr = np.dstack(images)
@@ -187,128 +316,370 @@ def image_to_array(raw_data_path, images):
   return im_arr
 
 
-def query_OSM(coords, classes):
+def raw_tiff_bands(raw_data_path):
+  """
+  Helper function only.
+  Opens the raw .tiff images in raw_data_path (in RGB order) without reading them.
+  Returns:
+  A list of (shape, read_rows) pairs, where read_rows(row_start, row_end) reads that 
+  block of rows of the band, and the list of raw files to remove once done reading.
+  """
+  from osgeo import gdal
+
+  bands, raw_paths = [], []
+  for filename in sorted(os.listdir(raw_data_path), reverse=True):
+    path_to_file = os.path.join(raw_data_path, filename)
+    # Remove output.info
+    if filename.endswith(".info"):
+      os.remove(path_to_file)
+
+    if filename.endswith(".tiff"):
+      dataset = gdal.Open(path_to_file)
+      band = dataset.GetRasterBand(1)
+      shape = (dataset.RasterYSize, dataset.RasterXSize)
+      read_rows = lambda r0, r1, dataset=dataset, band=band:\
+        band.ReadAsArray(0, r0, dataset.RasterXSize, r1 - r0)
+      bands.append((shape, read_rows))
+      raw_paths.extend([path_to_file, path_to_file + '.json'])
+  return bands, raw_paths
+
+
+def image_to_memmap(raw_data_path, bands, block_rows=1024):
+  """
+  Out-of-core version of `image_to_array`. Cleans the image in blocks of [block_rows]
+  rows, and writes the cleaned uint8 RGB image to `raw_data/Entire_Area.npy`, so
+  that only one block is in memory at a time.
+
+  The first pass over the blocks only reads the red band to find the rows and 
+  columns that contain valid (not NaN or -128) pixels. The second pass writes the 
+  valid rows and columns of each block to the memmap.
+
+  Requires:
+  [bands] is a list of (shape, read_rows) pairs in RGB order, where 
+    read_rows(row_start, row_end) returns that block of rows of the band.
+
+  Returns: 
+  A read-only memmap of the entire image.
+  """
+  height, width = bands[0][0]
+  blocks = [(r0, min(r0 + block_rows, height)) for r0 in range(0, height, block_rows)]
+
+  # Pass 1: rows and columns with valid pixels in the red channel.
+  row_mask = np.zeros(height, dtype=bool)
+  col_mask = np.zeros(width, dtype=bool)
+  read_red = bands[0][1]
+  for r0, r1 in blocks:
+    red = read_red(r0, r1)
+    valid = red > -128 # NaN > -128 is False
+    row_mask[r0:r1] = valid.any(axis=1)
+    col_mask |= valid.any(axis=0)
+
+  # Pass 2: clean each block and write it to disk.
+  path = os.path.join(raw_data_path, 'Entire_Area.npy')
+  out_shape = (int(row_mask.sum()), int(col_mask.sum()), len(bands))
+  im_arr = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=out_shape)
+
+  out_row = 0
+  for r0, r1 in blocks:
+    block_mask = row_mask[r0:r1]
+    if not block_mask.any():
+      continue
+    block = np.dstack([read_rows(r0, r1) for _, read_rows in bands])
+    block = block[block_mask][:, col_mask, :]
+    block[np.isnan(block)] = -128
+
+    # Add 128 to make all values positive.
+    im_arr[out_row:out_row + len(block)] = (block + 128).astype(np.uint8)
+    out_row += len(block)
+
+  im_arr.flush()
+  del im_arr
+  return np.load(path, mmap_mode='r')
+
+
+def query_OSM(coords, classes, cache=None, grid=1, max_workers=4, 
+              requests_per_minute=30, retries=4):
   """
-  Sends a request to OSM server and returns a dictionary of all the buildings
+  Sends a request to OSM server and returns a LabelStore of all the buildings
   and roads nodes along with their sub classes in the area specified by [coords].
   Those buildings and roads not in specified sub-classes are of sub-class "other".
+  All super classes are fetched with a single union query.
+  If an OSMCache [cache] is given, the parsed result of the query is looked up in
+  (or added to) the cache instead of always querying the server.
+
+  For large areas, [grid] > 1 splits [coords] into a [grid x grid] grid of sub boxes,
+  which are fetched concurrently by at most [max_workers] threads while starting at 
+  most [requests_per_minute] requests per minute. Each failed request is retried up to
+  [retries] times with exponential backoff. Ways crossing the borders of sub boxes
+  are only kept once (by way id).
 
   Returns: 
-  {building:
-    building_class1: [[building_class1_way1_node1, ...], [way2_node1, ...], ...],
-  ..., 
-  road:
-    road_class_1: [[road_class1_way1_node1, ...], [way2_node1, ...], ...],
-  ...} 
+  A LabelStore whose classes are
+  {building: [building_class1, ..., other], road: [road_class_1, ..., other], ...}
   where each node is in (lat,lon) format.
   """
-  api = overpy.Overpass()
+  limiter = RateLimiter(requests_per_minute)
+  if grid <= 1:
+    return query_OSM_bbox(coords, classes, cache, limiter, retries)
+
+  sub_boxes = split_bbox(coords, grid)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
+    futures = [ex.submit(query_OSM_bbox, sub_coords, classes, cache, limiter, retries)
+               for sub_coords in sub_boxes]
+    sub_box_stores = [future.result() for future in futures]
+
+  store = LabelStore.concatenate(LabelStore.with_other(classes), sub_box_stores)
+  return store.unique_ways()
+
+
+def query_OSM_bbox(coords, classes, cache=None, limiter=None, retries=0):
+  """
+  Helper function for `query_OSM` that fetches (or looks up in [cache]) all the 
+  super classes in the single bounding box [coords] with one union query.
+  """
   coords_string = f"{coords[0]}, {coords[1]}, {coords[2]}, {coords[3]}"
+  super_class_queries = "".join(f'way({coords_string})["{super_class}"];' 
+                                for super_class in classes)
+  query_string =\
+    f"""
+    [out:json];
+    ({super_class_queries});
+    (._;>;);
+    out body;
+    """
+
+  # Use the cached result of the same query if there is one.
+  key = OSMCache.key(coords, classes, query_string)
+  cached = cache.get(key) if cache else None
+  if cached is not None:
+    return cached
+
+  # Retry failed (eg: throttled or timed out) queries with exponential backoff.
+  for attempt in range(retries + 1):
+    if limiter:
+      limiter.wait()
+    try:
+      data = overpass_query(query_string)
+      break
+    except (RuntimeError, ValueError, requests.exceptions.RequestException) as e:
+      if attempt == retries:
+        raise
+      print(f"OSM query for {coords} failed ({e}), retrying...")
+      sleep(2 ** (attempt + 1))
 
-  # The dictionary of queried OSM labels for all classes
-  query_data = {}
-  for super_class, sub_classes in classes.items():
-    query_data[super_class] = {}
-    for sub_class in sub_classes + ["other"]:
-      query_data[super_class][sub_class] = []
+  store = parse_overpass_json(data, classes)
+  if cache:
+    cache.put(key, store)
+  return store
+
+
+def split_bbox(coords, grid):
+  """
+  Splits the bounding box [coords] into a [grid x grid] grid of equal sub boxes.
+  Requires:
+  `coords` is is in [LAT_MIN, LON_MIN, LAT_MAX, LON_MAX] format \n
+  Returns: 
+  A list of sub boxes in the same format, row by row from LAT_MIN, LON_MIN.
+  """
+  lat_min, lon_min, lat_max, lon_max = coords
+  lats = np.linspace(lat_min, lat_max, grid + 1)
+  lons = np.linspace(lon_min, lon_max, grid + 1)
+  return [[float(lats[i]), float(lons[j]), float(lats[i+1]), float(lons[j+1])]
+          for i in range(grid) for j in range(grid)]
 
-  # Query each super class, and then process data.
-  for super_class, sub_classes in classes.items():
+
+class RateLimiter:
+  """
+  Thread-safe limiter that spaces out the start of requests so that at most
+  `requests_per_minute` requests are started every minute.
+  """
+  def __init__(self, requests_per_minute):
+    self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+    self.next_time = time.monotonic()
+    self.lock = threading.Lock()
+
+  def wait(self):
+    """
+    Blocks until the caller is allowed to start its next request.
+    """
+    with self.lock:
+      now = time.monotonic()
+      start = max(now, self.next_time)
+      self.next_time = start + self.interval
+    if start > now:
+      sleep(start - now)
+
+
+def overpass_query(query_string, url=None, timeout=600):
+  """
+  Sends the Overpass QL [query_string] (which must ask for `[out:json]`) to the
+  Overpass API at [url] (defaults to OVERPASS_URL).
+  Returns:
+  The decoded json response as a dictionary.
+  """
+  response = requests.post(url or OVERPASS_URL, data={"data": query_string}, timeout=timeout)
+  if not response.ok:
+    raise RuntimeError(f"Overpass query failed with status: {response.status_code}")
+
+  try:
+    data = response.json()
+  except ValueError:
+    raise ValueError(f"Overpass response cannot be converted to .json dict")
+
+  # Overpass reports errors (eg: timeouts) in the response, with partial results.
+  remark = data.get("remark", "")
+  if "error" in remark:
+    raise RuntimeError(f"Overpass query failed: {remark}")
+  return data
+
+
+def parse_overpass_json(data, classes):
+  """
+  Parses the json response [data] of an Overpass query straight into a LabelStore.
+  Each way is added once for every super class in [classes] that it is tagged with,
+  and its node ids are resolved to (lat, lon) through a sorted node id lookup table.
+
+  Returns: 
+  A LabelStore with the classes in [classes] (plus "other"), 
+  where each node is in (lat,lon) format.
+  """
+  all_classes = LabelStore.with_other(classes)
+  elements = data.get("elements", [])
+  nodes = [e for e in elements if e["type"] == "node"]
+  ways = [e for e in elements if e["type"] == "way" and e.get("nodes")]
+
+  # Node id lookup table, sorted by id.
+  node_ids = np.fromiter((n["id"] for n in nodes), dtype=np.int64, count=len(nodes))
+  node_coords = np.array([(n["lat"], n["lon"]) for n in nodes], dtype=np.float64).reshape(-1, 2)
+  order = np.argsort(node_ids, kind='stable')
+  sorted_ids = node_ids[order]
+
+  # Rows of the store: (super_id, class_id, way), grouped by super class.
+  rows = []
+  for super_id, (super_class, sub_classes) in enumerate(classes.items()):
     sub_classes = set(sub_classes)
+    # "amenity" is current building status (eg: building that is hospital now vs was in past)
+    sub_class_key = "amenity" if super_class == "building" else super_class
     
-    query_string =\
-      f"""
-      way({coords_string})["{super_class}"];
-      (._;>;);
-      out body;
-      """
-    super_class_query_result = api.query(query_string)
-
-    # Go through each way and append nodes to corresponding subclass list of points.
-    for way in super_class_query_result.ways:
-      points = [(float(str(n.lat)), float(str(n.lon))) for n in way.nodes]
-      # "amenity" is current building status (eg: building that is hospital now vs was in past)
-      sub_class_key = "amenity" if super_class == "building" else super_class
+    for way in ways:
+      tags = way.get("tags", {})
+      if super_class not in tags:
+        continue
 
       # subclass is "other" if it doesn't exist in defined set of subclasses
-      sub_class_tag = way.tags.get(sub_class_key, "other")
+      sub_class_tag = tags.get(sub_class_key, "other")
       sub_class = sub_class_tag if sub_class_tag in sub_classes else "other"
-
-      query_data[super_class][sub_class].append(points)
-  
-  return query_data
+      rows.append((super_id, all_classes[super_class].index(sub_class), way))
+
+  # Resolve the node ids of all ways at once.
+  lengths = np.array([len(way["nodes"]) for _, _, way in rows], dtype=np.int64)
+  way_node_ids = np.fromiter((n for _, _, way in rows for n in way["nodes"]), 
+                             dtype=np.int64, count=int(lengths.sum()))
+  pos = np.minimum(np.searchsorted(sorted_ids, way_node_ids), max(len(sorted_ids) - 1, 0))
+  if len(way_node_ids) and (not len(sorted_ids) or (sorted_ids[pos] != way_node_ids).any()):
+    raise ValueError("Overpass response is missing nodes of some of its ways.")
+
+  store = LabelStore(all_classes)
+  store.nodes = node_coords[order[pos]] if len(way_node_ids) else np.zeros((0, 2))
+  store.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+  store.super_ids = np.array([super_id for super_id, _, _ in rows], dtype=np.int32)
+  store.class_ids = np.array([class_id for _, class_id, _ in rows], dtype=np.int32)
+  store.way_ids = np.array([way["id"] for _, _, way in rows], dtype=np.int64)
+  return store
+
+
+def pixel_bounds(coords, im_size, tile_range):
+  """
+  Returns the geographic bounds [lat_min, lon_min, lat_max, lon_max] of the pixels
+  `tile_range` ([col_start, col_end, row_start, row_end], cut off at the edges of the
+  image) of an image of shape `im_size` covering `coords` (the inverse of 
+  `LabelStore.to_pixels`).
+  """
+  lat_min, lon_min, lat_max, lon_max = coords
+  height, width = im_size[:2]
+  col_start, col_end, row_start, row_end = tile_range
+  col_end, row_end = min(col_end, width), min(row_end, height)
+  return [lat_max - row_end / height * (lat_max - lat_min),
+          lon_min + col_start / width * (lon_max - lon_min),
+          lat_max - row_start / height * (lat_max - lat_min),
+          lon_min + col_end / width * (lon_max - lon_min)]
 
 
 def coords_to_pixels(raw_OSM, coords, im_size, raw_data_path, out_file="annotations"):
   """
   Converts the OSM coordinates to pixels relative to the image data.
-  Also stores the returned list of buildings in a pickle file called 'annotations.pkl'
+  Also stores the returned labels in a memory-mappable file called 'annotations.npz'
 
   Requires:
+  `raw_OSM` is a LabelStore with nodes in (lat, lon) format \n
   `coords` is is in [LAT_MIN, LON_MIN, LAT_MAX, LON_MAX] format \n
   `im_size` is the shape of the entire image numpy array as (h, w, ...) \n
-  `out_f` is the name of the file in `data_path/raw_data/[out_f].pkl` \n
+  `out_f` is the name of the file in `data_path/raw_data/[out_f].npz` \n
 
   Returns: 
-  {building:
-    building_class1: [[building_class1_way1_node1, ...], [way2_node1, ...], ...], ..., 
-  road:
-    road_class_1: [[road_class1_way1_node1, ...], [way2_node1, ...], ...], ...} 
-  where each node is in (pixel_x, pixel_y) format.
+  A LabelStore with the same ways as `raw_OSM`, where each node is in 
+  (pixel_x, pixel_y) format.
   """
-
-  label_coords = raw_OSM
-
-  lat_min, lon_min, lat_max, lon_max = coords
-  width = lon_max - lon_min # width in longitude of image
-  height = lat_max - lat_min # height in latitude of image
-
   # Replaces lat,lon label coordinates with x,y coordinates relative to image array
-  for super_class, sub_class_ways in label_coords.items():
-    for sub_class, ways in sub_class_ways.items():
-      for w_index, way in enumerate(ways):
-        for n_index, (lat, lon) in enumerate(way):
-          nodeX = math.floor(((lon-lon_min)/width)*im_size[1])
-          nodeY = math.floor(((lat_max-lat)/height)*im_size[0])
-          label_coords[super_class][sub_class][w_index][n_index] = (nodeX, nodeY)
-    
-  with open(os.path.join(raw_data_path, f"{out_file}.pkl"), "wb") as filename:
-    pickle.dump(label_coords, filename)
+  label_coords = raw_OSM.to_pixels(coords, im_size)
+  label_coords.save(os.path.join(raw_data_path, f"{out_file}.npz"))
 
   # Reutrn the pixel building coords
   return label_coords
 
 
-def save_tile_and_bboxes(tile, label_coords, file_index, data_info):
+def save_tile_and_bboxes(tile, label_coords, file_index, data_info, bounds=None, window=None):
   """
-  Saves the tile as an indexed .jpeg image and the label_coords as an indexed .json file.
+  Saves the tile as an indexed image and the label_coords as an indexed annotation
+  file, in the formats of [data_info.image_encoder] and [data_info.label_encoder]
+  (.jpeg and .json by default).
 
   Requires: 
   [tile] is a numpy array, 
   [label_coords] is a dictionary of label coordinates (in pixel value) associated with tile.
   [file_index] is an integer.
-  """
-  img_name = str(file_index) + '.jpg'
-  bbox_name = str(file_index) + '.json'
-
-  # save jpeg
-  filename = os.path.join(data_info.ds.images_path, img_name)
-  im = Image.fromarray(tile)
-  im.save(filename)
+  [bounds] (optional) is the [lat_min, lon_min, lat_max, lon_max] of the tile.
+  [window] (optional) is the [col_start, col_end, row_start, row_end] of the tile in
+  pixels of the entire image (eg: to compare the tile to `Entire_Area.npy`).
 
-  # save json
-  with open(os.path.join(data_info.ds.annotations_path, bbox_name), 'w') as filename:
-    json.dump(label_coords, filename, indent=2)
+  Returns:
+  The record of the written tile for the Manifest (and TileCatalog).
+  """
+  image_encoder, label_encoder = data_info.image_encoder, data_info.label_encoder
+
+  # save image (encoded in memory first, to hash it)
+  img_bytes = image_encoder.encode(tile)
+  img_path = TileEncoder.write_tile_file(data_info.ds.images_path, file_index, img_bytes,
+                                         image_encoder.ext, TileEncoder.IMAGE_EXTS)
+
+  # save labels
+  ann_bytes = label_encoder.encode(label_coords)
+  ann_path = TileEncoder.write_tile_file(data_info.ds.annotations_path, file_index, ann_bytes,
+                                         label_encoder.ext, TileEncoder.LABEL_EXTS)
+
+  return {
+    'index': file_index,
+    'image_file': os.path.basename(img_path),
+    'annotation_file': os.path.basename(ann_path),
+    'image': Manifest.file_record(img_path, hashlib.sha256(img_bytes).hexdigest()),
+    'annotation': Manifest.file_record(ann_path, hashlib.sha256(ann_bytes).hexdigest()),
+    'source': data_info.source,
+    'bounds': bounds,
+    'window': window,
+    'labels': TileCatalog.count_labels(label_coords)
+  }
   
   
-def boxes_in_tile(label_coords, tile_range):
+def boxes_in_tile(label_coords, tile_range, label_index=None):
   """
   Helper function that returns the dictionary of boxes that are in the tile specified by
   col_start..col_end (the x range) and row_start..row_end (the y range). 
 
   Requires: 
-  `label_coords` are in pixels not in lat,lon \n
+  `label_coords` is a LabelStore in pixels not in lat,lon \n
   `tile_range` is a list in the format `[col_start, col_end, row_start, row_end]`\n
+  `label_index` (optional) is a `LabelIndex` built over `label_coords`. When tiling
+  a whole area, build it once and pass it in so that only nearby labels are checked.\n
 
   Returns:
   {building: 
@@ -316,54 +687,159 @@ def boxes_in_tile(label_coords, tile_range):
   of the labels inside given tile range, with coords of label_nodes converted relative to tile.
   """
   col_start, col_end, row_start, row_end = tile_range
+  if label_index is None:
+    label_index = LabelIndex(label_coords, max(col_end - col_start, row_end - row_start, 1))
 
   # Output buildings that are in the tile
-  labels_in_tile = {super_class: {} for super_class in label_coords}
-
-  for super_class, sub_class_labels in label_coords.items():
-    for sub_class, labels in sub_class_labels.items():
-      labels_in_tile[super_class][sub_class] = []
+  labels_in_tile = {super_class: {sub_class: [] for sub_class in sub_classes}
+                    for super_class, sub_classes in label_coords.classes.items()}
 
-      for label in labels:
-        label = np.array(label)
+  # Only labels with extents overlapping the tile can have nodes inside it.
+  for i in label_index.query(tile_range):
+    super_class, sub_class = label_coords.class_names(i)
+    label = np.array(label_coords.way(i))
 
-        # Check for label (x,y) coordinates that fall inside tile
-        x_in_tile = (col_start <= label[:, 0]) & (label[:, 0] < col_end)
-        y_in_tile = (row_start <= label[:, 1]) & (label[:, 1] < row_end)
+    # Check for label (x,y) coordinates that fall inside tile
+    x_in_tile = (col_start <= label[:, 0]) & (label[:, 0] < col_end)
+    y_in_tile = (row_start <= label[:, 1]) & (label[:, 1] < row_end)
 
-        # Only add label to tile if it has nodes that lie inside the tile
-        if (x_in_tile & y_in_tile).any():
+    # Only add label to tile if it has nodes that lie inside the tile
+    if (x_in_tile & y_in_tile).any():
 
-          if super_class == "highway":
-            # Only keep nodes of road that fully lie in the tile.
-            label = label[x_in_tile & y_in_tile]
-          else:
-            # Clip the out of bounds x,y coordinates of buildings to tile edge
-            label[:, 0] = np.clip(label[:, 0], col_start, col_end) 
-            label[:, 1] = np.clip(label[:, 1], row_start, row_end)
+      if super_class == "highway":
+        # Only keep nodes of road that fully lie in the tile.
+        label = label[x_in_tile & y_in_tile]
+      else:
+        # Clip the out of bounds x,y coordinates of buildings to tile edge
+        label[:, 0] = np.clip(label[:, 0], col_start, col_end) 
+        label[:, 1] = np.clip(label[:, 1], row_start, row_end)
 
-          # Convert coords relative to entire image to coords relative to tile
-          label[:, 0] = label[:, 0] - col_start
-          label[:, 1] = label[:, 1] - row_start
+      # Convert coords relative to entire image to coords relative to tile
+      label[:, 0] = label[:, 0] - col_start
+      label[:, 1] = label[:, 1] - row_start
 
-          # Flatten the label to a list and append
-          labels_in_tile[super_class][sub_class].append(label.tolist())
+      # Flatten the label to a list and append
+      labels_in_tile[super_class][sub_class].append(label.tolist())
 
   return labels_in_tile
 
       
-def tile_image(label_coords, im_arr, im_size, data_info):
+def tile_row(label_coords, label_index, im_arr, row_start, index, data_info, skip=(), 
+             keep=None):
+  """
+  Tiles the row of tiles starting at pixel row [row_start] of [im_arr], and saves 
+  them (with their bounding boxes) from left to right as [index], [index+1], ...
+  Tiles whose index is in [skip] (already written by an earlier run) aren't saved again.
+  If given, [keep] is a boolean array over the tiles of the row, and only the kept 
+  tiles are saved (and given indices).
+
+  Requires: 
+  [label_coords] is a LabelStore where each node is (pixel_x, pixel_y)
+  [label_index] is a LabelIndex built over [label_coords]
+  [im_arr] is a numpy array (or memmap) of the entire queried image
+
+  Returns:
+  The list of Manifest records of the written tiles.
+  """
+  tile_size = data_info.tile_size
+  step = tile_size-data_info.overlap
+  width = im_arr.shape[1]
+  coords = data_info.coords
+
+  records = []
+  row_end = row_start+tile_size
+  for col, col_start in enumerate(range(0, width-step, step)):
+    if keep is not None and not keep[col]:
+      continue
+    if index in skip:
+      index += 1
+      continue
+
+    # row_start,row_end, col_start, col_end in pixels relative to entire img
+    col_end = col_start+tile_size
+    tile = im_arr[row_start:row_end, col_start:col_end, :]
+
+    # All the building bounding boxes in the tile range
+    tile_range = [col_start, col_end, row_start, row_end]
+    labels_in_tile = boxes_in_tile(label_coords, tile_range, label_index)
+    bounds = pixel_bounds(coords, im_arr.shape, tile_range) if coords else None
+    records.append(save_tile_and_bboxes(tile, labels_in_tile, index, data_info, bounds,
+                                        tile_range))
+    
+    index += 1
+  return records
+
+
+def catalog_row(record):
+  """
+  Helper function only. Returns the TileCatalog row of a tile's Manifest record.
+  """
+  index = record['index']
+  return dict(record, image_file=record.get('image_file', f'{index}.jpg'),
+              annotation_file=record.get('annotation_file', f'{index}.json'),
+              sha256=record['image']['sha256'])
+
+
+# Per-process state of a tiling worker: the shared (memory-mapped) image and labels.
+_tile_worker = {}
+
+def _init_tile_worker(im_spec, labels_path, data_info):
+  """
+  Helper function only.
+  Initialises a tiling worker process by memory-mapping the entire image and the
+  labels, and building the label index once for all rows the worker tiles.
+  """
+  filename, dtype, offset, shape = im_spec
+  label_coords = LabelStore.load(labels_path)
+  _tile_worker.update(
+    im_arr=np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape),
+    label_coords=label_coords,
+    label_index=LabelIndex(label_coords, data_info.tile_size),
+    data_info=data_info
+  )
+
+
+def _tile_row_worker(task):
+  """
+  Helper function only. Tiles one row of tiles in a worker process.
+  """
+  row_start, index, skip, keep = task
+  return tile_row(_tile_worker['label_coords'], _tile_worker['label_index'], 
+                  _tile_worker['im_arr'], row_start, index, _tile_worker['data_info'], 
+                  skip, keep)
+
+
+def shared_image_spec(im_arr, raw_data_path):
+  """
+  Returns (filename, dtype, offset, shape) with which worker processes can 
+  memory-map [im_arr]. If [im_arr] isn't already a memmap, it is first written 
+  to `raw_data/Entire_Area.npy`.
+  """
+  if not isinstance(im_arr, np.memmap) or im_arr.filename is None:
+    path = os.path.join(raw_data_path, 'Entire_Area.npy')
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=im_arr.dtype, shape=im_arr.shape)
+    out[:] = im_arr
+    out.flush()
+    im_arr = out
+  return (im_arr.filename, im_arr.dtype.str, im_arr.offset, im_arr.shape)
+
+      
+def tile_image(label_coords, im_arr, im_size, data_info, manifest=None):
   """
   Tiles image array [im_arr] and saves tiles of size [tile_size x tile_size] 
-  and corresponding bounding boxes in [DATA_PATH] as individual .jpeg and .json files
+  and corresponding bounding boxes in [DATA_PATH] as individual .jpeg and .json files.
+  If [data_info.workers] > 1, rows of tiles are tiled and encoded in parallel by a
+  pool of processes that memory-map [im_arr] and [label_coords]. Tile indices don't
+  depend on the number of workers, so the output is the same as a serial run.
+  If a [manifest] is given, tiles it records as already written (and unchanged) are 
+  skipped, and newly written tiles are recorded in it.
+  Every tile is also recorded in the TileCatalog of [data_info.ds].
+  If [data_info.tile_filter] is set, the tiles it rejects are never encoded or saved,
+  and the kept tiles are indexed consecutively in the same (row by row) order.
 
   Requires: 
   [tile_size] is a positive integer
-  [label_coords] is 
-    {building: 
-      building_class1: [label_nodes_1, ...], ...
-     roads: ...} 
-    where each label_nodes_i = [label_node1, ...] and label_node is (pixel_x, pixel_y)
+  [label_coords] is a LabelStore where each node is (pixel_x, pixel_y)
   [im_arr] is a numpy array of the entire queried image
   [im_size] is the shape of the numpy array
   """
@@ -373,19 +849,131 @@ def tile_image(label_coords, im_arr, im_size, data_info):
   height, width, _ = im_size
   # total_rows, total_cols = height//step, width//step
 
-  index = 0
-  for row_start in range(0, height-step, step):
-    for col_start in range(0, width-step, step):
-      # row_start,row_end, col_start, col_end in pixels relative to entire img
-      row_end, col_end = row_start+tile_size, col_start+tile_size
-      tile = im_arr[row_start:row_end, col_start:col_end, :]
-
-      # All the building bounding boxes in the tile range
-      tile_range = [col_start, col_end, row_start, row_end]
-      labels_in_tile = boxes_in_tile(label_coords, tile_range)
-      save_tile_and_bboxes(tile, labels_in_tile, index, data_info)
-      
-      index += 1
+  # Each row of tiles starts at index row_number * total_cols.
+  row_starts = range(0, height-step, step)
+  col_starts = range(0, width-step, step)
+
+  # Decide which tiles to keep for the whole grid at once, before encoding any of them.
+  tile_filter = data_info.tile_filter
+  if tile_filter:
+    keep = tile_filter.keep_grid(im_arr, label_coords, row_starts, col_starts, tile_size)
+    print(f"Keeping {keep.sum()} of {keep.size} tiles after filtering.")
+  else:
+    keep = np.ones((len(row_starts), len(col_starts)), dtype=bool)
+
+  # Each row of tiles starts at the index of the number of tiles kept in earlier rows.
+  row_indices = np.concatenate([[0], np.cumsum(keep.sum(axis=1))]).tolist()
+
+  # Skip the rows of tiles that were all written by an earlier run.
+  ds = data_info.ds
+  valid = manifest.valid_tile_records(ds, row_indices[-1]) if manifest else {}
+  done = set(valid)
+  if done:
+    print(f"{len(done)} tiles already written, skipping them.")
+    uncataloged = sorted(done - ds.catalog.indices())
+    if uncataloged:
+      ds.catalog_tiles([catalog_row(valid[index]) for index in uncataloged])
+  tasks = []
+  for row, row_start in enumerate(row_starts):
+    index, row_end_index = row_indices[row], row_indices[row + 1]
+    skip = frozenset(done.intersection(range(index, row_end_index)))
+    if len(skip) < row_end_index - index:
+      tasks.append((row_start, index, skip, None if tile_filter is None else keep[row]))
+
+  def record_tiles(records):
+    if manifest:
+      manifest.record_tiles(records)
+    if records:
+      ds.catalog_tiles([catalog_row(record) for record in records])
+
+  workers = data_info.workers
+  if workers <= 1 or not tasks:
+    # Bucket the labels by grid cell once, instead of scanning all of them per tile.
+    label_index = LabelIndex(label_coords, tile_size)
+    for row_start, index, skip, row_keep in tasks:
+      record_tiles(tile_row(label_coords, label_index, im_arr, row_start, index, data_info, 
+                            skip, row_keep))
+    ds.catalog.truncate(row_indices[-1])
+    return
+
+  # Share the image and labels with the workers through memory-mapped files.
+  im_spec = shared_image_spec(im_arr, data_info.ds.raw_data_path)
+  labels_path = label_coords.path
+  if labels_path is None:
+    labels_path = os.path.join(data_info.ds.raw_data_path, 'annotations.npz')
+    label_coords.save(labels_path)
+
+  initargs = (im_spec, labels_path, data_info)
+  with multiprocessing.Pool(workers, initializer=_init_tile_worker, initargs=initargs) as pool:
+    for records in pool.imap_unordered(_tile_row_worker, tasks):
+      record_tiles(records)
+
+  # Forget tiles of an earlier run beyond the last tile.
+  ds.catalog.truncate(row_indices[-1])
+
+
+def tile_pyramid(label_coords, im_arr, data_info, manifest):
+  """
+  Builds the coarser levels of the dataset, downsampled by each factor in 
+  [data_info.pyramid], as their own Datasets in `data_path/pyramid/[factor]x`.
+  The entire image is read once to downsample it for all levels, and the labels are
+  rescaled for each level. Each level is then tiled like the full resolution dataset
+  (same tile size, overlap and filter), and the levels are listed in the shared
+  catalog `data_path/pyramid.json` (see `Pyramid.py`).
+
+  Requires:
+  [label_coords] is a LabelStore where each node is (pixel_x, pixel_y)
+  [im_arr] is a numpy array (or memmap) of the entire queried image
+  [manifest] is the Manifest of the full resolution dataset (with its stages done)
+  """
+  data_path = data_info.ds.data_path
+  tile_filter = data_info.tile_filter
+  levels = [{'factor': 1, 'shape': list(im_arr.shape), 'tiles': len(data_info.ds)}]
+
+  # Each level is a DataInfo (and Dataset) of its own, with its own manifest.
+  level_infos, level_manifests, level_keys = {}, {}, {}
+  for factor in data_info.pyramid:
+    level_info = copy.copy(data_info)
+    level_info.ds = Dataset(Pyramid.level_path(data_path, factor), 
+                            classes_path=data_info.classes_path)
+    level_infos[factor] = level_info
+    level_manifests[factor] = Manifest(level_info.ds.raw_data_path)
+    if data_info.restart:
+      level_manifests[factor].reset()
+    level_keys[factor] = Manifest.key(manifest.output_hash('raster'), 
+                                      manifest.output_hash('projected'), factor)
+
+  # Downsample the image for all levels that aren't done yet in a single read.
+  todo = [factor for factor in data_info.pyramid 
+          if not level_manifests[factor].is_done('level', level_keys[factor])]
+  area_paths = {factor: os.path.join(level_infos[factor].ds.raw_data_path, 'Entire_Area.npy')
+                for factor in data_info.pyramid}
+  if todo:
+    Pyramid.downsample_area(im_arr, todo, [area_paths[factor] for factor in todo])
+
+  for factor in data_info.pyramid:
+    level_info, level_manifest = level_infos[factor], level_manifests[factor]
+    labels_path = os.path.join(level_info.ds.raw_data_path, 'annotations.npz')
+    if factor in todo:
+      Pyramid.scale_labels(label_coords, factor).save(labels_path)
+      level_manifest.complete('level', level_keys[factor], area_paths[factor], labels_path)
+    level_arr = np.load(area_paths[factor], mmap_mode='r')
+    level_labels = LabelStore.load(labels_path)
+    if data_info.coords:
+      level_info.coords = Pyramid.level_coords(data_info.coords, im_arr.shape, factor)
+
+    print(f"Tiling level downsampled by {factor}x into {level_info.ds.data_path}")
+    level_manifest.start_tiles(Manifest.key(level_manifest.output_hash('level'),
+                                            data_info.tile_size, data_info.overlap,
+                                            tile_filter.config() if tile_filter else None,
+                                            data_info.image_encoder.config(),
+                                            data_info.label_encoder.config()))
+    tile_image(level_labels, level_arr, level_arr.shape, level_info, manifest=level_manifest)
+    level_manifest.complete_tiles()
+    levels.append({'factor': factor, 'shape': list(level_arr.shape), 
+                   'tiles': len(level_info.ds)})
+
+  Pyramid.write_catalog(data_path, data_info.tile_size, data_info.overlap, levels)
 
 
 def passed_arguments():
@@ -411,6 +999,71 @@ def passed_arguments():
                       type=str, 
                       default=os.path.join(".", "classes.json"),
                       help="Path to json file determining OSM classes. Should not be changed.")
+  parser.add_argument("-w", "--workers", 
+                      type=int, 
+                      default=1,
+                      help="Number of worker processes used to tile and encode the image.")
+  parser.add_argument("--streaming", 
+                      action="store_true",
+                      default=False,
+                      help="Clean the entire image in row blocks into an on-disk" +\
+                           " raw_data/Entire_Area.npy memmap instead of in memory.")
+  parser.add_argument("--no_osm_cache", 
+                      action="store_true",
+                      default=False,
+                      help="Always query OpenStreetMap instead of reusing cached results.")
+  parser.add_argument("--osm_cache_dir", 
+                      type=str, 
+                      default=None,
+                      help="Directory of the OpenStreetMap query cache" +\
+                           " (default: $AIR_OSM_CACHE or ~/.cache/AIR-Project/osm).")
+  parser.add_argument("--osm_grid", 
+                      type=int, 
+                      default=1,
+                      help="Split the OpenStreetMap query into an n x n grid of sub boxes.")
+  parser.add_argument("--osm_workers", 
+                      type=int, 
+                      default=4,
+                      help="Maximum number of concurrent OpenStreetMap requests.")
+  parser.add_argument("--osm_rpm", 
+                      type=int, 
+                      default=30,
+                      help="Maximum number of OpenStreetMap requests started per minute.")
+  parser.add_argument("--restart", 
+                      action="store_true",
+                      default=False,
+                      help="Rebuild the dataset from scratch instead of resuming the stages" +\
+                           " recorded in raw_data/manifest.json.")
+  parser.add_argument("--max_nodata", 
+                      type=float, 
+                      default=None,
+                      help="Skip tiles with a larger fraction of nodata pixels (eg: 0.5).")
+  parser.add_argument("--min_labels", 
+                      nargs="+",
+                      type=str, 
+                      default=None,
+                      help="Skip tiles with fewer labels of a class, as class=count" +\
+                           " (eg: building=1 or building/hospital=1).")
+  parser.add_argument("--min_entropy", 
+                      type=float, 
+                      default=None,
+                      help="Skip tiles whose grayscale entropy (in bits) is lower (eg: 1.0).")
+  parser.add_argument("--pyramid", 
+                      nargs="+",
+                      type=int, 
+                      default=None,
+                      help="Also build coarser levels of the dataset downsampled by these" +\
+                           " factors (eg: 2 4), in data_path/pyramid/[factor]x.")
+  parser.add_argument("--image_encoder", 
+                      type=str, 
+                      default="jpeg",
+                      help="Format of the tile images, with options" +\
+                           " (eg: jpeg:quality=90,subsampling=0, png:compress_level=1," +\
+                           " webp:lossless=true or npy).")
+  parser.add_argument("--label_encoder", 
+                      type=str, 
+                      default="json",
+                      help="Format of the tile labels: json, compact (json) or binary.")
   args = parser.parse_args()
   return args
 
@@ -421,8 +1074,21 @@ if __name__ == "__main__":
     args.tile_size,
     args.overlap,
     args.query_path,
-    args.classes
+    args.classes,
+    workers=args.workers,
+    streaming=args.streaming,
+    osm_cache=not args.no_osm_cache,
+    osm_cache_dir=args.osm_cache_dir,
+    osm_grid=args.osm_grid,
+    osm_workers=args.osm_workers,
+    osm_rpm=args.osm_rpm,
+    restart=args.restart,
+    tile_filter=TileFilter.from_args(args.max_nodata, args.min_labels, args.min_entropy),
+    pyramid=args.pyramid,
+    image_encoder=TileEncoder.image_encoder(args.image_encoder),
+    label_encoder=TileEncoder.label_encoder(args.label_encoder)
   )
 
   # For now only IBM.
-  create_dataset(data_info, source="IBM")     
+  if not create_dataset(data_info, source="IBM"):
+    sys.exit(1)     
@@ -1,12 +1,22 @@
 import os
 import re
 import json
+import hashlib
 import pickle
+import bisect
+import functools
 import random
 import argparse
 import numpy as np
 from PIL import Image
 from shutil import copyfile
+from LabelStore import LabelStore
+from TileCatalog import TileCatalog, CATALOG_FILENAME
+from DerivedStore import DerivedStore
+from Manifest import Manifest
+from BatchPrefetcher import prefetch_batches
+from SampleCache import SampleCache
+import TileEncoder
 
 # Visualising
 import matplotlib.pyplot as plt
@@ -27,6 +37,11 @@ class Dataset:
   2) The dictionary of classes defined for the dataset.\n
   3) A sorted list of image file names\n
   4) A sorted list of annotation/ building label file names\n
+  5) The TileCatalog of the tiles (`data_path/catalog.db`), from which the lists 3) and 4)
+     are read instead of listing the directories, once it exists.\n
+  6) A sorted list of the tile indices (the numbers in the file names) of the tiles,
+     which only differ from the dataset indices after tiles are removed.\n
+  7) An optional SampleCache of decoded tiles and labels (see `enable_cache`).\n
 
   Static methods (invariant of object):\n
   1) Copy over data from already created datasets into a combined dataset\n
@@ -35,13 +50,15 @@ class Dataset:
   1) Getting the length of the dataset (the number of images/ image file names)\n
   2) Getting the size of each image in the dataset (assumed to be the same for all images).\n
   3) Getting an image and its associated building labels given an index.\n
-  4) Getting a batch of images and assoicated building labels given a start index and batch size.\n
+  4) Getting a batch of images and assoicated building labels given a start index and batch size,
+     or iterating over batches of given indices loaded in the background.\n
   5) Removing a set of images and assoicated building labels given a set of indices.\n
   6) Visualizing a single image in images_path with its assoicated building labels.\n
   7) Visualizing a sequence of tiles (images) in images_path with associated building labels, given
      a start and end index.\n
   8) Visualizing the entire area with all bounding boxes (assuming such an image exists in the
       raw_data directory of the data_path).\n
+  9) Finding the tiles intersecting a geographic bounding box (using the TileCatalog).\n
   """
 
   def __init__(self, data_path, classes_path='classes.json'):
@@ -61,10 +78,14 @@ class Dataset:
     with open(classes_path, 'r') as f:
       self.classes = json.load(f)
       
-    # Attributes 3), 4)
-    key = Dataset.sort_key
-    self.img_list = Dataset.file_names(self.images_path, '.jpg','.jpeg', key=key)
-    self.annotation_list = Dataset.file_names(self.annotations_path, '.json', key=key)
+    # Attribute 5)
+    self.catalog = TileCatalog(os.path.join(data_path, CATALOG_FILENAME))
+
+    # Attributes 3), 4), 6)
+    self.tile_indices, self.img_list, self.annotation_list = self.list_files()
+
+    # Attribute 7)
+    self.cache = None
   
   @staticmethod
   def _create_dirs(*dirs):
@@ -110,15 +131,50 @@ class Dataset:
     d = re.search('[0-9]+', file_name)
     return int(file_name[d.start():d.end()]) if d else file_name
   
+  def list_files(self):
+    """
+    Helper method only.
+    Returns the sorted lists of tile indices, image and annotation file names of the
+    tiles that aren't removed, from the TileCatalog if the dataset has one, otherwise
+    by listing the images and annotations directories.
+    """
+    if self.catalog.exists():
+      files = self.catalog.files()
+      return ([index for index, _, _ in files], [img for _, img, _ in files],
+              [ann for _, _, ann in files])
+
+    key = Dataset.sort_key
+    img_list = Dataset.file_names(self.images_path, *TileEncoder.IMAGE_EXTS, key=key)
+    annotation_list = Dataset.file_names(self.annotations_path, *TileEncoder.LABEL_EXTS, key=key)
+    return Dataset.file_indices(img_list), img_list, annotation_list
+
+  @staticmethod
+  def file_indices(file_names):
+    """
+    Helper method only.
+    Returns the tile indices of sorted tile [file_names]: the numbers they are named by,
+    or their positions if they aren't all uniquely named by numbers.
+    """
+    indices = [Dataset.sort_key(f) for f in file_names]
+    if all(isinstance(i, int) for i in indices) and len(set(indices)) == len(indices):
+      return indices
+    return list(range(len(file_names)))
+
+  def next_tile_index(self):
+    """
+    Returns the tile index after the last one ever used, at which new tiles can be
+    added without overwriting any tile (even removed ones).
+    """
+    indices = self.catalog.indices() or self.list_files()[0]
+    return max(indices) + 1 if indices else 0
+
   def __len__(self):
     """
     Method 1)
-    Updates the img_list and annotation_list attributes and returns the number
-    of images in the dataset.
+    Updates the tile_indices, img_list and annotation_list attributes and returns the
+    number of images in the dataset.
     """
-    key = Dataset.sort_key
-    self.img_list = Dataset.file_names(self.images_path, '.jpg', '.jpeg', key=key)
-    self.annotation_list = Dataset.file_names(self.annotations_path, '.json', key=key)
+    self.tile_indices, self.img_list, self.annotation_list = self.list_files()
     return len(self.img_list)
 
   def get_img_size(self):
@@ -132,8 +188,7 @@ class Dataset:
       print(f"Warning! Your {self.images_path} directory is currently empty.")
       return None
     # Gets first image in dataset
-    im = Image.open(os.path.join(self.images_path, self.img_list[0]))
-    return np.array(im).shape
+    return TileEncoder.read_image(os.path.join(self.images_path, self.img_list[0])).shape
 
   
   def get_tile_and_label(self, index):
@@ -144,19 +199,32 @@ class Dataset:
     Returns:
     (tile_array, dictionary_of_buildings)
     """
+    if self.cache is None:
+      return self.read_tile_and_label(index)
+
+    # Labels are cached in the binary label format, which decodes to the same dictionary.
+    encoder = TileEncoder.BinaryLabelEncoder()
+    def load():
+      im_arr, buildings_in_tile = self.read_tile_and_label(index)
+      return im_arr, np.frombuffer(encoder.encode(buildings_in_tile), dtype=np.uint8)
 
-    # Open the jpeg image and save as numpy array
-    im = Image.open(os.path.join(self.images_path, self.img_list[index]))
-    im_arr = np.array(im)
+    key = ('tile', self.images_path, self.img_list[index])
+    im_arr, labels = self.cache.get_or_load(key, load)
+    return (im_arr, encoder.decode(labels.tobytes()))
 
-    # Open the json file and parse into dictionary of index -> buildings pairs
-    buildings_in_tile = {}
+  def read_tile_and_label(self, index):
+    """
+    Helper method only. Reads and decodes the tile and label files of data index.
+    """
+    # Open the image (jpeg by default) as numpy array
+    im_arr = TileEncoder.read_image(os.path.join(self.images_path, self.img_list[index]))
+
+    # Open the label file (json by default) and parse into dictionary of index -> buildings pairs
     ann_path = os.path.join(self.annotations_path, self.annotation_list[index])
-    with open(ann_path, 'r') as filename:
-      try: 
-        buildings_in_tile = json.load(filename)
-      except ValueError:
-        buildings_in_tile = {}
+    try: 
+      buildings_in_tile = TileEncoder.read_labels(ann_path)
+    except ValueError:
+      buildings_in_tile = {}
     
     return (im_arr, buildings_in_tile)
     
@@ -175,60 +243,119 @@ class Dataset:
     
     return batch
 
-  def remove_tiles(self, indices_to_remove):
+  def enable_cache(self, max_bytes, spill_path=None, spill_bytes=0, cache=None):
     """
-    Method 5)
-    Removes the tiles associated with the indices in indices_to_remove, and renames all files
-    in self.images_path and self.annotations.path (as appropriate)
+    Caches up to [max_bytes] bytes of decoded tiles and labels in memory (evicting the
+    least recently used ones), so that reading a tile again (eg: in the next epoch)
+    doesn't decode its files again. Evicted tiles spill to a memory-mapped file of
+    [spill_bytes] at [spill_path] if given. An existing SampleCache [cache] (eg: shared
+    by several datasets) is used instead if given.
+    Returns:
+      The SampleCache, whose `stats()` report its hit rate and the bytes it holds.
+    """
+    self.cache = cache if cache is not None else SampleCache(max_bytes, spill_path, spill_bytes)
+    return self.cache
 
-    Requires: indices_to_remove is a set
+  def load_batch(self, indices):
+    """
+    Helper method only. Gets the tiles and labels of the list of [indices], the batches
+    of `iter_batches`.
     """
+    return [self.get_tile_and_label(i) for i in indices]
 
-    # file_index keeps track of the correct index for the images in the directory 
-    file_index = 0
-    for i in range(len(self)):
-      img_path = os.path.join(self.images_path, f'{i}.jpg')
-      ann_path = os.path.join(self.annotations_path, f'{i}.json')
+  def iter_batches(self, indices, batch_size, workers=4, prefetch=2, processes=False,
+                   drop_last=False, **kwargs):
+    """
+    Method 4)
+    Iterates over the batches of [batch_size] of [indices], in order, while the next
+    ones are read and decoded by [workers] threads (or processes) in the background,
+    keeping [prefetch] batches ready ahead (see `BatchPrefetcher.prefetch_batches`).
+    Keyword arguments [kwargs] are passed on to `load_batch`.
 
-      # Check if index is to be removed
-      if i in indices_to_remove:
-        os.remove(img_path)
-        os.remove(ann_path)
-      else:
+    Returns:
+    A generator of batches, in the format of `load_batch`
+    """
+    load_batch = functools.partial(self.load_batch, **kwargs) if kwargs else self.load_batch
+    return prefetch_batches(load_batch, indices, batch_size, workers=workers, prefetch=prefetch,
+                            processes=processes, drop_last=drop_last)
 
-        # If not to be removed, then check if index of file is in line with new file_index
-        if i != file_index:
-          new_img_path = os.path.join(self.images_path, f'{file_index}.jpg')
-          os.rename(img_path, new_img_path)
+  def remove_tiles(self, indices_to_remove):
+    """
+    Method 5)
+    Removes the tiles associated with the indices in indices_to_remove. The tiles are
+    marked as removed in the TileCatalog (created first if needed) before their files
+    are deleted, and the remaining tiles keep their file names, so removing k tiles
+    costs O(k) file operations. The remaining tiles are still indexed consecutively in
+    the same order, and `compact` renumbers their files to match.
 
-          new_ann_path = os.path.join(self.annotations_path, f'{file_index}.json')
-          os.rename(ann_path, new_ann_path)
-        
-        file_index += 1
+    Requires: indices_to_remove is a set
+    """
+    if not self.catalog.exists():
+      self.rebuild_catalog()
+
+    # Refresh attributes 3), 4), 6) by calling len(self)
+    num_tiles = len(self)
+    removed = [i for i in sorted(indices_to_remove) if 0 <= i < num_tiles]
+    self.catalog.remove([self.tile_indices[i] for i in removed])
+    for i in removed:
+      for path in [os.path.join(self.images_path, self.img_list[i]),
+                   os.path.join(self.annotations_path, self.annotation_list[i])]:
+        if os.path.exists(path):
+          os.remove(path)
 
     # Update attributes 4) by calling len(self)
     print(f"New length of dataset: {len(self)}")
 
+  def compact(self):
+    """
+    Renumbers the files of the tiles consecutively (tile indices equal to dataset
+    indices again) after tiles were removed, and forgets the removed tiles. The files
+    are renamed before the catalog is updated, so if this is interrupted, calling it
+    again finishes it.
+    Returns:
+    The number of renumbered tiles.
+    """
+    if not self.catalog.exists():
+      return 0
+
+    renamed = self.catalog.renumbering()
+    # Derived files (eg: masks) are named by tile index, so they are derived again.
+    if renamed:
+      DerivedStore.clear_all(self.data_path)
+
+    # Files of removed tiles left by an interrupted `remove_tiles` (unless tiles are
+    # renamed to them, which replaces them).
+    targets = {r[4] for r in renamed} | {r[5] for r in renamed}
+    for _, img_name, ann_name in self.catalog.removed_files():
+      for path, name in [(self.images_path, img_name), (self.annotations_path, ann_name)]:
+        if name not in targets and os.path.exists(os.path.join(path, name)):
+          os.remove(os.path.join(path, name))
+
+    for path, names in [(self.images_path, [(r[2], r[4]) for r in renamed]),
+                        (self.annotations_path, [(r[3], r[5]) for r in renamed])]:
+      # Files are renamed in order to lower indices, so an interrupted earlier call
+      # stopped right after the last file that is gone (later files all still exist).
+      done = max((i for i, (old, _) in enumerate(names)
+                  if not os.path.exists(os.path.join(path, old))), default=-1)
+      for old, new in names[done + 1:]:
+        os.replace(os.path.join(path, old), os.path.join(path, new))
+
+    self.catalog.compact()
+    len(self)
+    if self.cache is not None:
+      self.cache.clear()
+    return len(renamed)
+
   def visualize_tile(self, index):
     """
     Method 6)
     Provides a visualization of the tile with the tile and its corresponding annotation/ label. 
     """
-    im = Image.open(os.path.join(self.images_path, self.img_list[index]))
-    im_arr = np.array(im)
+    im_arr, labels_in_tile = self.get_tile_and_label(index)
     mng = plt.get_current_fig_manager()
     # mng.window.state('zoomed')
     plt.imshow(im_arr)
 
-    # Open the json file and parse into dictionary of index -> buildings pairs
-    labels_in_tile = {}
-    ann_path = os.path.join(self.annotations_path, self.annotation_list[index])
-    with open(ann_path, 'r') as filename:
-      try: 
-        labels_in_tile = json.load(filename)
-      except ValueError:
-        labels_in_tile = {}
-
     for super_class, sub_class_labels in labels_in_tile.items():
       for sub_class, labels in sub_class_labels.items():
         sub_class_colour = list(np.random.choice(range(256), size=3)/256)
@@ -257,7 +384,7 @@ class Dataset:
       self.visualize_tile(i)
     
 
-  def visualize_dataset(self):
+  def visualize_dataset(self, out_path=None, window=None, max_size=2048):
     """
     Method 8)
     Provides visualization of entire dataset image area, 
@@ -266,66 +393,211 @@ class Dataset:
     This uses the data stored in the RAW_DATA_PATH.
     Requires:
     The entire image area with OSM data to be stored in a directory called raw_data.
-    The OSM data should be in a pickle file, and the entire image area should be in 
-    a jpeg file.
+    The OSM data should be in an `annotations.npz` LabelStore file (or a legacy
+    `annotations.pkl` file), and the entire image area should be in a jpeg file
+    (or an `Entire_Area.npy` file).
+
+    The area is shown downsampled to at most [max_size] pixels per side, and rendered
+    again at a finer resolution when zooming in (see `AreaRenderer`). Only the
+    [col_start, col_end, row_start, row_end] [window] is shown if given, and the
+    visualization is written to the PNG [out_path] instead of shown if given.
     """
-    label_coords = {}
-    # Open pickle file with osm data
-    osm_data_path = os.path.join(self.data_path, 'raw_data', 'annotations.pkl')
-    with open(osm_data_path, "rb") as filename:
-      label_coords = pickle.load(filename)
+    # Locally imports AreaRenderer, which imports Pyramid (which imports Dataset).
+    from AreaRenderer import AreaRenderer
+    renderer = AreaRenderer(self)
+    if out_path:
+      renderer.save(out_path, window=window, max_size=max_size)
+    else:
+      renderer.show(window=window, max_size=max_size)
+  
 
-    im = Image.open(os.path.join(self.data_path, 'raw_data', 'Entire_Area.jpg'))
-    im_arr = np.array(im)
+  def catalog_tiles(self, rows):
+    """
+    Adds the rows of newly written tiles (see TileCatalog) to the catalog. The first
+    time, the catalog is created with the tiles already in the directories (eg: of a
+    dataset written before catalogs existed), so that none of them go missing.
+    """
+    if not self.catalog.exists():
+      self.rebuild_catalog()
+    self.catalog.add_tiles(rows)
 
-    plt.imshow(im_arr)
-    for super_class, sub_class_labels in label_coords.items():
-      for sub_class, labels in sub_class_labels.items():
-        sub_class_colour = list(np.random.choice(range(256), size=3)/256)
-        if super_class == 'building':
-          for label in labels:
-            poly = Polygon(label)
-            x, y = poly.exterior.xy
-            plt.plot(x, y, c=sub_class_colour)
-        elif super_class == 'highway':
-          lines = mc.LineCollection(labels, colors=sub_class_colour)
-          plt.gca().add_collection(lines)
-    
-    # # Add the grid
-    # ax.grid(which='major', axis='both', linestyle='-')
-    # ax.show()
-    plt.grid()
-    # plt.xticks(np.arange(0, 6000, 228), range(0, 23))
-    # plt.yticks(np.arange(0, 6000, 228), range(0, 23))
-    plt.show()
-  
+  def rebuild_catalog(self, full=False):
+    """
+    (Re)builds the catalog from the files in the images and annotations directories,
+    keeping the split, source and bounds of tiles already in the catalog. Tiles are
+    indexed by the numbers in their file names, and tiles whose files no longer exist
+    are forgotten. If [full], the hashes and label counts of all tiles are computed
+    too (reading every tile).
+    Returns:
+    The number of tiles in the catalog.
+    """
+    # Only tiles with both an image and an annotation (eg: not one cut short by a crash).
+    key = Dataset.sort_key
+    annotations = {os.path.splitext(f)[0]: f
+                   for f in Dataset.file_names(self.annotations_path, *TileEncoder.LABEL_EXTS)}
+    img_list, annotation_list = [], []
+    for img_name in Dataset.file_names(self.images_path, *TileEncoder.IMAGE_EXTS, key=key):
+      ann_name = annotations.get(os.path.splitext(img_name)[0])
+      if ann_name:
+        img_list.append(img_name)
+        annotation_list.append(ann_name)
+
+    known = {(row['image_file'], row['annotation_file']): row
+             for row in self.catalog.rows(self.catalog.indices())}
+    rows = []
+    for i, img_name, ann_name in zip(Dataset.file_indices(img_list), img_list, annotation_list):
+      row = dict(known.get((img_name, ann_name), {}), index=i, image_file=img_name,
+                 annotation_file=ann_name)
+      if full:
+        ann_path = os.path.join(self.annotations_path, ann_name)
+        try:
+          row['labels'] = TileCatalog.count_labels(TileEncoder.read_labels(ann_path))
+        except ValueError:
+          row['labels'] = {}
+        row['sha256'] = Manifest.hash_file(os.path.join(self.images_path, img_name))
+      rows.append(row)
+
+    self.catalog.forget(self.catalog.indices() - {row['index'] for row in rows})
+    self.catalog.add_tiles(rows)
+    return len(rows)
+
+  @staticmethod
+  def split_key(tile_index, seed=0):
+    """
+    Returns the number in [0, 1) that tile [tile_index] (its index in the catalog) is
+    assigned to a split by, from the hash of the tile index and [seed]: it doesn't
+    depend on the other tiles or the order they are processed in.
+    """
+    digest = hashlib.sha256(f"{seed}:{tile_index}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2**64
+
+  @staticmethod
+  def split_of(key, train_val_test):
+    """
+    Returns the split ("train", "val" or "test") of a tile with `split_key` [key]:
+    keys are split at the [train_val_test] percentages.
+    """
+    train, val, _ = train_val_test
+    if key < train:
+      return "train"
+    return "val" if key < train + val else "test"
+
+  @staticmethod
+  def assign_splits(tile_indices, train_val_test, seed=0):
+    """
+    Assigns each of [tile_indices] to a split by its `split_key`.
+    Returns:
+      The dictionary of split -> list of its tile indices, in the order of their keys.
+    """
+    keys = {tile_index: Dataset.split_key(tile_index, seed) for tile_index in tile_indices}
+    splits = {"train": [], "val": [], "test": []}
+    for tile_index in sorted(keys, key=keys.__getitem__):
+      splits[Dataset.split_of(keys[tile_index], train_val_test)].append(tile_index)
+    return splits
+
+  def tiles_in_bbox(self, lat_min, lon_min, lat_max, lon_max):
+    """
+    Method 9)
+    Returns the sorted indices of the tiles intersecting the geographic bounding box
+    [lat_min, lon_min, lat_max, lon_max], using the R*Tree of the TileCatalog.
+    Tiles without recorded bounds (eg: indexed from an older dataset) are never returned.
+    """
+    len(self)
+    return [bisect.bisect_left(self.tile_indices, index)
+            for index in self.catalog.tiles_in_bbox(lat_min, lon_min, lat_max, lon_max)]
+
+
+  def load_entire_area(self):
+    """
+    Returns the entire area's image as a numpy array from `raw_data/Entire_Area.jpg`,
+    or as a read-only memmap of `raw_data/Entire_Area.npy` if the dataset was built 
+    out-of-core (with no jpeg).
+    """
+    jpg_path = os.path.join(self.raw_data_path, 'Entire_Area.jpg')
+    if os.path.isfile(jpg_path):
+      return np.array(Image.open(jpg_path))
+    return np.load(os.path.join(self.raw_data_path, 'Entire_Area.npy'), mmap_mode='r')
+
+
+  def load_label_store(self, name='annotations'):
+    """
+    Loads the (memory-mapped) LabelStore of the entire area's labels, in pixels,
+    from `raw_data/[name].npz`. Falls back to a legacy `raw_data/[name].pkl` file.
+    """
+    store_path = os.path.join(self.raw_data_path, f'{name}.npz')
+    if os.path.isfile(store_path):
+      return LabelStore.load(store_path)
+
+    with open(os.path.join(self.raw_data_path, f'{name}.pkl'), 'rb') as filename:
+      return LabelStore.from_dict(pickle.load(filename))
+
+
+  @staticmethod
+  def _transfer_file(src, dst, link=False):
+    """
+    Helper method only. Copies the file [src] to [dst], or hard links it if [link]
+    (falling back to copying when they are on different file systems).
+    """
+    if link:
+      if os.path.exists(dst):
+        os.remove(dst)
+      try:
+        os.link(src, dst)
+        return
+      except OSError:
+        pass
+    copyfile(src, dst)
 
   @staticmethod
-  def _combine_datasets(new_data_path, classes_path='classes.json', *data_paths):
+  def _combine_datasets(new_data_path, classes_path='classes.json', *data_paths, link=False):
     """
     Create a combined dataset from already created Datasets. \n
-    Copies over the `images` and `annotations` directories from given datasets.
+    Copies over the `images` and `annotations` directories from given datasets, and
+    catalogs the tiles with the sources, bounds and label counts of the given datasets'
+    catalogs (or the path of a dataset without a catalog as their source).
     Requires:
-      new_data_path: Path to directory where combined data will be stored.
+      new_data_path: Path to directory where combined data will be stored.\n
+      link: Hard link the files instead of copying them (falls back to copying
+            when `new_data_path` is on a different file system).\n
+    Returns:
+      The number of tiles in the combined dataset.
     """
     print("Creating directories store images, annotations...")
     new_ds = Dataset(new_data_path, classes_path=classes_path)
+    transfer = lambda src, dst: Dataset._transfer_file(src, dst, link=link)
 
     i = 0
+    rows = []
     for data_path in data_paths:
       assert os.path.isdir(data_path), f"Can't use non-existent data path: {data_path}"
       ds = Dataset(data_path, classes_path=classes_path)
       assert len(ds) > 0, "Previous dataset must have data."
-
-      # Iterate over each image, annotation, copying to new dataset
-      for img_path, ann_path in zip(ds.img_list, ds.annotation_list):
-        copyfile(os.path.join(ds.images_path, img_path), 
-                 os.path.join(new_ds.images_path, f'{i}.jpg'))
-
-        copyfile(os.path.join(ds.annotations_path, ann_path),
-                 os.path.join(new_ds.annotations_path, f'{i}.json'))
+      ds_rows = ds.catalog.rows()
+
+      # Iterate over each image, annotation, copying to new dataset (in the same format)
+      for j, (img_path, ann_path) in enumerate(zip(ds.img_list, ds.annotation_list)):
+        new_img = str(i) + os.path.splitext(img_path)[1]
+        new_ann = str(i) + os.path.splitext(ann_path)[1]
+        transfer(os.path.join(ds.images_path, img_path), os.path.join(new_ds.images_path, new_img))
+        transfer(os.path.join(ds.annotations_path, ann_path),
+                 os.path.join(new_ds.annotations_path, new_ann))
+
+        if ds_rows:
+          row = dict(ds_rows[j])
+        else:
+          row = {'source': os.path.basename(os.path.normpath(data_path))}
+        row.update(index=i, image_file=new_img, annotation_file=new_ann,
+                   split=None, split_index=None)
+        rows.append(row)
         i += 1
 
+    # The combined tiles replace whatever the new dataset had, so nothing needs indexing first.
+    new_ds.catalog.add_tiles(rows)
+    new_ds.catalog.truncate(i)
+    # Files derived from the tiles it had (named by their indices) no longer match.
+    DerivedStore.clear_all(new_data_path)
+    return i
+
 
 def passed_arguments():
   parser = argparse.ArgumentParser(description="Script to visualize labels on entire queried area.")
@@ -346,6 +618,20 @@ def passed_arguments():
                       type=str,
                       default=None,
                       help='Sequence of data_paths to combine into one new dataset.')
+  parser.add_argument('--rebuild_catalog',
+                      action='store_true',
+                      default=False,
+                      help='(Re)build the tile catalog from the images and annotations' +\
+                           ' directories, with the hashes and label counts of all tiles.')
+  parser.add_argument('--overview',
+                      type=str,
+                      default=None,
+                      help='Render the entire area with its labels to this PNG file instead' +\
+                           ' of showing it.')
+  parser.add_argument('--compact',
+                      action='store_true',
+                      default=False,
+                      help='Renumber the tile files consecutively after tiles were removed.')
   args = parser.parse_args()
   return args
 
@@ -357,10 +643,14 @@ if __name__ == "__main__":
     Dataset._combine_datasets(args.data_path, args.classes_path, *args.combine)
 
   ds = Dataset(args.data_path, args.classes_path)
-  if args.tile:
+  if args.rebuild_catalog:
+    print(f"Cataloged {ds.rebuild_catalog(full=True)} tiles in {ds.catalog.path}")
+  elif args.compact:
+    print(f"Renumbered {ds.compact()} tiles, {len(ds)} tiles in the dataset.")
+  elif args.tile:
     inds = random.sample(range(len(ds)), min(args.tile, len(ds)))
     for i in inds:
       ds.visualize_tile(i)
   else:
     if not args.combine:
-      ds.visualize_dataset()
+      ds.visualize_dataset(out_path=args.overview)
@@ -0,0 +1,149 @@
+## DerivedStore keeps the files derived from each tile of a dataset (eg: masks), keyed by tile index,
+## and the index files of splits of the tiles.
+import os
+import json
+from shutil import rmtree
+
+# Directory of the derived stores of a dataset, in its data path.
+DERIVED_DIRNAME = 'derived'
+
+
+class DerivedStore:
+  """
+  The 'DerivedStore' class keeps the files one process derives from each tile of a
+  dataset (eg: the class masks of ImSeg_Dataset, the box and class targets of
+  PIXOR_Dataset) in `data_path/derived/[name]/`, named by the tile index of the tile
+  in the TileCatalog (eg: `12.npz`). The files don't depend on how the tiles are
+  split, so the splits can be changed without touching them.
+
+  How the files were derived (eg: the classes and size of the masks) is kept as the
+  `config` of the store in its `config.json`: opening the store with another config
+  empties it, so files derived differently are never read. The files are written
+  atomically, so a file that exists is complete.
+  """
+
+  def __init__(self, data_path, name, config=None):
+    """
+    Opens (and creates) store [name] of the dataset in [data_path], emptied unless
+    its files were derived with [config] (a json-serialisable dictionary).
+    """
+    self.data_path = data_path
+    self.name = name
+    self.path = os.path.join(data_path, DERIVED_DIRNAME, name)
+    self.config_path = os.path.join(self.path, 'config.json')
+    os.makedirs(self.path, exist_ok=True)
+
+    self.config = self.load_config()
+    if config is not None:
+      # Compared as stored, eg: with tuples as lists.
+      config = json.loads(json.dumps(config))
+      if config != self.config:
+        self.clear()
+        with open(self.config_path, 'w') as f:
+          json.dump(config, f, indent=2)
+        self.config = config
+
+  def load_config(self):
+    """
+    Returns the config of the store, or None if it has none.
+    """
+    if not os.path.isfile(self.config_path):
+      return None
+    with open(self.config_path, 'r') as f:
+      return json.load(f)
+
+  def file_path(self, tile_index, ext):
+    """
+    Returns the path of the [ext] file of tile [tile_index] (which may not exist).
+    """
+    return os.path.join(self.path, f"{tile_index}{ext}")
+
+  def contains(self, tile_index, ext):
+    """
+    Returns whether the [ext] file of tile [tile_index] was written.
+    """
+    return os.path.exists(self.file_path(tile_index, ext))
+
+  def indices(self, ext):
+    """
+    Returns the set of tile indices with an [ext] file.
+    """
+    return {int(name[:-len(ext)]) for name in os.listdir(self.path)
+            if name.endswith(ext) and name[:-len(ext)].isdigit()}
+
+  def write(self, tile_index, ext, data):
+    """
+    Writes the bytes [data] as the [ext] file of tile [tile_index], through a
+    temporary file so that readers never see it half written.
+    Returns:
+      The path of the file.
+    """
+    path = self.file_path(tile_index, ext)
+    with open(path + '.tmp', 'wb') as f:
+      f.write(data)
+    os.replace(path + '.tmp', path)
+    return path
+
+  def read(self, tile_index, ext):
+    """
+    Returns the bytes of the [ext] file of tile [tile_index].
+    Raises FileNotFoundError if it wasn't written.
+    """
+    with open(self.file_path(tile_index, ext), 'rb') as f:
+      return f.read()
+
+  def clear(self):
+    """
+    Removes every file of the store (but keeps its config).
+    """
+    for name in os.listdir(self.path):
+      path = os.path.join(self.path, name)
+      if path == self.config_path:
+        continue
+      if os.path.isdir(path):
+        rmtree(path)
+      else:
+        os.remove(path)
+
+  @staticmethod
+  def clear_all(data_path):
+    """
+    Empties every store of the dataset in [data_path], eg: once its tiles are
+    renumbered, so that their files are derived again under the new tile indices.
+    Returns:
+      The names of the stores.
+    """
+    root = os.path.join(data_path, DERIVED_DIRNAME)
+    if not os.path.isdir(root):
+      return []
+    names = sorted(name for name in os.listdir(root) if os.path.isdir(os.path.join(root, name)))
+    for name in names:
+      DerivedStore(data_path, name).clear()
+    return names
+
+
+def write_split_index(index_path, samples):
+  """
+  Writes the index file of a split: the list of the file paths of each of its samples
+  (eg: [(image path, targets path), ...]), stored relative to the index file's
+  directory, so that the split refers to the tiles instead of copies of them.
+  """
+  directory = os.path.dirname(os.path.abspath(index_path))
+  relative = [[os.path.relpath(os.path.abspath(path), directory) for path in paths]
+              for paths in samples]
+  with open(index_path + '.tmp', 'w') as f:
+    json.dump(relative, f)
+  os.replace(index_path + '.tmp', index_path)
+
+
+def read_split_index(index_path):
+  """
+  Returns the list of the file paths of each sample of the split index file
+  [index_path] (see `write_split_index`), or None if it doesn't exist.
+  """
+  if not os.path.isfile(index_path):
+    return None
+  with open(index_path, 'r') as f:
+    relative = json.load(f)
+  directory = os.path.dirname(index_path)
+  return [tuple(os.path.join(directory, path) for path in paths) for paths in relative]
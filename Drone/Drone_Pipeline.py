@@ -2,6 +2,7 @@ import sys
 sys.path.append('.')
 import os
 import json
+import hashlib
 import requests
 import argparse
 import numpy as np
@@ -12,10 +13,16 @@ from tqdm import tqdm
 import multiprocessing
 import concurrent.futures
 from Drone.Drone_Dataset import Drone_Dataset
-from DataPipeline import query_OSM, coords_to_pixels, boxes_in_tile
+from DataPipeline import query_OSM, coords_to_pixels, boxes_in_tile, pixel_bounds
+from LabelStore import LabelIndex
+from OSMCache import OSMCache
+from TileFilter import TileFilter
+from TileCatalog import TileCatalog
+import TileEncoder
 
 
-def save_tile_and_labels(tile_arr, tile_labels, out_index, dataset, resize=None):
+def save_tile_and_labels(tile_arr, tile_labels, out_index, dataset, resize=None,
+                         image_encoder=None, label_encoder=None):
   """
   Saves a single tile and the labels associated with that tile. Resizes the
   tile if specified, assumes that `tile_labels` coords won't need to be resized.\n
@@ -23,17 +30,32 @@ def save_tile_and_labels(tile_arr, tile_labels, out_index, dataset, resize=None)
     tile_arr: numpy array denoting the specific tile.\n
     tile_labels: dictionary of label coords (in pixel value) associated with tile.\n
     out_index: named index of the tile/bbox to be saved\n
-    resize: (h, w) in pixels defining target size of tiles
+    resize: (h, w) in pixels defining target size of tiles\n
+    image_encoder, label_encoder: (Optional) TileEncoder formats of the tile and its
+      labels (default: .jpg and single line .json)\n
+  Returns:\n
+    The TileCatalog row of the tile (without its source and bounds).
   """
+  image_encoder = image_encoder or TileEncoder.JpegEncoder()
+  label_encoder = label_encoder or TileEncoder.JsonLabelEncoder(indent=None)
+
   tile_im = Image.fromarray(tile_arr).convert('RGB')
   if resize:
     tile_im = tile_im.resize(resize, resample=Image.BILINEAR)
-  tile_name = os.path.join(dataset.images_path, f"{out_index}.jpg")
-  tile_im.save(tile_name)
-
-  bbox_name = os.path.join(dataset.annotations_path, f"{out_index}.json")
-  with open(bbox_name, 'w') as f:
-    json.dump(tile_labels, f)
+  img_bytes = image_encoder.encode(np.array(tile_im))
+  img_path = TileEncoder.write_tile_file(dataset.images_path, out_index, img_bytes,
+                                         image_encoder.ext, TileEncoder.IMAGE_EXTS)
+
+  ann_path = TileEncoder.write_tile_file(dataset.annotations_path, out_index,
+                                         label_encoder.encode(tile_labels),
+                                         label_encoder.ext, TileEncoder.LABEL_EXTS)
+  return {
+    'index': out_index,
+    'image_file': os.path.basename(img_path),
+    'annotation_file': os.path.basename(ann_path),
+    'sha256': hashlib.sha256(img_bytes).hexdigest(),
+    'labels': TileCatalog.count_labels(tile_labels)
+  }
 
 
 def read_tile(im_path, tile_range):
@@ -60,8 +82,19 @@ def read_tile(im_path, tile_range):
   return clean_arr
 
 
+def read_resized(im_path, out_shape):
+  """
+  Reads the entire `.tiff` image at `im_path` downsampled to `out_shape` (h, w), 
+  as a numpy array of shape (h, w, channels).
+  """
+  with rasterio.open(im_path) as im:
+    im_arr = im.read(out_shape=(im.count, out_shape[0], out_shape[1]))
+  return im_arr.transpose(1, 2, 0)
+
+
 def tile_and_annotate(dataset, path_to_im, path_to_meta, 
-                      out_res=1, tile_size=(224, 224), overlap=0):
+                      out_res=1, tile_size=(224, 224), overlap=0, osm_cache=None,
+                      tile_filter=None, image_encoder=None, label_encoder=None):
   """
   Tiles and saves an image. The tiles that are saved are resized to the intended
   resolution determined by `out_res`. The input resolution of the file (in metres) 
@@ -75,7 +108,11 @@ def tile_and_annotate(dataset, path_to_im, path_to_meta,
       (including resolution as specified by the `gsd` attribute (in metres)) \n
     out_res: target per-pixel resolution, where 1 pixel ~ `out_res` meters \n
     tile_size: (h, w) in pixels defining target size of tiles \n
-    overlap: Amount of overlapping pixels between adjacent tiles (after resizing)
+    overlap: Amount of overlapping pixels between adjacent tiles (after resizing) \n
+    osm_cache: (Optional) OSMCache from which to reuse OpenStreetMap query results \n
+    tile_filter: (Optional) TileFilter rejecting tiles before they are read and saved.
+      Its image statistics are computed on the image downsampled to `out_res`.
+    image_encoder, label_encoder: (Optional) TileEncoder formats of the saved tiles and labels.
   """
   with rasterio.open(path_to_im) as im:
     h, w = im.shape
@@ -99,20 +136,36 @@ def tile_and_annotate(dataset, path_to_im, path_to_meta,
 
   # Get OSM data, and convert from lat-lon to pixel coords (in terms of resized image)
   print(f"Querying OpenStreetMap data for labels...")
-  raw_osm = query_OSM(coords, dataset.classes)
+  raw_osm = query_OSM(coords, dataset.classes, cache=osm_cache)
   label_coords = coords_to_pixels(raw_osm, coords, (h/ratio, w/ratio), 
                                   dataset.raw_data_path, out_file=f"{im_id}")
   print(f"Done querying OpenStreetMap.")
 
-  start = len(dataset)
+  # Bucket the labels by (resized) tile-sized grid cells once for all tiles.
+  label_index = LabelIndex(label_coords, tile_size[0])
+
+  # New tiles are numbered after every tile index ever used (even by removed tiles).
+  start = dataset.next_tile_index()
+
+  row_starts, col_starts = range(0, h - step_h, step_h), range(0, w - step_w, step_w)
+
+  # Decide which tiles to keep for the whole grid at once (in resized pixels).
+  if tile_filter:
+    resized = read_resized(path_to_im, (int(h/ratio), int(w/ratio)))
+    keep = tile_filter.keep_grid(resized, label_coords, np.array(row_starts) // ratio,
+                                 np.array(col_starts) // ratio, tile_size)
+    print(f"Keeping {keep.sum()} of {keep.size} tiles after filtering.")
+  else:
+    keep = np.ones((len(row_starts), len(col_starts)), dtype=bool)
 
   # Maps from image_ind --> (row_start, col_start)
   ind_to_tile_range = {}
   image_ind = start
-  for row_start in range(0, h - step_h, step_h):
-    for col_start in range(0, w - step_w, step_w):
-      ind_to_tile_range[image_ind] = (row_start, col_start)
-      image_ind += 1
+  for row, row_start in enumerate(row_starts):
+    for col, col_start in enumerate(col_starts):
+      if keep[row, col]:
+        ind_to_tile_range[image_ind] = (row_start, col_start)
+        image_ind += 1
   
   ## Executor function that saves tile for specific (row_start, col_start) inds.
   def tile_and_save(image_ind, row_start, col_start):
@@ -122,10 +175,13 @@ def tile_and_annotate(dataset, path_to_im, path_to_meta,
     # Get the tile array and the labels in the (resized) tile
     tile_range = np.array([col_start, col_end, row_start, row_end])
     tile_arr = read_tile(path_to_im, tile_range)
-    tile_labels = boxes_in_tile(label_coords, tile_range/ratio)
+    tile_labels = boxes_in_tile(label_coords, tile_range/ratio, label_index)
 
     # Save the tile and labels, resizing the tile to the `tile_size`
-    save_tile_and_labels(tile_arr, tile_labels, image_ind, dataset, resize=tile_size)
+    row = save_tile_and_labels(tile_arr, tile_labels, image_ind, dataset, resize=tile_size,
+                               image_encoder=image_encoder, label_encoder=label_encoder)
+    row.update(source=im_id, bounds=pixel_bounds(coords, (h/ratio, w/ratio), tile_range/ratio))
+    return row
 
   # Concurrently tile up and save tiles.
   max_workers = min(10, os.cpu_count())
@@ -136,13 +192,17 @@ def tile_and_annotate(dataset, path_to_im, path_to_meta,
     }
 
     # Throw error raised during tiling.
+    rows = []
     for future in concurrent.futures.as_completed(future_to_ind):
       ind = future_to_ind[future]
       err = future.exception()
       if err:
         raise err
-  
-  end = len(dataset)
+      rows.append(future.result())
+
+  # Catalog the new tiles (in index order) all at once.
+  dataset.catalog_tiles(sorted(rows, key=lambda row: row['index']))
+  end = start + len(rows)
 
   # Save the metadata associated with the range of tiles
   if end - start > 0:
@@ -211,7 +271,8 @@ def download_tiff(url, out_path):
       f.write(data)
 
 
-def create_dataset(data_path, classes_path, query_url_path=None, overlap=0):
+def create_dataset(data_path, classes_path, query_url_path=None, overlap=0, osm_cache=True,
+                   tile_filter=None, image_encoder=None, label_encoder=None):
   """
   Creates a dataset of drone imagery (no annotations) given the directory path
   to store the data. If specified, will download OpenAerialMap imagery from 
@@ -220,6 +281,9 @@ def create_dataset(data_path, classes_path, query_url_path=None, overlap=0):
     data_path: Path to directory where extracted dataset is stored.
     query_url_path: Path to .txt file containing URLs or image ids of OpenAerialMap
                     drone images.
+    osm_cache: Whether to reuse cached OpenStreetMap query results.
+    tile_filter: (Optional) TileFilter rejecting tiles before they are saved.
+    image_encoder, label_encoder: (Optional) TileEncoder formats of the saved tiles and labels.
   """
   ds = Drone_Dataset(data_path, classes_path=classes_path)
   im_ext1, im_ext2 = ".tif", ".tiff"
@@ -264,10 +328,13 @@ def create_dataset(data_path, classes_path, query_url_path=None, overlap=0):
     "Number of images != number of image metadata files."
   
   # Query OSM, tile image and save them.
+  cache = OSMCache() if osm_cache else None
   raw_im_paths, raw_meta_paths = sorted(raw_im_paths), sorted(raw_meta_paths)
   for im_path, meta_path in zip(raw_im_paths, raw_meta_paths):
     print(f"\nTiling image: {im_path}")
-    tile_and_annotate(ds, im_path, meta_path, overlap=overlap)
+    tile_and_annotate(ds, im_path, meta_path, overlap=overlap, osm_cache=cache,
+                      tile_filter=tile_filter, image_encoder=image_encoder,
+                      label_encoder=label_encoder)
     print(f"Done tiling image.\n")
 
 
@@ -290,6 +357,34 @@ def passed_arguments():
                       type=str, 
                       default=os.path.join(".", "classes.json"),
                       help="Path to json file determining OSM classes.")
+  parser.add_argument("--no_osm_cache", 
+                      action="store_true",
+                      default=False,
+                      help="Always query OpenStreetMap instead of reusing cached results.")
+  parser.add_argument("--max_nodata", 
+                      type=float, 
+                      default=None,
+                      help="Skip tiles with a larger fraction of nodata pixels (eg: 0.5).")
+  parser.add_argument("--min_labels", 
+                      nargs="+",
+                      type=str, 
+                      default=None,
+                      help="Skip tiles with fewer labels of a class, as class=count" +\
+                           " (eg: building=1 or building/hospital=1).")
+  parser.add_argument("--min_entropy", 
+                      type=float, 
+                      default=None,
+                      help="Skip tiles whose grayscale entropy (in bits) is lower (eg: 1.0).")
+  parser.add_argument("--image_encoder", 
+                      type=str, 
+                      default="jpeg",
+                      help="Format of the tile images, with options" +\
+                           " (eg: jpeg:quality=90,subsampling=0, png, webp or npy).")
+  parser.add_argument("--label_encoder", 
+                      type=str, 
+                      default=None,
+                      help="Format of the tile labels: json, compact (json) or binary" +\
+                           " (default: single line json).")
   args = parser.parse_args()
   return args
 
@@ -299,5 +394,9 @@ if __name__ == "__main__":
     args.data_path, 
     classes_path=args.classes, 
     query_url_path=args.query_path,
-    overlap=args.overlap
+    overlap=args.overlap,
+    osm_cache=not args.no_osm_cache,
+    tile_filter=TileFilter.from_args(args.max_nodata, args.min_labels, args.min_entropy),
+    image_encoder=TileEncoder.image_encoder(args.image_encoder),
+    label_encoder=TileEncoder.label_encoder(args.label_encoder) if args.label_encoder else None
   )
\ No newline at end of file
@@ -0,0 +1,176 @@
+## EncoderBenchmark compares the throughput and size of the TileEncoder formats on a dataset's tiles.
+import os
+import time
+import random
+import argparse
+import numpy as np
+from Dataset import Dataset
+from Manifest import Manifest
+import TileEncoder
+
+DEFAULT_IMAGE_ENCODERS = ['jpeg', 'jpeg:quality=90', 'jpeg:quality=90,subsampling=0',
+                          'png:compress_level=1', 'png', 'webp', 'webp:lossless=true', 'npy']
+DEFAULT_LABEL_ENCODERS = ['json', 'compact', 'binary']
+
+
+def sample_tiles(ds, num_tiles, seed=0):
+  """
+  Returns a list of (tile_array, labels) of [num_tiles] random tiles of Dataset [ds].
+  Each tile_array is the lossless raster of the tile (see `raster_tiles`) when its
+  window was recorded, and the decoded tile file otherwise.
+  """
+  indices = sorted(random.Random(seed).sample(range(len(ds)), min(num_tiles, len(ds))))
+  samples = [ds.get_tile_and_label(i) for i in indices]
+  rasters = raster_tiles(ds, [ds.tile_indices[i] for i in indices])
+  return [(tile if raster is None or raster.shape != tile.shape else raster, labels)
+          for (tile, labels), raster in zip(samples, rasters)]
+
+
+def raster_tiles(ds, tile_indices):
+  """
+  Returns the pixels of the tiles [tile_indices] of Dataset [ds] sliced from the
+  lossless `raw_data/Entire_Area.npy`, at the windows DataPipeline.py recorded in the
+  tiles Manifest, so that encoders are compared to the raster instead of to tiles
+  already compressed (eg: as jpeg). A tile is None if its window wasn't recorded (eg:
+  tiled by an older pipeline or by Drone_Pipeline.py), or the dataset has no
+  `Entire_Area.npy`.
+  """
+  area_path = os.path.join(ds.raw_data_path, 'Entire_Area.npy')
+  if not tile_indices or not os.path.isfile(area_path):
+    return [None] * len(tile_indices)
+  area = np.load(area_path, mmap_mode='r')
+  records = Manifest(ds.raw_data_path).valid_tile_records(ds, max(tile_indices) + 1)
+
+  rasters = []
+  for tile_index in tile_indices:
+    window = records.get(tile_index, {}).get('window')
+    if window is None:
+      rasters.append(None)
+      continue
+    col_start, col_end, row_start, row_end = window
+    rasters.append(np.array(area[row_start:row_end, col_start:col_end]))
+  return rasters
+
+
+def psnr(original, decoded):
+  """
+  Returns the peak signal to noise ratio (in dB) of a decoded image, inf if lossless.
+  """
+  mse = np.mean((original.astype(np.float64) - decoded.astype(np.float64)) ** 2)
+  return float('inf') if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+
+def benchmark_encoder(encoder, items, raw_size):
+  """
+  Encodes then decodes (from memory, so disk speed isn't included) every item of
+  [items] with [encoder].
+  Requires:
+    raw_size: function giving the uncompressed size in bytes of an item\n
+  Returns:
+    A dictionary of the encode throughput (MB/s of uncompressed input), the mean
+    encoded bytes per tile, the compression ratio, the decode time per tile (ms)
+    and the decoded items.
+  """
+  start = time.perf_counter()
+  encoded = [encoder.encode(item) for item in items]
+  encode_time = time.perf_counter() - start
+
+  start = time.perf_counter()
+  decoded = [encoder.decode(data) for data in encoded]
+  decode_time = time.perf_counter() - start
+
+  raw_bytes = sum(raw_size(item) for item in items)
+  encoded_bytes = sum(len(data) for data in encoded)
+  return {
+    'mb_per_s': raw_bytes / 1e6 / max(encode_time, 1e-9),
+    'bytes_per_tile': encoded_bytes / len(items),
+    'ratio': raw_bytes / max(encoded_bytes, 1),
+    'decode_ms': 1000 * decode_time / len(items),
+    'decoded': decoded
+  }
+
+
+def run_benchmark(ds, image_specs, label_specs, num_tiles=64, seed=0):
+  """
+  Benchmarks each image encoder spec on the tiles, and each label encoder spec on the
+  labels, of [num_tiles] random tiles of Dataset [ds].
+  Returns:
+    (image_results, label_results), lists of (spec, result dictionary).
+  """
+  samples = sample_tiles(ds, num_tiles, seed)
+  assert samples, "The dataset has no tiles to benchmark."
+  tiles = [tile for tile, _ in samples]
+  labels = [label for _, label in samples]
+
+  image_results = []
+  for spec in image_specs:
+    result = benchmark_encoder(TileEncoder.image_encoder(spec), tiles, lambda tile: tile.nbytes)
+    result['psnr'] = float(np.mean([psnr(tile, decoded)
+                                    for tile, decoded in zip(tiles, result.pop('decoded'))]))
+    image_results.append((spec, result))
+
+  # Label sizes are relative to the indented json the pipeline writes by default.
+  json_size = lambda label: len(TileEncoder.JsonLabelEncoder(indent=2).encode(label))
+  label_results = []
+  for spec in label_specs:
+    result = benchmark_encoder(TileEncoder.label_encoder(spec), labels, json_size)
+    assert result.pop('decoded') == labels, f"Label encoder {spec} doesn't round trip."
+    label_results.append((spec, result))
+  return image_results, label_results
+
+
+def print_report(image_results, label_results):
+  """
+  Prints a table of the results of `run_benchmark`.
+  """
+  print(f"{'image encoder':32} {'MB/s':>9} {'bytes/tile':>11} {'ratio':>7}" +\
+        f" {'decode ms':>10} {'PSNR dB':>8}")
+  for spec, r in image_results:
+    print(f"{spec:32} {r['mb_per_s']:9.1f} {r['bytes_per_tile']:11.0f} {r['ratio']:7.2f}" +\
+          f" {r['decode_ms']:10.3f} {r['psnr']:8.2f}")
+
+  print(f"\n{'label encoder':32} {'MB/s':>9} {'bytes/tile':>11} {'ratio':>7} {'decode ms':>10}")
+  for spec, r in label_results:
+    print(f"{spec:32} {r['mb_per_s']:9.1f} {r['bytes_per_tile']:11.0f} {r['ratio']:7.2f}" +\
+          f" {r['decode_ms']:10.3f}")
+
+
+def passed_arguments():
+  parser = argparse.ArgumentParser(
+    description="Script to benchmark the tile image and label formats on a dataset's tiles.")
+  parser.add_argument('-d', '--data_path',
+                      type=str,
+                      required=True,
+                      help='Path to directory where extracted dataset is stored.')
+  parser.add_argument('-c', '--classes_path',
+                      type=str,
+                      default='classes.json',
+                      help='Path to .json file denoting classes of labels used in dataset.')
+  parser.add_argument('-n', '--num_tiles',
+                      type=int,
+                      default=64,
+                      help='Number of random tiles to benchmark on.')
+  parser.add_argument('--image_encoders',
+                      nargs='+',
+                      type=str,
+                      default=DEFAULT_IMAGE_ENCODERS,
+                      help='Image encoder specs to compare (eg: jpeg:quality=90 png npy).')
+  parser.add_argument('--label_encoders',
+                      nargs='+',
+                      type=str,
+                      default=DEFAULT_LABEL_ENCODERS,
+                      help='Label encoder specs to compare (eg: json compact binary).')
+  parser.add_argument('--seed',
+                      type=int,
+                      default=0,
+                      help='Seed of the random sample of tiles.')
+  args = parser.parse_args()
+  return args
+
+
+if __name__ == "__main__":
+  args = passed_arguments()
+  ds = Dataset(args.data_path, classes_path=args.classes_path)
+  image_results, label_results = run_benchmark(ds, args.image_encoders, args.label_encoders,
+                                               num_tiles=args.num_tiles, seed=args.seed)
+  print_report(image_results, label_results)
@@ -1,23 +1,88 @@
 import sys
 sys.path.append('.')
 import os
-import math
 import json
 import random
+import functools
 import argparse
 import numpy as np
 from datetime import date
 from PIL import Image, ImageDraw
-from shutil import copyfile
 from Dataset import Dataset
+from CombinedDataset import CombinedDataset
+from DerivedStore import DerivedStore
+import TileEncoder
+import TileShards
 from ImSeg.preprocess import augment_data
+from ImSeg.rasterize import rasterize_labels, ROAD_WIDTH
+from BatchPrefetcher import prefetch_map
 
 # Visualising
 import matplotlib.pyplot as plt
 import matplotlib.ticker as plticker
 import matplotlib.colors as colors
 from shapely.geometry.polygon import Polygon
-from matplotlib.path import Path
+
+# Name of the DerivedStore of the class masks of the tiles.
+MASKS_STORE = 'im_seg_masks'
+
+
+def open_image(path_to_file, img_size):
+  """
+  Opens the image at path_to_file as a PIL Image, resized to the (h, w, d) img_size.
+  """
+  h, w, d = img_size
+  im = TileEncoder.open_image(path_to_file)
+  if (im.size[1], im.size[0], len(im.getbands())) != (h, w, d):
+    im = im.resize((w, h), resample=Image.BILINEAR)
+  return im
+
+
+def write_image(path_to_file, path_to_dest, img_size):
+  """
+  Copies the image at path_to_file to path_to_dest, resized to the (h, w, d) img_size.
+  """
+  open_image(path_to_file, img_size).save(path_to_dest)
+
+
+def encode_masks(path_to_file, img_name, img_size, class_indices):
+  """
+  Returns the class masks of the labels file at path_to_file (see `rasterize_labels`)
+  bit-packed with the image name (see `TileEncoder.MaskEncoder`). A labels file that
+  can't be decoded (eg: empty) gives empty masks.
+  """
+  try:
+    labels_in_tile = TileEncoder.read_labels(path_to_file)
+  except ValueError:
+    labels_in_tile = {}
+
+  masks = rasterize_labels(labels_in_tile, class_indices, img_size[:2])
+  return TileEncoder.MaskEncoder().encode(masks, img_name=img_name)
+
+
+def write_masks(path_to_file, dest_dir, index, img_name, img_size, class_indices):
+  """
+  Writes the class masks of the labels file at path_to_file (see `rasterize_labels`)
+  bit-packed to `dest_dir/[index].npz` (see `TileEncoder.MaskEncoder`).
+  Returns:
+  The path of the written file.
+  """
+  data = encode_masks(path_to_file, img_name, img_size, class_indices)
+  return TileEncoder.write_tile_file(dest_dir, index, data, TileEncoder.MaskEncoder.ext,
+                                     TileEncoder.MASK_EXTS)
+
+
+def _derive_masks(item, store, img_size, class_indices):
+  """
+  Helper function only.
+  Writes the masks of one tile to the masks DerivedStore [store] (in a worker process
+  of `ImSeg_Dataset.derive_masks`), given (labels path, tile index, image name).
+  Returns:
+  The path of the written masks.
+  """
+  labels_path, tile_index, img_name = item
+  data = encode_masks(labels_path, img_name, img_size, class_indices)
+  return store.write(tile_index, TileEncoder.MaskEncoder.ext, data)
 
 
 class ImSeg_Dataset(Dataset):
@@ -37,15 +102,16 @@ class ImSeg_Dataset(Dataset):
     This object will therefore override the self.annotations_path and
     self.annotation_list attributes.
     """
-    assert len(train_val_test) == 3, 'Split must only contain percentages for train/val/test'
-    assert sum(train_val_test) == 1, 'Train, val and test percentages should add to 1'
-    for s in train_val_test:
-      assert s >= 0, 'Train, val, test percentages should be non-negative'
-
+    ImSeg_Dataset.check_split(train_val_test)
     super().__init__(data_path, classes_path=classes_path)
 
     self.image_resize = image_resize
     self.seg_classes = self.sorted_classes(self.classes)
+    # Index of the mask of each (super_class, sub_class) in seg_classes.
+    self.seg_class_indices = {
+      (super_class, sub_class): self.seg_classes.index(self.get_seg_class_name(super_class, sub_class))
+      for super_class, sub_classes in self.classes.items() for sub_class in sub_classes
+    }
 
     # Set up data file paths
     self.train_val_test = train_val_test
@@ -54,6 +120,14 @@ class ImSeg_Dataset(Dataset):
     self.val_path = os.path.join(self.im_seg_path, 'val')
     self.test_path = os.path.join(self.im_seg_path, 'test')
     self.out_path = os.path.join(self.im_seg_path, 'out')
+    # Seed and percentages of the split of a dataset split by index (see `build_dataset`).
+    self.split_path = os.path.join(self.im_seg_path, 'split.json')
+    self.split_config = None
+    # Tile indices of each split, and position in img_list of each tile index.
+    self.split_tiles = {}
+    self.tile_positions = {}
+    self._mask_store = None
+    self._img_size = None
 
     self.data_sizes = {"train": 0, "val": 0, "test": 0, "out": 0}
     self.init_directories()
@@ -67,7 +141,7 @@ class ImSeg_Dataset(Dataset):
     Creates the 'im_seg' directory in the data_path. Also creates the train/val/test/out
     directories with the images/ and annotations/ directory for each.
     If the directories already exist, then initialises the data_sizes based on existing 
-    directories.
+    directories, or on the splits in the TileCatalog if the dataset is split by index.
     """
     Dataset._create_dirs(
       self.im_seg_path,
@@ -87,6 +161,7 @@ class ImSeg_Dataset(Dataset):
       num_samples = len([name for name in os.listdir(os.path.join(directory, 'images'))\
                          if name.endswith('.jpg')])
       self.data_sizes[set_type] = num_samples
+    self.load_splits()
   
 
   def create_model_out_dir(self, model_name):
@@ -142,162 +217,271 @@ class ImSeg_Dataset(Dataset):
     """
     if self.image_resize:
       return self.image_resize
-    return super().get_img_size()
+    # Tiles all have the same size, so it's only read once.
+    if self._img_size is None:
+      self._img_size = super().get_img_size()
+    return self._img_size
 
 
-  def build_dataset(self):
+  @staticmethod
+  def check_split(train_val_test):
+    """
+    Checks that train_val_test holds valid train/val/test percentages.
+    """
+    assert len(train_val_test) == 3, 'Split must only contain percentages for train/val/test'
+    assert sum(train_val_test) == 1, 'Train, val and test percentages should add to 1'
+    for s in train_val_test:
+      assert s >= 0, 'Train, val, test percentages should be non-negative'
+
+
+  def build_dataset(self, seed=0, workers=None):
+    """
+    Splits the tiles into train, val and test sets, without copying them.
+
+    Each tile is assigned to a split by the hash of its tile index and [seed] (see
+    `Dataset.split_key`), so the same seed always gives the same splits, and is numbered
+    in a split by the order of the hashes. The splits are recorded in the TileCatalog
+    (and the seed and percentages in `im_seg/split.json`), and samples are read from
+    the tiles in `images/`. The masks are rasterized into the masks DerivedStore by
+    [workers] processes (all cpus by default, 0 to rasterize them in this process),
+    skipping the tiles whose masks are already there. The images and masks copied into
+    the train/val/test directories by an earlier build are removed.
+    """
+    # The catalog is rescanned for tiles added to images/ since it was (re)built.
+    self.rebuild_catalog()
+    len(self)
+    self.derive_masks(workers=workers)
+    self.write_splits(Dataset.assign_splits(self.tile_indices, self.train_val_test, seed),
+                      self.train_val_test, seed)
+
+    for set_type in ["train", "val", "test"]:
+      for d_type in ["images", "annotations"]:
+        d_path = os.path.join(getattr(self, f"{set_type}_path"), d_type)
+        for f in os.listdir(d_path):
+          os.remove(os.path.join(d_path, f))
+
+
+  def resplit(self, train_val_test=None, seed=None):
     """
-    Helper method only called in build_dataset that splits data into test
-    train and validation sets.
+    Splits a dataset split by index (see `build_dataset`) again with the
+    [train_val_test] percentages and [seed] (the current ones if None). Only the
+    TileCatalog, `split.json` and `path_map.json` are written: no tile or mask is read,
+    copied or rasterized.
     """
-    data = list(zip(self.img_list, self.annotation_list))
-    random.shuffle(data)
-    shuffled_img, shuffled_annotations = zip(*data)
+    assert self.split_config is not None,\
+      "Only datasets split by index (see build_dataset) can be re-split."
+    train_val_test = train_val_test or self.split_config["train_val_test"]
+    seed = self.split_config["seed"] if seed is None else seed
+    ImSeg_Dataset.check_split(train_val_test)
+
+    self.train_val_test = train_val_test
+    self.write_splits(Dataset.assign_splits(self.tile_indices, train_val_test, seed),
+                      train_val_test, seed)
 
-    train, val, test = self.train_val_test
 
-    # Mapping from image/ann path in train/val/test folder to original source
-    # in images/annotations folder
+  def write_splits(self, splits, train_val_test, seed):
+    """
+    Helper method only.
+    Records [splits] (dictionary of split -> list of its tile indices, in order) in the
+    TileCatalog, the percentages and seed they were made with in `split.json`, and the
+    files of each sample in `path_map.json`.
+    """
+    self.catalog.set_splits({tile_index: (split, split_index)
+                             for split, tiles in splits.items()
+                             for split_index, tile_index in enumerate(tiles)})
+    with open(self.split_path, 'w') as f:
+      json.dump({"seed": seed, "train_val_test": list(train_val_test)}, f, indent=2)
+    self.load_splits()
+    self.write_path_map()
+    if self.cache is not None:
+      self.cache.clear()
+
+
+  def append(self, workers=None):
+    """
+    Adds the tiles that aren't in any split yet (eg: the tiles of a new drone image
+    added by Drone_Pipeline.py, which numbers them after the tiles already in
+    `images/`), to a dataset split by index (see `build_dataset`), without changing
+    the splits of the tiles already in them. The catalog is rebuilt first, so tiles
+    copied into `images/` and `annotations/` without updating it are added too.
+
+    The new tiles are assigned to splits by the same rule, seed and percentages as the
+    dataset was split with (see `Dataset.split_key`), so a tile is in the same split as
+    if the dataset was built with it, and are numbered in each split after its current
+    samples, in the order of their hashes. Only the masks of the new tiles are
+    rasterized (by [workers] processes, see `derive_masks`).
+    Returns:
+    The dictionary of split -> number of tiles added to it.
+    """
+    assert self.split_config is not None,\
+      "Only datasets split by index can be appended to (see build_dataset)."
+    # Keeps the rows (and splits) of the tiles already in the catalog.
+    self.rebuild_catalog()
+    len(self)
+    in_splits = set()
+    for tiles in self.split_tiles.values():
+      in_splits.update(tiles)
+    new_tiles = [tile_index for tile_index in self.tile_indices if tile_index not in in_splits]
+
+    self.derive_masks(tile_indices=new_tiles, workers=workers)
+    splits = Dataset.assign_splits(new_tiles, self.split_config["train_val_test"],
+                                   self.split_config["seed"])
+    self.catalog.set_splits({tile_index: (split, len(self.split_tiles[split]) + split_index)
+                             for split, tiles in splits.items()
+                             for split_index, tile_index in enumerate(tiles)})
+    self.load_splits()
+    self.write_path_map()
+    return {split: len(tiles) for split, tiles in splits.items()}
+
+
+  def write_path_map(self):
+    """
+    Helper method only.
+    Writes `path_map.json`, which maps the image and masks of each sample of the splits
+    of a dataset split by index to its original image and annotation.
+    """
+    # Mapping from the image/masks of each sample of train/val/test to the original
+    # image/annotation in the images/annotations folder (the same file for images).
+    store = self.mask_store()
     new_path_map = {
-      set_type: {"images":{}, "annotations":{}} 
+      set_type: {"images":{}, "annotations":{}}
       for set_type in ["train", "val", "test"]
     }
-
-    # index counter i
-    i = 0
-    while i < len(shuffled_img):
-      if i < math.floor(train*len(shuffled_img)):
-        # Add to train folder
-        ind = i
-        out_path = self.train_path
-        set_type = "train"
-        self.data_sizes[set_type] += 1
-
-      elif i < math.floor((train+val)*len(shuffled_img)):
-        # Add to val folder
-        ind = i - math.floor(train*len(shuffled_img))
-        out_path = self.val_path
-        set_type = "val"
-        self.data_sizes[set_type] += 1
-        
-      else:
-        # Add to test folder
-        ind = i - math.floor((train+val)*len(shuffled_img))
-        out_path = self.test_path
-        set_type = "test"
-        self.data_sizes[set_type] += 1
-
-      # Copy over image to new [train/val/test] destination dir
-      im_source_path = os.path.join(self.images_path, shuffled_img[i])
-      im_dest_path = os.path.join(out_path, "images", f"{ind}.jpg")
-      self.format_image(im_source_path, im_dest_path)
-
-      # Create mask and save annotation in new [train/val/test] destination dir
-      ann_source_path = os.path.join(self.annotations_path, shuffled_annotations[i])
-      ann_dest_path = os.path.join(out_path, "annotations", f"{ind}.json")
-      self.format_json(ann_source_path, ann_dest_path, f"{ind}.jpg")
-
-      # Add mapping from new destination path back to origin source
-      new_path_map[set_type]["images"][im_dest_path] = im_source_path
-      new_path_map[set_type]["annotations"][ann_dest_path] = ann_source_path
-                       
-      # increment index counter
-      i += 1
-    
+    for set_type, tiles in self.split_tiles.items():
+      for tile_index in tiles:
+        i = self.tile_positions[tile_index]
+        im_path = os.path.join(self.images_path, self.img_list[i])
+        new_path_map[set_type]["images"][im_path] = im_path
+        ann_dest_path = store.file_path(tile_index, TileEncoder.MaskEncoder.ext)
+        new_path_map[set_type]["annotations"][ann_dest_path] =\
+          os.path.join(self.annotations_path, self.annotation_list[i])
     with open(os.path.join(self.im_seg_path, 'path_map.json'), 'w') as outfile:
       json.dump(new_path_map, outfile, indent=2)
 
 
-  def format_image(self, path_to_file, path_to_dest):
+  def load_splits(self):
+    """
+    Helper method only.
+    Loads the splits of a dataset split by index (see `build_dataset`): the seed and
+    percentages in `split.json`, and the tiles of each split in the TileCatalog, which
+    give `data_sizes`. Datasets built before keep the sizes of their directories.
     """
-    Helper method called in build_dataset that copies the file from 
-    path_to_file, resizes it to IMAGE_SIZE x IMAGE_SIZE x 3, and saves
-    it in the destination folder. 
+    if not os.path.isfile(self.split_path):
+      return
+    with open(self.split_path, 'r') as f:
+      self.split_config = json.load(f)
+    len(self)
+    self.tile_positions = {tile_index: i for i, tile_index in enumerate(self.tile_indices)}
+    for set_type in ["train", "val", "test"]:
+      self.split_tiles[set_type] = self.catalog.tiles_in_split(set_type)
+      self.data_sizes[set_type] = len(self.split_tiles[set_type])
+
+
+  def mask_store(self):
     """
-    h, w, d = self.get_img_size()
-    im = Image.open(path_to_file)
-    if (im.size[1], im.size[0], len(im.getbands())) != (h, w, d):
-      im = im.resize((w, h), resample=Image.BILINEAR)
-    im.save(path_to_dest)
+    Returns the DerivedStore of the class masks of the tiles, `derived/im_seg_masks/`,
+    where the masks of tile index t are `t.npz`. It's emptied if the classes, the tile
+    size or the road width they were rasterized with change.
+    """
+    if self._mask_store is None:
+      h, w, _ = self.get_img_size()
+      self._mask_store = DerivedStore(self.data_path, MASKS_STORE, {
+        "seg_classes": self.seg_classes, "img_size": [h, w], "road_width": ROAD_WIDTH
+      })
+    return self._mask_store
 
 
-  def format_json(self, path_to_file, path_to_dest, img_name):
+  def derive_masks(self, tile_indices=None, workers=None):
     """
-    Helper method only called in split_data that takes a json file at
-    path_to_file and writes a corresponding json at path_to_dest.
-    {
-      "annotation" : [pixel-wise encoding],
-      "img" : img_name
-    }
+    Rasterizes the masks of the tiles of [tile_indices] (all tiles if None) that aren't
+    in the masks store yet (see `mask_store`), in [workers] processes (all cpus by
+    default, 0 to rasterize them in this process).
+    Returns:
+    The number of tiles rasterized.
     """
+    store = self.mask_store()
+    img_size = self.get_img_size()
+    len(self)
+    done = store.indices(TileEncoder.MaskEncoder.ext)
+    wanted = None if tile_indices is None else set(tile_indices)
+    items = [(os.path.join(self.annotations_path, self.annotation_list[i]), tile_index,
+              self.img_list[i])
+             for i, tile_index in enumerate(self.tile_indices)
+             if tile_index not in done and (wanted is None or tile_index in wanted)]
+
+    workers = os.cpu_count() if workers is None else workers
+    derive = functools.partial(_derive_masks, store=store, img_size=img_size,
+                               class_indices=self.seg_class_indices)
+    for _ in prefetch_map(derive, items, workers=workers, prefetch=4 * workers, processes=True):
+      pass
+    return len(items)
 
-    # Im_size: [width, height, depth] should be squares
-    with open(path_to_file) as f:
-      try:
-        labels_in_tile = json.load(f)
-      except:
-        labels_in_tile = {}
 
-    labels_in_tile = self.create_mask(labels_in_tile)
+  def masks_path(self, tile_index):
+    """
+    Returns the path of the masks of tile [tile_index] in the masks store, rasterizing
+    them first if they aren't there (eg: after `compact` renumbered the tiles).
+    """
+    store = self.mask_store()
+    if not store.contains(tile_index, TileEncoder.MaskEncoder.ext):
+      i = self.tile_positions[tile_index]
+      _derive_masks((os.path.join(self.annotations_path, self.annotation_list[i]), tile_index,
+                     self.img_list[i]), store, self.get_img_size(), self.seg_class_indices)
+    return store.file_path(tile_index, TileEncoder.MaskEncoder.ext)
+
+
+  def remove_tiles(self, indices_to_remove):
+    """
+    Removes the tiles of indices_to_remove (see `Dataset.remove_tiles`), and from the
+    splits of a dataset split by index.
+    """
+    super().remove_tiles(indices_to_remove)
+    self.load_splits()
+
+
+  def compact(self):
+    """
+    Renumbers the tiles consecutively (see `Dataset.compact`). The splits of a dataset
+    split by index follow their tiles, whose masks are rasterized again when read.
+    """
+    renumbered = super().compact()
+    self.load_splits()
+    return renumbered
+
+
+  def format_image(self, path_to_file, path_to_dest, img_size=None):
+    """
+    Helper method (eg: for the inference sets of Drone_Dataset) that copies the file
+    from path_to_file, resizes it to IMAGE_SIZE x IMAGE_SIZE x 3 (img_size if given),
+    and saves it in the destination folder. 
+    """
+    write_image(path_to_file, path_to_dest, img_size or self.get_img_size())
 
-    # Add corresponding image name to annotaion
-    labels_in_tile["img"] = img_name
 
-    # save annotation in file
-    with open(path_to_dest, 'w') as dest:
-      json.dump(labels_in_tile, dest)
+  def format_masks(self, path_to_file, dest_dir, index, img_name, img_size=None):
+    """
+    Helper method that takes the labels file at path_to_file and writes its
+    img_size class masks (see `create_mask`) bit-packed to `dest_dir/[index].npz`
+    (see `TileEncoder.MaskEncoder`), with the image name.
+    Returns:
+    The path of the written file.
+    """
+    return write_masks(path_to_file, dest_dir, index, img_name, img_size or self.get_img_size(),
+                       self.seg_class_indices)
 
 
-  def create_mask(self, labels_in_tile):
+  def create_mask(self, labels_in_tile, img_size=None):
     """
-    Helper method only called in convert_json that takes a dictionary of
+    Helper method that takes a dictionary of
       building coordinates and creates a one-hot encoding for each pixel 
-      for an image { "annotation" : [pixel-wise encoding] }
-    Also resizes the mask to IMAGE_SIZE x IMAGE_SIZE before returning the one-hot encoding.
-    Assumes: only one class.
-    Reference: https://stackoverflow.com/questions/21339448/how-to-get-list-of-points-inside-a-polygon-in-python
-    """
-    # Image size of tiles.
-    h, w, _ = self.get_img_size()
-    C = len(self.seg_classes)
-
-    # make a canvas with pixel coordinates
-    x, y = np.meshgrid(np.arange(w), np.arange(h))
-    x, y = x.flatten(), y.flatten()
-    # A list of all pixels in terms of indices
-    all_pix = np.vstack((x, y)).T
-
-    # Single, (C, w*h) 1d array of empty mask for all pixels in image, for each class, initialised
-    # to 0s. This will accumulate annotation markings for each building by ORing the pixels.
-    pixel_annotations = np.zeros((C, h*w), dtype=bool)
-    for super_class, sub_class_labels in labels_in_tile.items():
-      for sub_class, labels in sub_class_labels.items():
-        for label_nodes in labels:
-          
-          one_label_pixels = []
-          if super_class == "highway":
-            # Draw the road as a thick line on a blank mask.
-            label_nodes = [tuple(point) for point in label_nodes]
-            road_mask = Image.fromarray(np.zeros((h, w)).astype(np.uint8))
-            drawer = ImageDraw.Draw(road_mask)
-            drawer.line(label_nodes, fill=1, width=5)
-
-            one_label_pixels = np.array(road_mask).astype(np.bool).flatten()
-
-          elif super_class == "building":
-            # Create a path enclosing the nodes, and then fill in a blank mask for building's mask
-            p = Path(label_nodes)
-            one_label_pixels = p.contains_points(all_pix)
-          else:
-            raise NotImplementedError("Only support roads and buildings currently.")
-
-          # Index of label's class name in list of ordered seg_classes
-          seg_class = self.seg_classes.index(self.get_seg_class_name(super_class, sub_class))
-          pixel_annotations[seg_class] = np.logical_or(pixel_annotations[seg_class], one_label_pixels)
-
-    pixel_annotations = pixel_annotations.astype(np.uint8).reshape((C, h, w))
-
-    return {"annotation": pixel_annotations.tolist()}
+      for an image, as a (C, h, w) uint8 array.
+    The masks are IMAGE_SIZE x IMAGE_SIZE (img_size if given). All the labels of
+    a class are rasterized onto the same mask (see `ImSeg/rasterize.py`): buildings
+    are filled with a scanline fill (the same pixels as `Path.contains_points`),
+    and roads are drawn as lines 5 pixels wide.
+    """
+    h, w, _ = img_size or self.get_img_size()
+    return rasterize_labels(labels_in_tile, self.seg_class_indices, (h, w))
 
   
   def get_data_gen(self, rotate_range=0, flip=False, 
@@ -361,12 +545,8 @@ class ImSeg_Dataset(Dataset):
     Format: (block of images, block of labels)
     """
 
-    # Initialise path based on argument
-    path = self.train_path
-    if set_type.find("val") != -1:
-      path = self.val_path
-    elif set_type.find("test") != -1:
-      path = self.test_path
+    # Initialise split based on argument
+    split = ImSeg_Dataset.split_name(set_type)
 
     # Filter label classes by classes_of_interest
     indices_of_interest = self.indices_of_interest(classes_of_interest)
@@ -374,21 +554,18 @@ class ImSeg_Dataset(Dataset):
     # Accumulators for images and annotations in batch
     images, annotations = [], []
     for i in indices:
-      image = Image.open(os.path.join(path, 'images', f'{i}.jpg'))
-      image = np.array(image)
-
       # Filter out classes we don't want then reshape to (h,w,C) dimensions
       try:
-        with open(os.path.join(path, 'annotations', f'{i}.json'), 'r') as ann:
-          annotation = np.array(json.load(ann)['annotation'])
-          annotation = np.moveaxis(annotation[indices_of_interest], 0, -1)
+        image, annotation = self.read_sample(split, i)
+        annotation = np.moveaxis(annotation[indices_of_interest], 0, -1)
       except FileNotFoundError:
         # Create dummy ground truths for inference tasks.
         if set_type.find("inf") != -1:
+          image = np.array(Image.open(self.sample_files(split, i)[0]))
           h, w, _ = image.shape
           annotation = np.zeros((h, w, len(indices_of_interest)))
         else:
-          raise FileNotFoundError(f"Annotation {i}.json doesn't exist.")
+          raise FileNotFoundError(f"Annotation {i} doesn't exist.")
 
       images.append(image)
       annotations.append(annotation)
@@ -404,13 +581,145 @@ class ImSeg_Dataset(Dataset):
     return images, annotations
 
 
+  @staticmethod
+  def split_name(set_type, default="train"):
+    """
+    Returns the split ("train", "val" or "test") a set_type like "val" or "inf_test"
+    refers to ([default] if it names none).
+    """
+    for split in ["train", "val", "test"]:
+      if set_type.find(split) != -1:
+        return split
+    return default
+
+
+  def sample_files(self, split, i):
+    """
+    Returns the paths of the image and of the class masks of sample i of [split]
+    ("train", "val" or "test"). Samples of a dataset split by index (see `build_dataset`)
+    are tiles in `images/` with their masks in the masks store (rasterized first if they
+    aren't there yet), otherwise they are files of the split's directory.
+    """
+    if self.split_config is None:
+      path = getattr(self, f"{split}_path")
+      return os.path.join(path, 'images', f'{i}.jpg'), ImSeg_Dataset.annotation_path(path, i)
+
+    tile_index = self.split_tiles[split][i]
+    im_path = os.path.join(self.images_path, self.img_list[self.tile_positions[tile_index]])
+    return im_path, self.masks_path(tile_index)
+
+
+  def read_sample(self, split, i):
+    """
+    Helper method only.
+    Reads the image and the (C, h, w) class masks of sample i of [split] (see
+    `sample_files`), from the SampleCache if enabled (see `Dataset.enable_cache`),
+    where the masks are stored bit-packed.
+    Raises FileNotFoundError if the sample has no annotation.
+    """
+    def load():
+      im_path, masks_path = self.sample_files(split, i)
+      if self.split_config is None:
+        image = np.array(Image.open(im_path))
+      else:
+        image = np.array(open_image(im_path, self.get_img_size()))
+      return image, TileEncoder.read_masks(masks_path)
+
+    if self.cache is None:
+      return load()
+    return self.cache.get_or_load(('im_seg', getattr(self, f"{split}_path"), i), load,
+                                  packed=(1,))
+
+
+  @staticmethod
+  def annotation_path(path, i):
+    """
+    Returns the path of the class masks of sample i of the train/val/test directory
+    [path]: `annotations/i.npz`, or `annotations/i.json` for datasets built (and not
+    converted, see `convert_annotations`) before masks were bit-packed.
+    """
+    npz_path = os.path.join(path, 'annotations', f'{i}{TileEncoder.MaskEncoder.ext}')
+    if os.path.exists(npz_path):
+      return npz_path
+    return os.path.join(path, 'annotations', f'{i}.json')
+
+
+  def convert_annotations(self):
+    """
+    Converts the json class masks of the train/val/test directories (written before
+    masks were bit-packed) into `.npz` files in place, and renames them in
+    `path_map.json`. Each json file is only removed once its `.npz` file is written,
+    so an interrupted conversion can be run again.
+    Returns:
+      The number of converted files.
+    """
+    encoder = TileEncoder.MaskEncoder()
+    converted = 0
+    for set_type in ["train", "val", "test"]:
+      ann_dir = os.path.join(getattr(self, f"{set_type}_path"), 'annotations')
+      for name in Dataset.file_names(ann_dir, '.json'):
+        json_path = os.path.join(ann_dir, name)
+        with open(json_path, 'r') as f:
+          annotation = json.load(f)
+        data = encoder.encode(np.array(annotation['annotation'], dtype=np.uint8),
+                              img_name=annotation.get('img'))
+        npz_path = json_path[:-len('.json')] + encoder.ext
+        with open(npz_path + '.tmp', 'wb') as f:
+          f.write(data)
+        os.replace(npz_path + '.tmp', npz_path)
+        os.remove(json_path)
+        converted += 1
+
+    path_map_path = os.path.join(self.im_seg_path, 'path_map.json')
+    if converted and os.path.isfile(path_map_path):
+      with open(path_map_path, 'r') as f:
+        path_map = json.load(f)
+      for paths in path_map.values():
+        paths["annotations"] = {
+          (dest[:-len('.json')] + encoder.ext if dest.endswith('.json') else dest): source
+          for dest, source in paths.get("annotations", {}).items()
+        }
+      with open(path_map_path, 'w') as f:
+        json.dump(path_map, f, indent=2)
+
+    if self.cache is not None:
+      self.cache.clear()
+    return converted
+
+
+  def load_batch(self, indices, set_type, classes_of_interest=[]):
+    """
+    Helper method only. Gets the batch of the list of [indices] of `iter_batches`,
+    the same as `get_batch`.
+    """
+    return self.get_batch(indices, set_type, classes_of_interest=classes_of_interest)
+
+
+  def iter_shard_batches(self, reader, batch_size, set_type, classes_of_interest=[],
+                         shuffle_buffer=0, seed=None, workers=4, prefetch=2, drop_last=True):
+    """
+    Iterates over batches of the shards of a split exported by `TileShards.py --im_seg`,
+    read by the ShardReader [reader] (shuffled by a buffer of [shuffle_buffer] samples),
+    in the format of `get_batch` (and augmented like it).
+    Format: (block of images, block of labels)
+    """
+    decode = functools.partial(TileShards.decode_imseg_batch,
+                               indices_of_interest=self.indices_of_interest(classes_of_interest))
+    for images, annotations in reader.iter_batches(batch_size, decode, shuffle_buffer, seed=seed,
+                                                   workers=workers, prefetch=prefetch,
+                                                   drop_last=drop_last):
+      if self.augment:
+        images, annotations = augment_data(images, annotations, *self.augment)
+      yield images, annotations
+
+
   @staticmethod
   def draw_mask_on_im(im_path, masks):
     """
     Helper method that opens an image, draws the segmentation masks in `masks`
     as bitmaps, and then returns the masked image.\n
     Requires: \n
-      `im_path`: Path to .jpg image \n
+      `im_path`: Path to .jpg image (resized to the masks if needed) \n
       `masks`: Array shaped as: #C x h x w \n
     """
     # Generates an (r, g, b) tuple for each class index
@@ -424,7 +733,9 @@ class ImSeg_Dataset(Dataset):
       return color_choice.get(i % 9)
 
     # Open the image and set up an ImageDraw object
-    im = Image.open(im_path).convert('RGB')
+    im = TileEncoder.open_image(im_path).convert('RGB')
+    if masks.shape[1:] != (im.size[1], im.size[0]):
+      im = im.resize((masks.shape[2], masks.shape[1]), resample=Image.BILINEAR)
     im_draw = ImageDraw.Draw(im)
 
     # Draw the bitmap for each class
@@ -451,18 +762,14 @@ class ImSeg_Dataset(Dataset):
        from which to get annotations. If empty, assumes all classes.\n
       `set_type`: The directory that image_indices corresponds to. (Usually val)\n
     """
-    # Path from where images will be copied
-    path = self.val_path
-    if set_type.find("train") != -1:
-      path = self.train_path
-    elif set_type.find("test") != -1:
-      path = self.test_path
+    # Split from where images will be copied
+    split = ImSeg_Dataset.split_name(set_type, default="val")
     
     indices_of_interest = self.indices_of_interest(classes_of_interest)
     
     # Save the images annotated with their predicted labels
     for i, image_ind in enumerate(image_indices):
-      im_path = os.path.join(path, 'images', f'{image_ind}.jpg')
+      im_path, masks_path = self.sample_files(split, image_ind)
 
       # Reshape from (h, w, #C) to (#C, h, w) dimensions
       pred_masks = batch_preds[i]
@@ -479,11 +786,8 @@ class ImSeg_Dataset(Dataset):
 
       # Save associated image annotated with ground truth masks (if not inference)
       if set_type.find("inf") == -1:
-        with open(os.path.join(path, 'annotations', f'{image_ind}.json')) as f:
-          annotation = json.load(f)
-        annotation = np.array(annotation['annotation'])  # shape (C, h, w)
-
-        gt_masks = annotation[indices_of_interest]
+        # shape (C, h, w)
+        gt_masks = TileEncoder.read_masks(masks_path, channels=indices_of_interest)
         gt_im = ImSeg_Dataset.draw_mask_on_im(im_path, gt_masks)
         gt_im.save(os.path.join(self.preds_path, f'{set_type}_gt_{image_ind}.jpg'))
       
@@ -495,25 +799,16 @@ class ImSeg_Dataset(Dataset):
     Requires:
       index: A valid index in one of train/test/val
     """
-    if directory == "train":
-      path = self.train_path
-    elif directory == "test":
-      path = self.test_path
-    elif directory == "val":
-      path = self.val_path
-    else: raise ValueError("Can only visualize annotations from train/val/test.")
+    if directory not in ["train", "val", "test"]:
+      raise ValueError("Can only visualize annotations from train/val/test.")
 
     # Image visualization
     fig, ax = plt.subplots(nrows=1, ncols=1)
 
-    with open(os.path.join(path, 'annotations', f'{index}.json')) as f:
-      try: annotation = json.load(f)
-      except: annotation = {}
-
-    class_masks = np.array(annotation["annotation"])#.reshape(C, h, w)
+    im_path, masks_path = self.sample_files(directory, index)
+    class_masks = TileEncoder.read_masks(masks_path)
 
     # Draw masks on image
-    im_path = os.path.join(path, 'images', f'{index}.jpg')
     masked_im = ImSeg_Dataset.draw_mask_on_im(im_path, class_masks)
     ax.imshow(masked_im)
     plt.show()
@@ -521,25 +816,36 @@ class ImSeg_Dataset(Dataset):
 
   @staticmethod
   def _combine_datasets(new_data_path, classes_path='classes.json', image_resize=None,
-                        *data_paths):
+                        *data_paths, link=False):
     """
     Create a combined dataset from already created ImSeg_Datasets. \n
     Copies over the `images` and `annotations` directories from given datasets.\n
-    Copies over the `train`, `val` and `test` directories from given datasets.\n
+    Copies over the `train`, `val` and `test` directories from given datasets, or for
+    datasets split by index (see `build_dataset`), their splits and masks store.\n
     Requires:\n
-      new_data_path: Path to directory where combined data will be stored.
+      new_data_path: Path to directory where combined data will be stored.\n
+      link: Hard link the files instead of copying them.
     """
+    datasets = [ImSeg_Dataset(data_path, classes_path=classes_path) for data_path in data_paths]
+    by_index = [ds.split_config is not None for ds in datasets]
+    assert all(by_index) or not any(by_index),\
+      "Datasets split by index can only be combined with each other (build the others first)."
+
     # First copy over image and annotation dirs
-    Dataset._combine_datasets(new_data_path, classes_path, *data_paths)
+    Dataset._combine_datasets(new_data_path, classes_path, *data_paths, link=link)
+    split_path = os.path.join(new_data_path, 'im_seg', 'split.json')
+    if os.path.isfile(split_path):
+      os.remove(split_path)
     
     new_ds = ImSeg_Dataset(new_data_path, classes_path=classes_path)
+    if all(by_index):
+      ImSeg_Dataset._combine_splits(new_ds, datasets, link=link)
+      return
 
     # inds keeps track of file name index for each of train/val/test
     inds = {set_type: {"images":0, "annotations":0} 
             for set_type in ["train", "val", "test"]}
-    for data_path in data_paths:
-      ds = ImSeg_Dataset(data_path, classes_path=classes_path)
-
+    for data_path, ds in zip(data_paths, datasets):
       # Do for each of train/val/test
       for set_type in ["train", "val", "test"]:
         size = ds.data_sizes[set_type]
@@ -547,20 +853,155 @@ class ImSeg_Dataset(Dataset):
 
         # Do for each of images/annotations within train/val/test
         set_path = lambda ds: getattr(ds, f"{set_type}_path")
-        im_ann = {"images":[".jpg", ".jpeg"], "annotations":[".json"]}
+        im_ann = {"images":[".jpg", ".jpeg"], "annotations":list(TileEncoder.MASK_EXTS)}
         for d_type, ext in im_ann.items():
           d_path = os.path.join(set_path(ds), d_type)
           files = Dataset.file_names(d_path, *ext, key=Dataset.sort_key)
 
-          # Iterate through the .jpg/.json files and copy to new train/val/test dir
+          # Iterate through the .jpg/.npz/.json files and copy to new train/val/test dir
           for f in files:
             out_ind = inds[set_type][d_type]
             source_path = os.path.join(d_path, f)
-            dest_path = os.path.join(set_path(new_ds), d_type, f"{out_ind}{ext[0]}")
-            copyfile(source_path, dest_path)
+            # Images are renamed .jpg, masks keep their format.
+            out_ext = ext[0] if d_type == "images" else os.path.splitext(f)[1]
+            dest_path = os.path.join(set_path(new_ds), d_type, f"{out_ind}{out_ext}")
+            Dataset._transfer_file(source_path, dest_path, link=link)
 
             # Update the index for the trian/val/test type
             inds[set_type][d_type] += 1
+
+
+  @staticmethod
+  def _combine_splits(new_ds, datasets, link=False):
+    """
+    Helper method only.
+    Splits the combined dataset [new_ds] by index like the [datasets] it combines (all
+    split by index), whose tiles it holds one after the other (see
+    `Dataset._combine_datasets`), and transfers their masks from their masks stores.
+    """
+    store = new_ds.mask_store()
+    splits = {"train": [], "val": [], "test": []}
+    offset = 0
+    for ds in datasets:
+      len(ds)
+      positions = {tile_index: i for i, tile_index in enumerate(ds.tile_indices)}
+      for set_type, tiles in ds.split_tiles.items():
+        splits[set_type].extend(offset + positions[tile_index] for tile_index in tiles)
+
+      # Masks rasterized the same way keep their files, the others are rasterized again.
+      ds_store = ds.mask_store()
+      if ds_store.config == store.config:
+        for tile_index in ds_store.indices(TileEncoder.MaskEncoder.ext):
+          if tile_index in positions:
+            Dataset._transfer_file(
+              ds_store.file_path(tile_index, TileEncoder.MaskEncoder.ext),
+              store.file_path(offset + positions[tile_index], TileEncoder.MaskEncoder.ext),
+              link=link)
+      offset += len(ds.tile_indices)
+
+    first = datasets[0].split_config
+    new_ds.write_splits(splits, first["train_val_test"], first["seed"])
+
+
+class ImSeg_CombinedDataset(CombinedDataset):
+  """
+  The 'ImSeg_CombinedDataset' class combines several built ImSeg_Datasets for training,
+  without copying their `im_seg/train`, `val` and `test` directories. The splits stay
+  separate: the train (val, test) tiles of the datasets are indexed one after the other,
+  so validating on the combination validates on the val tiles of every dataset.
+
+  It provides the `data_sizes`, `seg_classes` and `get_batch(indices, set_type, ...)`
+  used by the train loop, and draws train batches by the weights of the datasets with
+  `sample_indices(num_samples, set_type)`. Models (checkpoints, metrics, predictions)
+  are stored in the `im_seg/out` directory of the first dataset.
+  """
+
+  def __init__(self, datasets, weights=None):
+    super().__init__(datasets, weights=weights)
+    for ds in datasets[1:]:
+      assert ds.seg_classes == datasets[0].seg_classes,\
+        "Combined datasets must have the same segmentation classes."
+    self.seg_classes = datasets[0].seg_classes
+    self.data_sizes = {set_type: sum(ds.data_sizes[set_type] for ds in datasets)
+                       for set_type in datasets[0].data_sizes}
+
+  def split_offsets(self, set_type):
+    """
+    Returns the cumulative sizes of the [set_type] splits of the datasets.
+    """
+    split = ImSeg_Dataset.split_name(set_type)
+    return self.cumulative_sizes([ds.data_sizes[split] for ds in self.datasets])
+
+  def build_dataset(self):
+    """
+    Builds the ImSeg_Datasets that haven't been built yet.
+    """
+    for ds in self.datasets:
+      if ds.data_sizes["train"] == 0:
+        ds.build_dataset()
+    self.data_sizes = {set_type: sum(ds.data_sizes[set_type] for ds in self.datasets)
+                       for set_type in self.data_sizes}
+
+  def create_model_out_dir(self, model_name):
+    """
+    Creates the model directories (see `ImSeg_Dataset.create_model_out_dir`) in the
+    first dataset.
+    """
+    first = self.datasets[0]
+    first.create_model_out_dir(model_name)
+    self.model_path, self.checkpoint_path = first.model_path, first.checkpoint_path
+    self.metrics_path, self.preds_path = first.metrics_path, first.preds_path
+
+  def sample_indices(self, num_samples, set_type="train", seed=None):
+    """
+    Returns [num_samples] indices of the [set_type] split, drawn from the datasets by
+    their weights (see `CombinedDataset.sample_indices`).
+    """
+    split = ImSeg_Dataset.split_name(set_type)
+    return super().sample_indices(num_samples, [ds.data_sizes[split] for ds in self.datasets],
+                                  seed=seed)
+
+  def get_batch(self, indices, set_type, classes_of_interest=[]):
+    """
+    Returns the batch of images and labels (see `ImSeg_Dataset.get_batch`) of the
+    [indices] of the [set_type] split of the combination, read from each dataset in one
+    batch, in the order of [indices].
+    Format: (block of images, block of labels)
+    """
+    offsets = self.split_offsets(set_type)
+    groups = {}
+    for position, index in enumerate(indices):
+      source, local = self.locate(index, offsets)
+      groups.setdefault(source, []).append((position, local))
+
+    images, annotations = [None] * len(indices), [None] * len(indices)
+    for source, group in groups.items():
+      batch_images, batch_annotations = self.datasets[source].get_batch(
+        [local for _, local in group], set_type, classes_of_interest=classes_of_interest)
+      for (position, _), image, annotation in zip(group, batch_images, batch_annotations):
+        images[position], annotations[position] = image, annotation
+    return np.stack(images), np.stack(annotations)
+
+  def load_batch(self, indices, set_type, classes_of_interest=[]):
+    """
+    Helper method only. Gets the batch of `iter_batches`, the same as `get_batch`.
+    """
+    return self.get_batch(indices, set_type, classes_of_interest=classes_of_interest)
+
+  def visualize_tile(self, index, directory="train"):
+    """
+    Visualizes tile [index] of the [directory] split of the combination.
+    """
+    source, local = self.locate(index, self.split_offsets(directory))
+    self.datasets[source].visualize_tile(local, directory=directory)
+
+  def export(self, new_data_path, classes_path='classes.json', link=True):
+    """
+    Writes the combined datasets, with their train/val/test splits, as one ImSeg dataset
+    in [new_data_path] (see `ImSeg_Dataset._combine_datasets`).
+    """
+    ImSeg_Dataset._combine_datasets(new_data_path, classes_path, None,
+                                    *[ds.data_path for ds in self.datasets], link=link)
       
 
 def passed_arguments():
@@ -578,6 +1019,24 @@ def passed_arguments():
                       nargs='+',
                       default=[0.8, 0.1, 0.1],
                       help='Train/val/test split percentages.')
+  parser.add_argument('--seed',
+                      type=int,
+                      default=0,
+                      help='Seed of the hashes assigning tiles to the train/val/test splits.')
+  parser.add_argument('-w', '--workers',
+                      type=int,
+                      default=None,
+                      help='Number of processes formatting the tiles (all cpus by default).')
+  parser.add_argument('--resplit',
+                      action='store_true',
+                      default=False,
+                      help='Split the built dataset again with --split and --seed, without' +\
+                           ' copying or rasterizing anything.')
+  parser.add_argument('--append',
+                      action='store_true',
+                      default=False,
+                      help='Add the tiles that are not in any split yet (eg: of a new city) to' +\
+                           ' the built dataset, without changing the others.')
   parser.add_argument('-t', '--tile',\
                       action='store_true',
                       default=False,
@@ -587,6 +1046,11 @@ def passed_arguments():
                       type=str,
                       default=None,
                       help='Sequence of data_paths to combine into one new ImSeg dataset.')
+  parser.add_argument('--convert_masks',
+                      action='store_true',
+                      default=False,
+                      help='Convert the json masks of a dataset built before masks were' +\
+                           ' bit-packed into .npz files in place.')
   args = parser.parse_args()
   return args
 
@@ -603,10 +1067,17 @@ if __name__ == "__main__":
   ds = ImSeg_Dataset(args.data_path, args.classes_path, train_val_test=args.split)
 
   # Build dataset.
-  if ds.data_sizes["train"] == 0:
-    ds.build_dataset()
+  if ds.data_sizes["train"] == 0 or (args.resplit and ds.split_config is None):
+    ds.build_dataset(seed=args.seed, workers=args.workers)
+  elif args.resplit:
+    ds.resplit(args.split, args.seed)
+  elif args.append:
+    print(f"Appended {ds.append(workers=args.workers)} tiles")
   print(ds.seg_classes)
 
+  if args.convert_masks:
+    print(f"Converted {ds.convert_annotations()} json masks to .npz")
+
   # Visualize tiles.
   if args.tile:
     inds = random.sample(range(ds.data_sizes["train"]), min(20, ds.data_sizes["train"]))
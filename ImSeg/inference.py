@@ -77,10 +77,10 @@ if __name__ == "__main__":
 
   ## Iterate over dataset.
   data_indices = list(range(num_samples))
-  for batch in range(num_batches):
+  batches = dataset.iter_batches(data_indices[:num_batches*batch_size], batch_size,
+                                 set_type=args.set_type, classes_of_interest=interest_classes)
+  for batch, (imgs, label_masks) in enumerate(batches):
     iter_indices = data_indices[batch*batch_size : (batch+1)*batch_size]
-    imgs, label_masks = dataset.get_batch(iter_indices, args.set_type, 
-                                          classes_of_interest=interest_classes)
 
     # Feed inputs to model
     img_input = np.array(imgs, dtype=np.float32)
@@ -0,0 +1,230 @@
+## Rasterizes the labels of a tile (building polygons and road polylines) into class masks.
+import sys
+sys.path.append('.')
+import time
+import argparse
+import numpy as np
+from PIL import Image, ImageDraw
+from matplotlib.path import Path
+
+# Width in pixels of the roads drawn in the masks.
+ROAD_WIDTH = 5
+
+
+def polygon_spans(polygons, h, w):
+  """
+  Finds the pixels (x, y) with integer coordinates in [0, w) x [0, h) inside each of
+  [polygons] (lists of (x, y) nodes, implicitly closed), as the horizontal spans of a
+  scanline fill of all the polygons at once.
+  Pixels are inside by the even-odd rule, with the same crossing test as
+  `matplotlib.path.Path(nodes).contains_points` (so pixels on an edge are inside or
+  outside exactly as with it), but only the rows and edges of the polygons are visited.
+  Returns:
+    The (rows, starts, ends) int arrays of the spans, each covering the pixels
+    `starts <= x < ends` of a row.
+  """
+  empty = np.zeros(0, dtype=np.int64)
+  # Like matplotlib, paths of fewer than 3 nodes contain no pixel.
+  polygons = [nodes for nodes in polygons if len(nodes) >= 3]
+  if not polygons:
+    return empty, empty, empty
+  lengths = np.array([len(nodes) for nodes in polygons])
+  nodes = np.concatenate([np.asarray(nodes, dtype=np.float64).reshape(-1, 2)
+                          for nodes in polygons])
+  polygon_of_node = np.repeat(np.arange(len(polygons)), lengths)
+
+  # Edge k goes from node k-1 to node k, and the first node of a polygon closes it.
+  previous = np.arange(len(nodes)) - 1
+  starts = np.cumsum(lengths) - lengths
+  previous[starts] = starts + lengths - 1
+  x0, y0 = nodes[previous, 0], nodes[previous, 1]
+  x1, y1 = nodes[:, 0], nodes[:, 1]
+
+  # An edge crosses row y if one of its nodes has y' >= y and the other doesn't.
+  with np.errstate(invalid='ignore'):
+    lo = np.maximum(np.floor(np.minimum(y0, y1)) + 1, 0)
+    hi = np.minimum(np.floor(np.maximum(y0, y1)), h - 1)
+    counts = np.where(np.isfinite(lo) & np.isfinite(hi), np.maximum(hi - lo + 1, 0), 0)
+  counts = counts.astype(np.int64)
+  if not counts.sum():
+    return empty, empty, empty
+  edges = np.repeat(np.arange(len(nodes)), counts)
+  rows = lo[edges].astype(np.int64) + np.arange(len(edges)) - np.repeat(np.cumsum(counts) - counts, counts)
+  x0, y0, x1, y1 = x0[edges], y0[edges], x1[edges], y1[edges]
+  ty = rows.astype(np.float64)
+
+  # The crossing of an edge toggles the pixels (x, y) of the row with x <= last, where
+  # last is found with the exact comparison of matplotlib's point_in_path.
+  def toggles(tx):
+    return ((y1 - ty) * (x0 - x1) >= (x1 - tx) * (y0 - y1)) == (y1 >= ty)
+  crossing = np.floor(x1 + (ty - y1) * (x0 - x1) / (y0 - y1))
+  last = np.where(toggles(crossing + 1), crossing + 1,
+                  np.where(toggles(crossing), crossing, crossing - 1))
+  last = np.clip(last, -1, w - 1).astype(np.int64)
+
+  # Each row of a polygon crosses an even number of its edges: pixels toggled an odd
+  # number of times are the ones after the 1st crossing up to the 2nd, after the 3rd
+  # up to the 4th, ...
+  order = np.lexsort((last, rows, polygon_of_node[edges]))
+  rows, last = rows[order], last[order]
+  starts, ends = last[0::2] + 1, last[1::2] + 1
+  keep = starts < ends
+  return rows[0::2][keep], starts[keep], ends[keep]
+
+
+def fill_polygons(canvas, polygons):
+  """
+  Sets the pixels of the boolean (h, w) [canvas] inside any of [polygons] (lists of
+  (x, y) nodes) to True (see `polygon_spans`).
+  """
+  h, w = canvas.shape
+  rows, starts, ends = polygon_spans(polygons, h, w)
+  # Flat indices of the pixels of all the spans.
+  lengths = ends - starts
+  span_of_pixel = np.repeat(np.arange(len(rows)), lengths)
+  offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+  canvas.reshape(-1)[rows[span_of_pixel] * w + starts[span_of_pixel] + offsets] = True
+  return canvas
+
+
+def draw_polylines(canvas, lines, width=ROAD_WIDTH):
+  """
+  Sets the pixels of the boolean (h, w) [canvas] on any of [lines] (lists of (x, y)
+  nodes) drawn [width] pixels wide to True, drawing all of them on one PIL canvas.
+  """
+  h, w = canvas.shape
+  lines_mask = Image.new('L', (w, h))
+  drawer = ImageDraw.Draw(lines_mask)
+  for nodes in lines:
+    drawer.line([tuple(point) for point in nodes], fill=1, width=width)
+  canvas |= np.asarray(lines_mask, dtype=bool)
+  return canvas
+
+
+def rasterize_labels(labels_in_tile, class_indices, img_size):
+  """
+  Rasterizes the labels of a tile into one mask per class, drawing all the labels of
+  a class on the same canvas: buildings are filled polygons, and roads ("highway")
+  are lines ROAD_WIDTH pixels wide.
+  Requires:
+    labels_in_tile: dictionary of super_class -> sub_class -> list of labels (lists
+                    of (x, y) nodes in pixels of the tile)\n
+    class_indices: dictionary of (super_class, sub_class) -> index of its mask\n
+    img_size: (h, w) of the masks\n
+  Returns:
+    The (C, h, w) uint8 array of masks, with C the number of class indices.
+  """
+  h, w = img_size[:2]
+  masks = np.zeros((len(class_indices), h, w), dtype=bool)
+  for super_class, sub_class_labels in labels_in_tile.items():
+    for sub_class, labels in sub_class_labels.items():
+      if not labels:
+        continue
+      mask = masks[class_indices[(super_class, sub_class)]]
+      if super_class == "highway":
+        draw_polylines(mask, labels)
+      elif super_class == "building":
+        fill_polygons(mask, labels)
+      else:
+        raise NotImplementedError("Only support roads and buildings currently.")
+  return masks.astype(np.uint8)
+
+
+def reference_masks(labels_in_tile, class_indices, img_size):
+  """
+  Rasterizes the labels of a tile like `rasterize_labels`, testing every pixel against
+  every building with `Path.contains_points` and drawing every road on its own canvas
+  (the implementation `rasterize_labels` replaced, kept to check and benchmark it).
+  """
+  h, w = img_size[:2]
+  x, y = np.meshgrid(np.arange(w), np.arange(h))
+  all_pix = np.vstack((x.flatten(), y.flatten())).T
+
+  masks = np.zeros((len(class_indices), h*w), dtype=bool)
+  for super_class, sub_class_labels in labels_in_tile.items():
+    for sub_class, labels in sub_class_labels.items():
+      for label_nodes in labels:
+        if super_class == "highway":
+          road_mask = Image.fromarray(np.zeros((h, w)).astype(np.uint8))
+          drawer = ImageDraw.Draw(road_mask)
+          drawer.line([tuple(point) for point in label_nodes], fill=1, width=ROAD_WIDTH)
+          one_label_pixels = np.array(road_mask).astype(bool).flatten()
+        elif super_class == "building":
+          one_label_pixels = Path(label_nodes).contains_points(all_pix)
+        else:
+          raise NotImplementedError("Only support roads and buildings currently.")
+        seg_class = class_indices[(super_class, sub_class)]
+        masks[seg_class] = np.logical_or(masks[seg_class], one_label_pixels)
+  return masks.astype(np.uint8).reshape((len(class_indices), h, w))
+
+
+def benchmark(ds, num_tiles=100):
+  """
+  Rasterizes the labels of the first [num_tiles] tiles of Dataset [ds] with
+  `rasterize_labels` and `reference_masks`, and checks that the masks are the same.
+  Returns:
+    A dictionary of the number of tiles and labels, the seconds taken by each
+    implementation, and the number of tiles (and pixels) whose masks differ.
+  """
+  # Masks are in the order of the seg classes of ImSeg_Dataset.
+  class_names = sorted((super_class, sub_class) for super_class, sub_classes in ds.classes.items()
+                       for sub_class in sub_classes)
+  class_indices = {name: i for i, name in enumerate(sorted(class_names, key=':'.join))}
+  img_size = ds.get_img_size()
+
+  results = {'tiles': 0, 'labels': 0, 'scanline_seconds': 0.0, 'reference_seconds': 0.0,
+             'different_tiles': 0, 'different_pixels': 0}
+  for i in range(min(num_tiles, len(ds))):
+    _, labels_in_tile = ds.get_tile_and_label(i)
+    # Only the classes of the dataset are rasterized.
+    labels_in_tile = {super_class: {sub_class: labels
+                                    for sub_class, labels in sub_class_labels.items()
+                                    if (super_class, sub_class) in class_indices}
+                      for super_class, sub_class_labels in labels_in_tile.items()}
+
+    start = time.time()
+    masks = rasterize_labels(labels_in_tile, class_indices, img_size)
+    results['scanline_seconds'] += time.time() - start
+    start = time.time()
+    expected = reference_masks(labels_in_tile, class_indices, img_size)
+    results['reference_seconds'] += time.time() - start
+
+    different = int(np.count_nonzero(masks != expected))
+    results['tiles'] += 1
+    results['labels'] += sum(len(labels) for sub_class_labels in labels_in_tile.values()
+                             for labels in sub_class_labels.values())
+    results['different_tiles'] += int(different > 0)
+    results['different_pixels'] += different
+  return results
+
+
+def passed_arguments():
+  parser = argparse.ArgumentParser(
+    description="Script to benchmark the scanline rasterization of the masks against the" +\
+                " previous implementation.")
+  parser.add_argument('-d', '--data_path',
+                      type=str,
+                      required=True,
+                      help='Path to directory where extracted dataset is stored.')
+  parser.add_argument('-c', '--classes_path',
+                      type=str,
+                      default='classes.json',
+                      help='Path to .json file denoting classes of labels used in dataset.')
+  parser.add_argument('-n', '--num_tiles',
+                      type=int,
+                      default=100,
+                      help='Number of tiles to rasterize.')
+  args = parser.parse_args()
+  return args
+
+
+if __name__ == "__main__":
+  from Dataset import Dataset
+  args = passed_arguments()
+  results = benchmark(Dataset(args.data_path, classes_path=args.classes_path), args.num_tiles)
+  print(f"{results['tiles']} tiles, {results['labels']} labels")
+  for name in ['scanline', 'reference']:
+    seconds = results[f'{name}_seconds']
+    print(f"{name}: {seconds:.3f}s ({1000 * seconds / max(1, results['tiles']):.2f}ms per tile)")
+  print(f"Speedup: {results['reference_seconds'] / max(results['scanline_seconds'], 1e-9):.1f}x")
+  print(f"Different masks: {results['different_tiles']} tiles, {results['different_pixels']} pixels")
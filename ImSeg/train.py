@@ -2,8 +2,9 @@ import sys
 sys.path.append('.')
 import json
 import ImSeg.refine_net as refine_net
-from ImSeg.ImSeg_Dataset import ImSeg_Dataset
+from ImSeg.ImSeg_Dataset import ImSeg_Dataset, ImSeg_CombinedDataset
 from ImSeg.segmentation import load_model, save_model
+from TileShards import ShardReader
 
 import os
 import logging
@@ -30,6 +31,41 @@ def passed_arguments():
                       type=str,
                       default='./classes.json',
                       help='Path to directory where extracted dataset is stored.')
+  parser.add_argument('--combine',
+                      nargs='+',
+                      type=str,
+                      default=None,
+                      help='(Optional) paths to more datasets to train on together with' +\
+                           ' data_path, without copying them.')
+  parser.add_argument('--weights',
+                      nargs='+',
+                      type=float,
+                      default=None,
+                      help='(Optional) weights to sample training tiles from data_path and' +\
+                           ' the --combine datasets by (proportional to their sizes by default).')
+  parser.add_argument('--shards',
+                      type=str,
+                      default=None,
+                      help='(Optional) directory of the train/ and val/ shards exported by' +\
+                           ' TileShards.py --im_seg, read instead of the im_seg directories.')
+  parser.add_argument('--shuffle_buffer',
+                      type=int,
+                      default=1000,
+                      help='Number of samples in the shuffle buffer when reading --shards.')
+  parser.add_argument('--cache_mb',
+                      type=float,
+                      default=0,
+                      help='(Optional) MB of memory to cache decoded images and masks in' +\
+                           ' across epochs (no cache by default).')
+  parser.add_argument('--spill_path',
+                      type=str,
+                      default=None,
+                      help='(Optional) path of a local file samples evicted from the cache' +\
+                           ' spill to.')
+  parser.add_argument('--spill_mb',
+                      type=float,
+                      default=0,
+                      help='Size in MB of the --spill_path file.')
   args = parser.parse_args()
   return args
 
@@ -175,11 +211,28 @@ if __name__ == "__main__":
   augment_kwargs = config.get("augment", {})
 
   ## Set up dataset, number of train/val samples, number of batches and interested classes.
-  dataset = ImSeg_Dataset(data_path=args.data_path, classes_path=args.classes_path,
-                          augment_kwargs=augment_kwargs)
-  if dataset.data_sizes["train"] == 0 or dataset.data_sizes["val"] == 0:
-    dataset.build_dataset()
-  num_train, num_val = dataset.data_sizes["train"], dataset.data_sizes["val"]
+  if args.combine:
+    dataset = ImSeg_CombinedDataset.from_paths([args.data_path] + args.combine,
+                                               classes_path=args.classes_path,
+                                               weights=args.weights,
+                                               dataset_class=ImSeg_Dataset,
+                                               augment_kwargs=augment_kwargs)
+  else:
+    dataset = ImSeg_Dataset(data_path=args.data_path, classes_path=args.classes_path,
+                            augment_kwargs=augment_kwargs)
+  if args.shards:
+    assert not args.combine, "Can't combine datasets when training from shards."
+    shard_readers = {phase: ShardReader(os.path.join(args.shards, phase))
+                     for phase in ["train", "val"]}
+    num_train, num_val = len(shard_readers["train"]), len(shard_readers["val"])
+  else:
+    if dataset.data_sizes["train"] == 0 or dataset.data_sizes["val"] == 0:
+      dataset.build_dataset()
+    num_train, num_val = dataset.data_sizes["train"], dataset.data_sizes["val"]
+  cache = None
+  if args.cache_mb:
+    cache = dataset.enable_cache(int(args.cache_mb * 2**20), spill_path=args.spill_path,
+                                 spill_bytes=int(args.spill_mb * 2**20))
   num_train_batches, num_val_batches = num_train//batch_size, num_val//batch_size
   config["classes"] = dataset.seg_classes if not config["classes"] else config["classes"]
   interest_classes = config["classes"]
@@ -215,6 +268,10 @@ if __name__ == "__main__":
     train_indices, val_indices = list(range(num_train)), list(range(num_val))
     np.random.shuffle(train_indices)
     np.random.shuffle(val_indices)
+
+    # Draw the training tiles of combined datasets by the weights of the datasets.
+    if args.combine:
+      train_indices = dataset.sample_indices(num_train, "train")
     
     # Alternate between training and validation epochs.
     for phase in ["train", "val"]:
@@ -235,11 +292,16 @@ if __name__ == "__main__":
       epoch_prec = tf.keras.metrics.MeanTensor()
       epoch_recall = tf.keras.metrics.MeanTensor()
 
-      # Actual train/val over all batches.
-      for batch in range(num_batches):
-        img_input, label_masks =\
-          dataset.get_batch(indices[batch*batch_size : (batch+1)*batch_size], phase,
-                            classes_of_interest=interest_classes)
+      # Actual train/val over all batches, the next batches being loaded in the background.
+      if args.shards:
+        shuffle_buffer = args.shuffle_buffer if phase == "train" else 0
+        batches = dataset.iter_shard_batches(shard_readers[phase], batch_size, phase,
+                                             classes_of_interest=interest_classes,
+                                             shuffle_buffer=shuffle_buffer)
+      else:
+        batches = dataset.iter_batches(indices[:num_batches*batch_size], batch_size,
+                                       set_type=phase, classes_of_interest=interest_classes)
+      for img_input, label_masks in batches:
         
         # Feed inputs to model
         img_input = np.array(img_input, dtype=np.float32)
@@ -291,4 +353,11 @@ if __name__ == "__main__":
       epoch_prec.reset_states()
       epoch_recall.reset_states()
 
+    if cache is not None:
+      stats = cache.stats()
+      print(f"Sample cache: hit rate {stats['hit_rate']:.1%}, {stats['samples']} samples" +\
+            f" ({stats['bytes'] / 2**20:.0f} MB) in memory, {stats['spilled_samples']} spilled" +\
+            f" ({stats['spilled_bytes'] / 2**20:.0f} MB)")
+      logging.info(f"Epoch {epoch+1}, sample cache: {stats}")
+
     print("\n")
@@ -0,0 +1,346 @@
+## LabelStore keeps OSM labels in a compact columnar (CSR-style) format.
+import json
+import math
+import struct
+import zipfile
+import numpy as np
+
+
+class LabelStore:
+  """
+  The 'LabelStore' class holds every labelled OSM way of an area as flat arrays
+  instead of nested lists of tuples.
+
+  Attributes:\n
+  1) `classes`: ordered dictionary of super_class -> [sub_class, ..., "other"].\n
+  2) `nodes`: (N, 2) array of all node coordinates, either (lat, lon) as returned by
+     OSM or (pixel_x, pixel_y) once projected onto an image.\n
+  3) `offsets`: (W+1,) array, the nodes of way `i` are `nodes[offsets[i]:offsets[i+1]]`.\n
+  4) `super_ids`: (W,) index of each way's super class in `classes`.\n
+  5) `class_ids`: (W,) index of each way's sub class in its super class' sub class list.\n
+  6) `way_ids`: (W,) OSM id of each way.\n
+  """
+
+  def __init__(self, classes, nodes=None, offsets=None, super_ids=None,
+               class_ids=None, way_ids=None):
+    self.classes = {super_class: list(sub_classes)
+                    for super_class, sub_classes in classes.items()}
+    self.super_classes = list(self.classes)
+
+    self.nodes = nodes if nodes is not None else np.zeros((0, 2))
+    self.offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+    self.super_ids = super_ids if super_ids is not None else np.zeros(0, dtype=np.int32)
+    self.class_ids = class_ids if class_ids is not None else np.zeros(0, dtype=np.int32)
+    self.way_ids = way_ids if way_ids is not None else np.zeros(0, dtype=np.int64)
+
+    # Path of the .npz file this store was last saved to or loaded from.
+    self.path = None
+
+  @staticmethod
+  def with_other(classes):
+    """
+    Returns the classes dictionary with the "other" sub class added to each super class.
+    """
+    return {super_class: list(sub_classes) + ["other"]
+            for super_class, sub_classes in classes.items()}
+
+  @staticmethod
+  def from_ways(classes, ways, dtype=np.float64):
+    """
+    Builds a LabelStore from an iterable of ways.
+    Requires:
+      classes: dictionary of super_class -> [sub_class, ...] (including "other")\n
+      ways: iterable of (super_class, sub_class, way_id, [(c0, c1), ...]) tuples\n
+    """
+    store = LabelStore(classes)
+    lengths, super_ids, class_ids, way_ids, nodes = [], [], [], [], []
+    for super_class, sub_class, way_id, points in ways:
+      if not points:
+        continue
+      super_id = store.super_classes.index(super_class)
+      lengths.append(len(points))
+      super_ids.append(super_id)
+      class_ids.append(store.classes[super_class].index(sub_class))
+      way_ids.append(way_id)
+      nodes.extend(points)
+
+    store.nodes = np.array(nodes, dtype=dtype).reshape(-1, 2)
+    store.offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]).astype(np.int64)
+    store.super_ids = np.array(super_ids, dtype=np.int32)
+    store.class_ids = np.array(class_ids, dtype=np.int32)
+    store.way_ids = np.array(way_ids, dtype=np.int64)
+    return store
+
+  @staticmethod
+  def from_dict(label_coords):
+    """
+    Builds a LabelStore from the nested {super_class: {sub_class: [way, ...]}} format
+    (eg: the legacy `annotations.pkl` files).
+    """
+    classes = {super_class: list(sub_class_labels)
+               for super_class, sub_class_labels in label_coords.items()}
+    ways = ((super_class, sub_class, -1, way)
+            for super_class, sub_class_labels in label_coords.items()
+            for sub_class, labels in sub_class_labels.items()
+            for way in labels)
+    return LabelStore.from_ways(classes, ways, dtype=None)
+
+  @staticmethod
+  def concatenate(classes, stores):
+    """
+    Concatenates the ways of `stores` (in order) into one LabelStore with `classes`.
+    The super and sub class names used by each store must exist in `classes`.
+    """
+    result = LabelStore(classes)
+    stores = [store for store in stores if len(store)]
+    if not stores:
+      return result
+
+    super_ids, class_ids = [], []
+    for store in stores:
+      # Map the store's super/sub class ids to ids in `classes` by name.
+      store_super_ids = np.asarray(store.super_ids)
+      store_class_ids = np.asarray(store.class_ids)
+      new_super_ids = np.empty(len(store), dtype=np.int32)
+      new_class_ids = np.empty(len(store), dtype=np.int32)
+      for super_id, super_class in enumerate(store.super_classes):
+        ways = store_super_ids == super_id
+        class_map = np.array([result.classes[super_class].index(sub_class)
+                              for sub_class in store.classes[super_class]], dtype=np.int32)
+        new_super_ids[ways] = result.super_classes.index(super_class)
+        new_class_ids[ways] = class_map[store_class_ids[ways]]
+      super_ids.append(new_super_ids)
+      class_ids.append(new_class_ids)
+
+    lengths = np.concatenate([np.diff(store.offsets) for store in stores])
+    result.nodes = np.concatenate([store.nodes for store in stores])
+    result.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    result.super_ids = np.concatenate(super_ids)
+    result.class_ids = np.concatenate(class_ids)
+    result.way_ids = np.concatenate([store.way_ids for store in stores]).astype(np.int64)
+    return result
+
+  def __len__(self):
+    return len(self.super_ids)
+
+  def way(self, i):
+    """
+    Returns the (n, 2) node array of way `i` (a view into `nodes`).
+    """
+    return self.nodes[self.offsets[i]:self.offsets[i+1]]
+
+  def class_names(self, i):
+    """
+    Returns (super_class, sub_class) of way `i`.
+    """
+    super_class = self.super_classes[self.super_ids[i]]
+    return super_class, self.classes[super_class][self.class_ids[i]]
+
+  def take(self, indices):
+    """
+    Returns a new LabelStore with only the ways at `indices` (in that order).
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    starts = self.offsets[:-1][indices]
+    lengths = np.diff(self.offsets)[indices]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    # Index of every node of the selected ways in self.nodes
+    node_inds = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+    return LabelStore(self.classes, self.nodes[node_inds], offsets,
+                      self.super_ids[indices], self.class_ids[indices], self.way_ids[indices])
+
+  def unique_ways(self):
+    """
+    Returns a new LabelStore where each (super class, way id) pair only appears once,
+    with ways sorted by super class and then by way id (as Overpass returns them).
+    """
+    order = np.lexsort((self.way_ids, self.super_ids))
+    super_ids, way_ids = self.super_ids[order], self.way_ids[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (super_ids[1:] != super_ids[:-1]) | (way_ids[1:] != way_ids[:-1])
+    return self.take(order[first])
+
+  def extents(self):
+    """
+    Returns the per-way (min_c0, min_c1) and (max_c0, max_c1) arrays, each shaped (W, 2).
+    """
+    if not len(self):
+      return np.zeros((0, 2)), np.zeros((0, 2))
+    starts = self.offsets[:-1]
+    return np.minimum.reduceat(self.nodes, starts), np.maximum.reduceat(self.nodes, starts)
+
+  def to_dict(self):
+    """
+    Returns the labels in the nested format
+    {super_class: {sub_class: [[node1, node2, ...], ...]}}
+    """
+    label_coords = {super_class: {sub_class: [] for sub_class in sub_classes}
+                    for super_class, sub_classes in self.classes.items()}
+    for i in range(len(self)):
+      super_class, sub_class = self.class_names(i)
+      label_coords[super_class][sub_class].append(self.way(i).tolist())
+    return label_coords
+
+  def to_pixels(self, coords, im_size):
+    """
+    Returns a new LabelStore with (lat, lon) nodes projected to integer pixel
+    coordinates (pixel_x, pixel_y) relative to the image.
+    Requires:
+      `coords` is is in [LAT_MIN, LON_MIN, LAT_MAX, LON_MAX] format \n
+      `im_size` is the shape of the entire image numpy array as (h, w, ...) \n
+    """
+    lat_min, lon_min, lat_max, lon_max = coords
+    width = lon_max - lon_min # width in longitude of image
+    height = lat_max - lat_min # height in latitude of image
+
+    lat, lon = self.nodes[:, 0], self.nodes[:, 1]
+    pixels = np.empty(self.nodes.shape, dtype=np.int64)
+    pixels[:, 0] = np.floor(((lon-lon_min)/width)*im_size[1])
+    pixels[:, 1] = np.floor(((lat_max-lat)/height)*im_size[0])
+
+    return LabelStore(self.classes, pixels, self.offsets,
+                      self.super_ids, self.class_ids, self.way_ids)
+
+  def save(self, path):
+    """
+    Saves the store as a single uncompressed `.npz` file, so that it can later be
+    memory-mapped by `LabelStore.load`.
+    """
+    np.savez(path,
+             classes=np.array(json.dumps(self.classes)),
+             nodes=self.nodes,
+             offsets=self.offsets,
+             super_ids=self.super_ids,
+             class_ids=self.class_ids,
+             way_ids=self.way_ids)
+    self.path = path if path.endswith('.npz') else path + '.npz'
+
+  @staticmethod
+  def load(path, mmap=True):
+    """
+    Loads a LabelStore saved with `save`. If `mmap`, the arrays are memory-mapped
+    from the `.npz` file instead of being read into memory.
+    """
+    with np.load(path) as npz:
+      classes = json.loads(str(npz['classes']))
+      if not mmap:
+        arrays = {k: npz[k] for k in npz.files if k != 'classes'}
+    if mmap:
+      arrays = LabelStore._mmap_npz(path)
+    store = LabelStore(classes, arrays['nodes'], arrays['offsets'], arrays['super_ids'],
+                       arrays['class_ids'], arrays['way_ids'])
+    store.path = path
+    return store
+
+  @staticmethod
+  def _mmap_npz(path):
+    """
+    Helper method only.
+    Memory-maps each numeric array stored (uncompressed) in the `.npz` file at `path`.
+    Compressed or non-numeric members are read into memory instead.
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+      for info in zf.infolist():
+        name = info.filename[:-len('.npy')]
+        if info.compress_type != zipfile.ZIP_STORED:
+          with zf.open(info) as member:
+            arrays[name] = np.lib.format.read_array(member)
+          continue
+
+        # Skip the zip local file header to find the start of the .npy data.
+        f.seek(info.header_offset)
+        header = f.read(30)
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+          shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+          shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+        if dtype.hasobject or dtype.kind == 'U' or 0 in shape or shape == ():
+          with zf.open(info) as member:
+            arrays[name] = np.lib.format.read_array(member)
+        else:
+          arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(),
+                                   shape=shape, order='F' if fortran_order else 'C')
+    return arrays
+
+
+class LabelIndex:
+  """
+  Grid bucket index over the pixel extents of every way in a `LabelStore`.
+  It is built once per area, so that each tile only checks the labels whose
+  bounding boxes overlap it instead of every label in the area.
+
+  Requires:
+  `label_store` is a LabelStore in pixels not in lat,lon \n
+  `cell_size` is the side (in pixels) of each grid cell, usually the tile size.\n
+  """
+  def __init__(self, label_store, cell_size):
+    self.cell_size = float(cell_size)
+    self.store = label_store
+
+    # Pixel extents of each label as (x, y) mins and maxs.
+    n = len(label_store)
+    self.mins, self.maxs = label_store.extents()
+
+    # Grid cells covered by each label's extent.
+    lo = np.floor(self.mins / self.cell_size).astype(np.int64)
+    hi = np.floor(self.maxs / self.cell_size).astype(np.int64)
+    self.cell_min = lo.min(axis=0) if n else np.zeros(2, dtype=np.int64)
+    self.cell_max = hi.max(axis=0) if n else np.zeros(2, dtype=np.int64)
+    self.n_cols = int(self.cell_max[0] - self.cell_min[0]) + 1
+
+    # One (cell, label) entry for every cell a label covers.
+    span = hi - lo + 1
+    counts = span[:, 0] * span[:, 1]
+    ids = np.repeat(np.arange(n), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cell_x = lo[ids, 0] + k % span[ids, 0]
+    cell_y = lo[ids, 1] + k // span[ids, 0]
+
+    # Sort entries by cell key, so each row of cells is a contiguous slice.
+    cell_keys = self._cell_key(cell_x, cell_y)
+    order = np.argsort(cell_keys, kind='stable')
+    self.cell_keys, self.cell_ids = cell_keys[order], ids[order]
+
+  def __len__(self):
+    return len(self.store)
+
+  def _cell_key(self, cell_x, cell_y):
+    return (cell_y - self.cell_min[1]) * self.n_cols + (cell_x - self.cell_min[0])
+
+  def query(self, tile_range):
+    """
+    Returns the sorted indices of the labels whose extents overlap `tile_range`.
+    Requires:
+    `tile_range` is a list in the format `[col_start, col_end, row_start, row_end]`\n
+    """
+    col_start, col_end, row_start, row_end = tile_range
+    if not len(self):
+      return np.zeros(0, dtype=np.int64)
+
+    # Range of grid cells touched by the tile, clipped to the occupied grid.
+    cx0 = max(math.floor(col_start / self.cell_size), self.cell_min[0])
+    cx1 = min(math.floor(col_end / self.cell_size), self.cell_max[0])
+    cy0 = max(math.floor(row_start / self.cell_size), self.cell_min[1])
+    cy1 = min(math.floor(row_end / self.cell_size), self.cell_max[1])
+    if cx0 > cx1 or cy0 > cy1:
+      return np.zeros(0, dtype=np.int64)
+
+    candidates = []
+    for cell_y in range(cy0, cy1 + 1):
+      lo = np.searchsorted(self.cell_keys, self._cell_key(cx0, cell_y), side='left')
+      hi = np.searchsorted(self.cell_keys, self._cell_key(cx1, cell_y), side='right')
+      candidates.append(self.cell_ids[lo:hi])
+    candidates = np.unique(np.concatenate(candidates))
+
+    # Keep only labels whose extent actually overlaps the tile.
+    mins, maxs = self.mins[candidates], self.maxs[candidates]
+    overlaps = (mins[:, 0] < col_end) & (maxs[:, 0] >= col_start) &\
+               (mins[:, 1] < row_end) & (maxs[:, 1] >= row_start)
+    return candidates[overlaps]
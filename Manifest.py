@@ -0,0 +1,184 @@
+## Manifest records the completed stages of a dataset build, so that reruns can resume.
+import os
+import json
+import hashlib
+
+
+class Manifest:
+  """
+  The 'Manifest' class records which stages of `DataPipeline.create_dataset` are done
+  in `raw_data/manifest.json`, so that a rerun after a failure skips finished work.
+
+  Each stage (eg: "raster", "osm", "projected") is recorded with a key of its inputs
+  and the sha256 hash, size and modification time of each of its output files. A stage
+  is only done if its inputs are unchanged and its outputs still match their hashes.
+  Later stages include the output hashes of earlier ones in their keys, so redoing a
+  stage makes everything depending on it stale.
+
+  Written tiles are appended to `raw_data/tiles_manifest.jsonl` one row of tiles at a
+  time (rewriting the whole manifest for each tile would be too slow).
+  """
+
+  def __init__(self, raw_data_path):
+    self.path = os.path.join(raw_data_path, 'manifest.json')
+    self.tiles_path = os.path.join(raw_data_path, 'tiles_manifest.jsonl')
+    self.stages = {}
+    if os.path.isfile(self.path):
+      with open(self.path, 'r') as f:
+        self.stages = json.load(f)
+
+  @staticmethod
+  def key(*inputs):
+    """
+    Returns the hex digest identifying json serialisable `inputs` of a stage.
+    """
+    content = json.dumps(inputs, sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+  @staticmethod
+  def hash_file(path, chunk_size=1 << 20):
+    """
+    Returns the sha256 hex digest of the contents of the file at `path`.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(chunk_size), b''):
+        sha.update(chunk)
+    return sha.hexdigest()
+
+  @staticmethod
+  def file_record(path, sha256=None):
+    """
+    Returns the record of the file at `path`: its sha256 hash (computed unless given),
+    size and modification time.
+    """
+    stat = os.stat(path)
+    return {
+      'sha256': sha256 or Manifest.hash_file(path),
+      'size': stat.st_size,
+      'mtime': stat.st_mtime_ns
+    }
+
+  @staticmethod
+  def matches(record, path):
+    """
+    Returns whether the file at `path` still matches its `record`. Files with the
+    recorded size and modification time are assumed unchanged, others are rehashed.
+    """
+    try:
+      stat = os.stat(path)
+    except FileNotFoundError:
+      return False
+    if stat.st_size != record['size']:
+      return False
+    return stat.st_mtime_ns == record['mtime'] or Manifest.hash_file(path) == record['sha256']
+
+  def _save(self):
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(self.stages, f, indent=2)
+    os.replace(tmp_path, self.path)
+
+  def is_done(self, stage, key):
+    """
+    Returns whether `stage` was completed with inputs `key` and its outputs are unchanged.
+    """
+    entry = self.stages.get(stage)
+    if not entry or entry['key'] != key or not entry.get('done', True):
+      return False
+    return all(Manifest.matches(record, os.path.join(os.path.dirname(self.path), name))
+               for name, record in entry['files'].items())
+
+  def complete(self, stage, key, *paths):
+    """
+    Records that `stage` was completed with inputs `key`, producing the files at `paths`
+    (which must be in the same directory as the manifest).
+    """
+    self.stages[stage] = {
+      'key': key,
+      'files': {os.path.basename(path): Manifest.file_record(path) for path in paths}
+    }
+    self._save()
+
+  def output_hash(self, stage):
+    """
+    Returns a hash of all the outputs of the completed `stage`.
+    """
+    files = self.stages[stage]['files']
+    return Manifest.key(*[files[name]['sha256'] for name in sorted(files)])
+
+  def start_tiles(self, key):
+    """
+    Starts (or resumes) the tiling stage with inputs `key`. If the inputs changed
+    since the last run, the record of written tiles is discarded.
+    """
+    entry = self.stages.get('tiles')
+    if not entry or entry['key'] != key:
+      self.stages['tiles'] = {'key': key, 'files': {}, 'done': False}
+      self._save()
+      open(self.tiles_path, 'w').close()
+
+  def valid_tiles(self, ds, num_tiles):
+    """
+    Returns the set of tile indices (below `num_tiles`) whose image and annotation
+    files in Dataset `ds` are recorded as written by the current tiling stage and
+    are unchanged since.
+    """
+    return set(self.valid_tile_records(ds, num_tiles))
+
+  def valid_tile_records(self, ds, num_tiles):
+    """
+    Returns the dictionary of tile index -> record of the tiles of `valid_tiles`.
+    """
+    if not os.path.isfile(self.tiles_path):
+      return {}
+
+    # Later records of the same tile replace earlier ones.
+    records = {}
+    with open(self.tiles_path, 'r') as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          # Partly written last line of an interrupted run.
+          continue
+        records[record['index']] = record
+
+    valid = {}
+    for index, record in records.items():
+      if index >= num_tiles:
+        continue
+      img_path = os.path.join(ds.images_path, record.get('image_file', f'{index}.jpg'))
+      ann_path = os.path.join(ds.annotations_path, record.get('annotation_file', f'{index}.json'))
+      if Manifest.matches(record['image'], img_path) and\
+         Manifest.matches(record['annotation'], ann_path):
+        valid[index] = record
+    return valid
+
+  def record_tiles(self, records):
+    """
+    Appends the records of newly written tiles to the tiles manifest.
+    """
+    if not records:
+      return
+    with open(self.tiles_path, 'a') as f:
+      for record in records:
+        f.write(json.dumps(record) + '\n')
+      f.flush()
+      os.fsync(f.fileno())
+
+  def complete_tiles(self):
+    """
+    Marks the tiling stage as done.
+    """
+    self.stages['tiles']['done'] = True
+    self._save()
+
+  def reset(self):
+    """
+    Forgets every completed stage and written tile.
+    """
+    self.stages = {}
+    for path in [self.path, self.tiles_path]:
+      if os.path.isfile(path):
+        os.remove(path)
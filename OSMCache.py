@@ -0,0 +1,141 @@
+## OSMCache persists parsed OpenStreetMap query results on disk between runs.
+import os
+import json
+import hashlib
+from contextlib import contextmanager
+from LabelStore import LabelStore
+
+try:
+  import fcntl
+except ImportError:
+  # No advisory file locks (eg: on Windows), so the cache isn't safe to share.
+  fcntl = None
+
+
+class OSMCache:
+  """
+  The 'OSMCache' class is a content-addressed, size-bounded cache of parsed Overpass
+  query results. Each result is stored as a LabelStore `.npz` file named by the hash
+  of everything that determines it (bbox, super and sub classes and query text).
+
+  Entries are evicted least recently used first once the cache grows beyond
+  `max_bytes`. Reads and writes take a lock on `cache_dir/.lock`, so that several
+  runs (or processes) can share one cache directory.
+  """
+
+  def __init__(self, cache_dir=None, max_bytes=2 * 1024**3):
+    """
+    Initialises the cache in `cache_dir`. Defaults to the `AIR_OSM_CACHE` environment
+    variable if set, or `~/.cache/AIR-Project/osm` otherwise.
+    """
+    if cache_dir is None:
+      cache_dir = os.environ.get('AIR_OSM_CACHE',
+        os.path.join(os.path.expanduser('~'), '.cache', 'AIR-Project', 'osm'))
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    os.makedirs(self.cache_dir, exist_ok=True)
+    self.lock_path = os.path.join(self.cache_dir, '.lock')
+
+  @staticmethod
+  def key(coords, classes, query_string):
+    """
+    Returns the hex digest identifying the result of a query.
+    Requires:
+      coords: [LAT_MIN, LON_MIN, LAT_MAX, LON_MAX] of the query\n
+      classes: dictionary of queried super classes -> sub classes the ways are sorted into\n
+      query_string: the Overpass QL query text\n
+    """
+    content = json.dumps([list(coords), classes, " ".join(query_string.split())])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+  def _entry_path(self, key):
+    return os.path.join(self.cache_dir, f"{key}.npz")
+
+  @contextmanager
+  def _locked(self, exclusive):
+    """
+    Helper method only. Holds a shared (or exclusive) lock on the cache directory.
+    """
+    with open(self.lock_path, 'a') as lock_file:
+      if fcntl:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+      try:
+        yield
+      finally:
+        if fcntl:
+          fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+  def get(self, key):
+    """
+    Returns the cached LabelStore for `key`, or None if it isn't cached.
+    Marks the entry as most recently used.
+    """
+    path = self._entry_path(key)
+    with self._locked(exclusive=False):
+      if not os.path.isfile(path):
+        return None
+      store = LabelStore.load(path, mmap=False)
+      store.path = None
+
+      # The modification time of an entry is its last access time.
+      os.utime(path)
+    return store
+
+  def put(self, key, store):
+    """
+    Adds `store` to the cache under `key`, then evicts least recently used entries
+    until the cache fits in `max_bytes`.
+    """
+    path = self._entry_path(key)
+    tmp_path = os.path.join(self.cache_dir, f"{key}.{os.getpid()}.tmp.npz")
+    saved_path = store.path
+    store.save(tmp_path)
+    store.path = saved_path
+
+    with self._locked(exclusive=True):
+      os.replace(tmp_path, path)
+      self._evict()
+
+  def entries(self):
+    """
+    Returns a list of (last_used_time, size_in_bytes, path) of each cache entry.
+    """
+    entries = []
+    for f in os.listdir(self.cache_dir):
+      name, ext = os.path.splitext(f)
+      if ext != '.npz' or '.' in name:
+        continue
+      path = os.path.join(self.cache_dir, f)
+      try:
+        stat = os.stat(path)
+      except FileNotFoundError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+  def size(self):
+    """
+    Returns the total size of the cache entries in bytes.
+    """
+    return sum(size for _, size, _ in self.entries())
+
+  def _evict(self):
+    """
+    Helper method only, called with the exclusive lock held.
+    Removes least recently used entries until the cache fits in `max_bytes`.
+    """
+    entries = sorted(self.entries())
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+      if total <= self.max_bytes:
+        break
+      os.remove(path)
+      total -= size
+
+  def clear(self):
+    """
+    Removes every entry in the cache.
+    """
+    with self._locked(exclusive=True):
+      for _, _, path in self.entries():
+        os.remove(path)
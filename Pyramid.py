@@ -0,0 +1,113 @@
+## Pyramid builds coarser resolution levels of a dataset's entire area in a single read.
+import os
+import json
+import numpy as np
+from Dataset import Dataset
+from LabelStore import LabelStore
+
+# Catalog of the levels of a pyramid, stored in the data path of the full resolution level.
+CATALOG_FILENAME = 'pyramid.json'
+
+
+def level_path(data_path, factor):
+  """
+  Returns the data path of the pyramid level downsampled by [factor]. The full
+  resolution level (factor 1) is the dataset in [data_path] itself.
+  """
+  return data_path if factor == 1 else os.path.join(data_path, 'pyramid', f'{factor}x')
+
+
+def downsample_area(im_arr, factors, out_paths, block_rows=1024):
+  """
+  Reads the entire image [im_arr] once, in blocks of rows, and writes it downsampled
+  by each of [factors] (averaging each factor x factor block of pixels) to the
+  `.npy` file at the corresponding path in [out_paths].
+  Rows and columns that don't fill a whole block at the bottom and right edges are dropped.
+
+  Requires:
+  [im_arr] is a (h, w, channels) uint8 numpy array or memmap \n
+  [factors] are integers > 1 \n
+
+  Returns:
+  A dictionary of factor -> read-only memmap of the downsampled image.
+  """
+  height, width, channels = im_arr.shape
+
+  # Blocks must start on a multiple of every factor.
+  lcm = int(np.lcm.reduce(list(factors)))
+  block_rows = max(lcm, block_rows // lcm * lcm)
+
+  outs = {}
+  for factor, path in zip(factors, out_paths):
+    out_shape = (height // factor, width // factor, channels)
+    outs[factor] = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=out_shape)
+
+  for r0 in range(0, height, block_rows):
+    block = np.asarray(im_arr[r0:r0 + block_rows], dtype=np.float32)
+    for factor, out in outs.items():
+      out_h, out_w = out.shape[:2]
+      rows = min(len(block) // factor, out_h - r0 // factor)
+      if rows <= 0:
+        continue
+      level_block = block[:rows * factor, :out_w * factor]
+      level_block = level_block.reshape(rows, factor, out_w, factor, channels).mean(axis=(1, 3))
+      out[r0 // factor:r0 // factor + rows] = np.round(level_block).astype(np.uint8)
+
+  for out in outs.values():
+    out.flush()
+  del outs
+  return {factor: np.load(path, mmap_mode='r') for factor, path in zip(factors, out_paths)}
+
+
+def level_coords(coords, im_size, factor):
+  """
+  Returns the [LAT_MIN, LON_MIN, LAT_MAX, LON_MAX] covered by the level downsampled by
+  [factor] of an image of shape [im_size] covering [coords] (without the rows and
+  columns `downsample_area` drops at the bottom and right edges).
+  """
+  lat_min, lon_min, lat_max, lon_max = coords
+  height, width = im_size[:2]
+  return [lat_max - (height // factor * factor) / height * (lat_max - lat_min), lon_min,
+          lat_max, lon_min + (width // factor * factor) / width * (lon_max - lon_min)]
+
+
+def scale_labels(label_coords, factor):
+  """
+  Returns a LabelStore of the pixel labels [label_coords] in the pixels of the image
+  downsampled by [factor]. Flooring keeps the same truncation as `LabelStore.to_pixels`.
+  """
+  nodes = np.asarray(label_coords.nodes)
+  return LabelStore(label_coords.classes, nodes // factor,
+                    np.asarray(label_coords.offsets), np.asarray(label_coords.super_ids),
+                    np.asarray(label_coords.class_ids), np.asarray(label_coords.way_ids))
+
+
+def write_catalog(data_path, tile_size, overlap, levels):
+  """
+  Writes the catalog of a pyramid's levels to `data_path/pyramid.json`.
+  Requires:
+  [levels] is a list of dictionaries with the `factor`, `shape` of the entire area and
+  number of `tiles` of each level.
+  """
+  catalog = {
+    'tile_size': tile_size,
+    'overlap': overlap,
+    'levels': [dict(level, data_path=os.path.relpath(level_path(data_path, level['factor']),
+                                                     data_path))
+               for level in sorted(levels, key=lambda level: level['factor'])]
+  }
+  with open(os.path.join(data_path, CATALOG_FILENAME), 'w') as f:
+    json.dump(catalog, f, indent=2)
+
+
+def load_pyramid(data_path, classes_path='classes.json'):
+  """
+  Reads the pyramid catalog in [data_path].
+  Returns:
+  A dictionary of factor -> Dataset of that level.
+  """
+  with open(os.path.join(data_path, CATALOG_FILENAME), 'r') as f:
+    catalog = json.load(f)
+  return {level['factor']: Dataset(os.path.join(data_path, level['data_path']),
+                                   classes_path=classes_path)
+          for level in catalog['levels']}
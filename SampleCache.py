@@ -0,0 +1,192 @@
+## SampleCache keeps decoded samples (tiles and masks) in memory, so they are only decoded once.
+import threading
+import collections
+import numpy as np
+
+
+class SampleCache:
+  """
+  The 'SampleCache' class is a least recently used cache of decoded samples, each a
+  tuple of numpy arrays (eg: a uint8 tile and its class masks), holding at most
+  `max_bytes` bytes of arrays. Arrays only holding 0s and 1s (masks) can be stored
+  bit-packed, 8 times smaller, and are unpacked (to their original dtype) when read.
+
+  Samples evicted from memory can optionally spill to a local memory-mapped file of
+  `spill_bytes` bytes at `spill_path`, used as a ring buffer (the oldest spilled
+  samples are overwritten first). Reading a spilled sample is a copy, much cheaper
+  than decoding it again, and moves it back into memory.
+
+  The cache is thread safe (eg: shared by the workers of `Dataset.iter_batches`),
+  and counts its hits, spilled hits and misses (see `stats`). Pickling it (eg: to
+  send a dataset to worker processes) gives an empty cache of the same budget
+  without spilling, since processes can't share it.
+  """
+
+  def __init__(self, max_bytes, spill_path=None, spill_bytes=0):
+    assert max_bytes >= 0 and spill_bytes >= 0, "Cache budgets must be non-negative."
+    self.max_bytes = max_bytes
+    self.spill_path = spill_path
+    self.spill_bytes = spill_bytes if spill_path else 0
+    self._lock = threading.Lock()
+    self._init_entries()
+
+  def _init_entries(self):
+    # key -> list of (array, shape, dtype, packed) in memory, most recently used last.
+    self._entries = collections.OrderedDict()
+    self.nbytes = 0
+    self.hits, self.spill_hits, self.misses, self.evictions = 0, 0, 0, 0
+
+    # key -> (offset, size, specs) of the spilled samples, oldest first.
+    self._spilled = collections.OrderedDict()
+    self._spill_cursor = 0
+    self._spill = None
+    if self.spill_bytes:
+      self._spill = np.memmap(self.spill_path, dtype=np.uint8, mode='w+',
+                              shape=(self.spill_bytes,))
+
+  def __getstate__(self):
+    return {'max_bytes': self.max_bytes, 'spill_path': None, 'spill_bytes': 0}
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+    self._init_entries()
+
+  def __len__(self):
+    return len(self._entries)
+
+  @staticmethod
+  def pack(array, packed):
+    """
+    Helper method only. Returns (stored array, shape, dtype, packed) of [array],
+    bit-packed if [packed] and it only holds 0s and 1s.
+    """
+    array = np.asarray(array)
+    if packed and array.size and np.array_equal(array, array.astype(bool)):
+      return np.packbits(array.astype(bool), axis=None), array.shape, array.dtype, True
+    return np.ascontiguousarray(array).copy(), array.shape, array.dtype, False
+
+  @staticmethod
+  def unpack(stored):
+    """
+    Helper method only. Returns the array stored as [stored] by `pack`.
+    """
+    array, shape, dtype, packed = stored
+    if packed:
+      size = int(np.prod(shape))
+      return np.unpackbits(array)[:size].reshape(shape).astype(dtype)
+    return array.reshape(shape).copy()
+
+  def get(self, key):
+    """
+    Returns the tuple of arrays cached for [key] (copies, safe to modify), or None.
+    """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        self._entries.move_to_end(key)
+        self.hits += 1
+      elif key in self._spilled:
+        entry = self._unspill(key)
+        self.spill_hits += 1
+      else:
+        self.misses += 1
+        return None
+    return tuple(SampleCache.unpack(stored) for stored in entry)
+
+  def put(self, key, arrays, packed=()):
+    """
+    Caches the tuple of numpy [arrays] for [key], bit-packing the arrays at the
+    positions in [packed] (eg: masks), and evicts the least recently used samples
+    beyond the byte budget. Samples larger than the budget aren't cached.
+    """
+    entry = [SampleCache.pack(array, i in packed) for i, array in enumerate(arrays)]
+    with self._lock:
+      self._insert(key, entry)
+
+  def get_or_load(self, key, load, packed=()):
+    """
+    Returns the arrays cached for [key], or loads them with `load()` and caches them
+    (see `put`). Loading happens outside the lock, so threads load in parallel.
+    """
+    arrays = self.get(key)
+    if arrays is None:
+      arrays = tuple(load())
+      self.put(key, arrays, packed=packed)
+    return arrays
+
+  def _insert(self, key, entry):
+    size = sum(stored[0].nbytes for stored in entry)
+    if key in self._entries:
+      self.nbytes -= sum(stored[0].nbytes for stored in self._entries.pop(key))
+    self._spilled.pop(key, None)
+    if size > self.max_bytes:
+      return
+
+    self._entries[key] = entry
+    self.nbytes += size
+    while self.nbytes > self.max_bytes:
+      old_key, old_entry = self._entries.popitem(last=False)
+      self.nbytes -= sum(stored[0].nbytes for stored in old_entry)
+      self.evictions += 1
+      self._spill_entry(old_key, old_entry)
+
+  def _spill_entry(self, key, entry):
+    size = sum(stored[0].nbytes for stored in entry)
+    if self._spill is None or size > self.spill_bytes:
+      return
+
+    # The oldest spilled samples are the ones after the cursor. Wrapping around drops
+    # the ones up to the end of the file, then the sample overwrites the next ones.
+    oldest = lambda: next(iter(self._spilled.values()))[0] if self._spilled else -1
+    if self._spill_cursor + size > self.spill_bytes:
+      while oldest() >= self._spill_cursor:
+        self._spilled.popitem(last=False)
+      self._spill_cursor = 0
+    while self._spill_cursor <= oldest() < self._spill_cursor + size:
+      self._spilled.popitem(last=False)
+
+    offset, specs = self._spill_cursor, []
+    for array, shape, dtype, packed in entry:
+      data = array.view(np.uint8).reshape(-1)
+      self._spill[offset:offset + data.size] = data
+      specs.append((offset, data.size, array.dtype, shape, dtype, packed))
+      offset += data.size
+    self._spilled[key] = (self._spill_cursor, size, specs)
+    self._spill_cursor = offset
+
+  def _unspill(self, key):
+    _, _, specs = self._spilled.pop(key)
+    entry = [(np.array(self._spill[offset:offset + size]).view(stored_dtype), shape, dtype, packed)
+             for offset, size, stored_dtype, shape, dtype, packed in specs]
+    self._insert(key, entry)
+    return entry
+
+  def clear(self):
+    """
+    Empties the cache (eg: after the files of the samples changed), keeping its stats.
+    """
+    with self._lock:
+      self._entries.clear()
+      self._spilled.clear()
+      self.nbytes, self._spill_cursor = 0, 0
+
+  def stats(self):
+    """
+    Returns a dictionary of the number of hits (in memory and spilled), misses and
+    evictions, the hit rate, and the number of samples and bytes held in memory and
+    in the spill file.
+    """
+    with self._lock:
+      lookups = self.hits + self.spill_hits + self.misses
+      return {
+        'hits': self.hits,
+        'spill_hits': self.spill_hits,
+        'misses': self.misses,
+        'hit_rate': (self.hits + self.spill_hits) / lookups if lookups else 0.0,
+        'evictions': self.evictions,
+        'samples': len(self._entries),
+        'bytes': self.nbytes,
+        'spilled_samples': len(self._spilled),
+        'spilled_bytes': sum(size for _, size, _ in self._spilled.values())
+      }
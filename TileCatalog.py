@@ -0,0 +1,366 @@
+## TileCatalog is a persistent SQLite catalog of the tiles of a dataset.
+import os
+import sqlite3
+import threading
+
+# Catalog of a dataset's tiles, stored in its data path.
+CATALOG_FILENAME = 'catalog.db'
+
+# Condition selecting the tiles that haven't been removed.
+LIVE = "tile_index NOT IN (SELECT tile_index FROM removed_tiles)"
+
+# Tile indices per query when selecting tiles by index (SQLite allows 999 parameters by default).
+MAX_QUERY_INDICES = 900
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (
+  tile_index INTEGER PRIMARY KEY,
+  image_file TEXT NOT NULL,
+  annotation_file TEXT NOT NULL,
+  split TEXT,
+  split_index INTEGER,
+  source TEXT,
+  lat_min REAL,
+  lon_min REAL,
+  lat_max REAL,
+  lon_max REAL,
+  sha256 TEXT
+);
+CREATE TABLE IF NOT EXISTS label_counts (
+  tile_index INTEGER NOT NULL,
+  super_class TEXT NOT NULL,
+  sub_class TEXT NOT NULL,
+  count INTEGER NOT NULL,
+  PRIMARY KEY (tile_index, super_class, sub_class)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tiles_split ON tiles (split, split_index);
+CREATE TABLE IF NOT EXISTS removed_tiles (
+  tile_index INTEGER PRIMARY KEY
+);
+"""
+
+RTREE_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS tile_bounds USING rtree(
+  tile_index, lon_min, lon_max, lat_min, lat_max
+);
+"""
+
+
+class TileCatalog:
+  """
+  The 'TileCatalog' class keeps one row per tile of a dataset in the SQLite database
+  `data_path/catalog.db`, so that the tiles can be listed and searched without
+  listing the `images` and `annotations` directories. Each row holds:\n
+  1) The tile index, the number its files are named by (eg: 12.jpg).\n
+  2) The names of its image and annotation files.\n
+  3) The split (eg: "train") the tile was assigned to, and its index in that split.\n
+  4) The source it was tiled from (the PAIRS query name or drone image id).\n
+  5) Its geographic bounds (lat_min, lon_min, lat_max, lon_max), indexed by an R*Tree
+     for spatial queries.\n
+  6) The sha256 hash of its image file.\n
+  7) The number of labels of each (super_class, sub_class) in it.\n
+
+  Rows are given and returned as dictionaries like the Manifest tile records:
+  {'index', 'image_file', 'annotation_file', 'split', 'split_index', 'source',
+   'bounds': [lat_min, lon_min, lat_max, lon_max], 'sha256',
+   'labels': {super_class: {sub_class: count}}}, where all but the index and file
+  names are optional.
+
+  Removed tiles are only marked as removed (tombstones in `removed_tiles`), so that
+  removing k tiles costs O(k) instead of renaming every later tile. The Dataset index
+  of a tile is its rank among the tiles that aren't removed, and reads only return
+  those tiles. `compact` renumbers the tiles consecutively again.
+
+  The database is only created by the first write, and connections aren't pickled,
+  so datasets can still be sent to worker processes.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self._conn = None
+    self._lock = threading.Lock()
+    self.has_rtree = True
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['_conn'], state['_lock'] = None, None
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+  def exists(self):
+    """
+    Returns whether the catalog database has been created.
+    """
+    return os.path.isfile(self.path)
+
+  def _connect(self):
+    """
+    Helper method only. Returns the (cached) connection to the database, creating
+    its tables if needed.
+    """
+    if self._conn is None:
+      conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+      conn.executescript(SCHEMA)
+      try:
+        conn.executescript(RTREE_SCHEMA)
+      except sqlite3.OperationalError:
+        # SQLite built without the R*Tree module, bounds are searched in `tiles`.
+        self.has_rtree = False
+      conn.commit()
+      self._conn = conn
+    return self._conn
+
+  def close(self):
+    """
+    Closes the connection to the database (it is reopened by the next access).
+    """
+    with self._lock:
+      if self._conn is not None:
+        self._conn.close()
+        self._conn = None
+
+  def _query(self, sql, params=()):
+    """
+    Helper method only. Returns all rows of a read query (empty if there's no catalog).
+    """
+    if not self.exists():
+      return []
+    with self._lock:
+      return self._connect().execute(sql, params).fetchall()
+
+  def __len__(self):
+    return self._query(f"SELECT COUNT(*) FROM tiles WHERE {LIVE}")[0][0] if self.exists() else 0
+
+  def files(self):
+    """
+    Returns the list of (tile_index, image_file, annotation_file) of all tiles that
+    aren't removed, in index order.
+    """
+    return self._query("SELECT tile_index, image_file, annotation_file FROM tiles" +\
+                       f" WHERE {LIVE} ORDER BY tile_index")
+
+  def indices(self):
+    """
+    Returns the set of the indices of all tiles in the catalog (including removed ones).
+    """
+    return {index for index, in self._query("SELECT tile_index FROM tiles")}
+
+  def add_tiles(self, rows):
+    """
+    Adds the tiles (row dictionaries, see above) to the catalog, replacing any tiles
+    with the same indices (even removed ones), in a single transaction.
+    """
+    rows = list(rows)
+    if not rows:
+      return
+    tiles, counts, bounds = [], [], []
+    for row in rows:
+      index = row['index']
+      box = row.get('bounds') or [None] * 4
+      tiles.append((index, row['image_file'], row['annotation_file'], row.get('split'),
+                    row.get('split_index'), row.get('source'), *box, row.get('sha256')))
+      for super_class, sub_counts in (row.get('labels') or {}).items():
+        for sub_class, count in sub_counts.items():
+          counts.append((index, super_class, sub_class, count))
+      if row.get('bounds'):
+        lat_min, lon_min, lat_max, lon_max = box
+        bounds.append((index, lon_min, lon_max, lat_min, lat_max))
+
+    indices = [(row['index'],) for row in rows]
+    with self._lock:
+      conn = self._connect()
+      with conn:
+        conn.executemany("DELETE FROM label_counts WHERE tile_index = ?", indices)
+        conn.executemany("DELETE FROM removed_tiles WHERE tile_index = ?", indices)
+        conn.executemany("INSERT OR REPLACE INTO tiles VALUES (?,?,?,?,?,?,?,?,?,?,?)", tiles)
+        conn.executemany("INSERT INTO label_counts VALUES (?,?,?,?)", counts)
+        if self.has_rtree:
+          conn.executemany("DELETE FROM tile_bounds WHERE tile_index = ?", indices)
+          conn.executemany("INSERT INTO tile_bounds VALUES (?,?,?,?,?)", bounds)
+
+  def rows(self, indices=None):
+    """
+    Returns the row dictionaries of the tiles with [indices] (default: all tiles that
+    aren't removed), in index order.
+    """
+    if indices is None:
+      tiles = self._query(f"SELECT * FROM tiles WHERE {LIVE} ORDER BY tile_index")
+      label_counts = self._query("SELECT * FROM label_counts")
+    else:
+      # Only the rows of the indices are read, in chunks of sorted indices (so in order).
+      indices = sorted({int(index) for index in indices})
+      tiles, label_counts = [], []
+      for start in range(0, len(indices), MAX_QUERY_INDICES):
+        chunk = indices[start:start + MAX_QUERY_INDICES]
+        marks = ",".join("?" * len(chunk))
+        tiles += self._query(f"SELECT * FROM tiles WHERE tile_index IN ({marks})"
+                             " ORDER BY tile_index", chunk)
+        label_counts += self._query(f"SELECT * FROM label_counts WHERE tile_index IN ({marks})",
+                                    chunk)
+    counts = {}
+    for index, super_class, sub_class, count in label_counts:
+      counts.setdefault(index, {}).setdefault(super_class, {})[sub_class] = count
+
+    rows = []
+    for index, image_file, annotation_file, split, split_index, source, *box, sha256 in tiles:
+      rows.append({
+        'index': index,
+        'image_file': image_file,
+        'annotation_file': annotation_file,
+        'split': split,
+        'split_index': split_index,
+        'source': source,
+        'bounds': None if box[0] is None else box,
+        'sha256': sha256,
+        'labels': counts.get(index, {})
+      })
+    return rows
+
+  def truncate(self, num_tiles):
+    """
+    Forgets the tiles with an index of [num_tiles] or more (eg: left over by an earlier
+    run that wrote more tiles).
+    """
+    self.prune("tile_index >= ?", (num_tiles,))
+
+  def prune(self, condition, params=()):
+    """
+    Helper method only. Forgets the tiles whose index matches the SQL [condition].
+    """
+    if not self.exists():
+      return
+    with self._lock:
+      conn = self._connect()
+      with conn:
+        # removed_tiles last, since the condition may select from it.
+        for table in ['tiles', 'label_counts'] + (['tile_bounds'] if self.has_rtree else []) +\
+                     ['removed_tiles']:
+          conn.execute(f"DELETE FROM {table} WHERE {condition}", params)
+
+  def forget(self, indices):
+    """
+    Forgets the tiles with tile [indices] entirely (eg: whose files no longer exist).
+    """
+    if not self.exists():
+      return
+    with self._lock:
+      conn = self._connect()
+      with conn:
+        for table in ['tiles', 'label_counts', 'removed_tiles'] +\
+                     (['tile_bounds'] if self.has_rtree else []):
+          conn.executemany(f"DELETE FROM {table} WHERE tile_index = ?",
+                           [(index,) for index in indices])
+
+  def remove(self, indices):
+    """
+    Marks the tiles with tile [indices] as removed, in O(len(indices)).
+    """
+    with self._lock:
+      conn = self._connect()
+      with conn:
+        conn.executemany("INSERT OR IGNORE INTO removed_tiles VALUES (?)",
+                         [(index,) for index in indices])
+
+  def removed_files(self):
+    """
+    Returns the list of (tile_index, image_file, annotation_file) of removed tiles.
+    """
+    return self._query("SELECT tile_index, image_file, annotation_file FROM tiles" +\
+                       " WHERE tile_index IN (SELECT tile_index FROM removed_tiles)" +\
+                       " ORDER BY tile_index")
+
+  def renumbering(self):
+    """
+    Returns how `compact` renumbers the tiles that aren't removed: the list of
+    (tile_index, new_index, image_file, annotation_file, new_image_file,
+    new_annotation_file) of every tile whose index changes, in index order.
+    """
+    renamed = []
+    for new_index, (index, image_file, annotation_file) in enumerate(self.files()):
+      if index != new_index:
+        renamed.append((index, new_index, image_file, annotation_file,
+                        str(new_index) + os.path.splitext(image_file)[1],
+                        str(new_index) + os.path.splitext(annotation_file)[1]))
+    return renamed
+
+  def compact(self):
+    """
+    Forgets the removed tiles, and renumbers the remaining tiles (and their file names)
+    consecutively in the same order, as given by `renumbering`. The files themselves
+    have to be renamed by the caller (see `Dataset.compact`).
+    """
+    if not self.exists():
+      return
+    renamed = self.renumbering()
+    self.prune("tile_index IN (SELECT tile_index FROM removed_tiles)")
+
+    # Indices only decrease, so renumbering in increasing order never collides.
+    moves = [(new, old) for old, new, _, _, _, _ in renamed]
+    with self._lock:
+      conn = self._connect()
+      with conn:
+        conn.executemany("UPDATE tiles SET tile_index = ?, image_file = ?," +\
+                         " annotation_file = ? WHERE tile_index = ?",
+                         [(new, new_img, new_ann, old)
+                          for old, new, _, _, new_img, new_ann in renamed])
+        conn.executemany("UPDATE label_counts SET tile_index = ? WHERE tile_index = ?", moves)
+        if self.has_rtree:
+          conn.executemany("UPDATE tile_bounds SET tile_index = ? WHERE tile_index = ?", moves)
+
+  def set_splits(self, splits):
+    """
+    Records the split of tiles, given as a dictionary of
+    tile index -> (split, index of the tile in that split).
+    """
+    with self._lock:
+      conn = self._connect()
+      with conn:
+        conn.executemany("UPDATE tiles SET split = ?, split_index = ? WHERE tile_index = ?",
+                         [(split, split_index, index)
+                          for index, (split, split_index) in splits.items()])
+
+  def tiles_in_split(self, split):
+    """
+    Returns the tile indices of the tiles in [split] (that aren't removed), in the
+    order of their split index.
+    """
+    return [index for index, in self._query(
+      f"SELECT tile_index FROM tiles WHERE split = ? AND {LIVE} ORDER BY split_index", (split,))]
+
+  def tiles_in_bbox(self, lat_min, lon_min, lat_max, lon_max):
+    """
+    Returns the sorted tile indices of the tiles (that aren't removed) whose geographic
+    bounds intersect the box [lat_min, lon_min, lat_max, lon_max]. Tiles without bounds
+    are never returned.
+    """
+    if not self.exists():
+      return []
+    with self._lock:
+      conn = self._connect()
+      table = 'tile_bounds' if self.has_rtree else 'tiles'
+      rows = conn.execute(f"SELECT tile_index FROM {table} WHERE lon_max >= ? AND lon_min <= ?" +\
+                          f" AND lat_max >= ? AND lat_min <= ? AND {LIVE} ORDER BY tile_index",
+                          (lon_min, lon_max, lat_min, lat_max)).fetchall()
+    return [index for index, in rows]
+
+  def label_counts(self, index):
+    """
+    Returns the {super_class: {sub_class: count}} label counts of the tile at [index].
+    """
+    counts = {}
+    for super_class, sub_class, count in self._query(
+        "SELECT super_class, sub_class, count FROM label_counts WHERE tile_index = ?", (index,)):
+      counts.setdefault(super_class, {})[sub_class] = count
+    return counts
+
+  @staticmethod
+  def count_labels(labels):
+    """
+    Returns the {super_class: {sub_class: count}} label counts of a tile's labels.
+    """
+    return {super_class: {sub_class: len(class_labels)
+                          for sub_class, class_labels in sub_labels.items()}
+            for super_class, sub_labels in labels.items()}
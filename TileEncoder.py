@@ -0,0 +1,339 @@
+## TileEncoder holds the file formats tiles and their labels can be saved in.
+import io
+import os
+import json
+import struct
+import numpy as np
+from PIL import Image
+
+
+class ImageEncoder:
+  """
+  The 'ImageEncoder' class encodes tiles (uint8 numpy arrays) into the bytes of an
+  image file. This base class encodes JPEG with PIL. Subclasses set the PIL format
+  and file extension. `options` are passed on to PIL (eg: quality, subsampling), and
+  options that are None are left at PIL's defaults.
+  """
+  name = 'jpeg'
+  pil_format = 'JPEG'
+  ext = '.jpg'
+
+  def __init__(self, **options):
+    self.options = {key: value for key, value in options.items() if value is not None}
+
+  def encode(self, tile):
+    buffer = io.BytesIO()
+    Image.fromarray(tile).save(buffer, format=self.pil_format, **self.options)
+    return buffer.getvalue()
+
+  def decode(self, data):
+    return np.array(Image.open(io.BytesIO(data)))
+
+  def config(self):
+    """
+    Returns a json serialisable description of the encoder (eg: for a Manifest key).
+    """
+    return dict(self.options, format=self.name)
+
+
+class JpegEncoder(ImageEncoder):
+  """
+  Lossy JPEG, with `quality` (1-95, PIL's default is 75) and chroma `subsampling`
+  (0 for 4:4:4, 1 for 4:2:2, 2 for 4:2:0, the default) settings.
+  """
+  def __init__(self, quality=None, subsampling=None, optimize=None, progressive=None):
+    super().__init__(quality=quality, subsampling=subsampling, optimize=optimize,
+                     progressive=progressive)
+
+
+class PngEncoder(ImageEncoder):
+  """
+  Lossless PNG, with a zlib `compress_level` (0-9, default 6).
+  """
+  name = 'png'
+  pil_format = 'PNG'
+  ext = '.png'
+
+  def __init__(self, compress_level=None, optimize=None):
+    super().__init__(compress_level=compress_level, optimize=optimize)
+
+
+class WebpEncoder(ImageEncoder):
+  """
+  WebP, lossy with a `quality` (0-100, default 80) or `lossless`, and the encoding
+  `method` (0-6, slower methods give smaller files).
+  """
+  name = 'webp'
+  pil_format = 'WEBP'
+  ext = '.webp'
+
+  def __init__(self, quality=None, lossless=None, method=None):
+    super().__init__(quality=quality, lossless=lossless, method=method)
+
+
+class NpyEncoder(ImageEncoder):
+  """
+  Raw uint8 `.npy` arrays: lossless, no encoding cost and decoded by a single read
+  (or memory map), at the cost of the largest files.
+  """
+  name = 'npy'
+  ext = '.npy'
+
+  def encode(self, tile):
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(tile))
+    return buffer.getvalue()
+
+  def decode(self, data):
+    return np.load(io.BytesIO(data))
+
+
+class JsonLabelEncoder:
+  """
+  The 'JsonLabelEncoder' class encodes the labels of a tile, a dictionary of
+  {super_class: {sub_class: [label_nodes, ...]}}, as json indented by `indent`
+  spaces (or on a single line if `indent` is None).
+  """
+  name = 'json'
+  ext = '.json'
+
+  def __init__(self, indent=2, separators=None):
+    self.indent = indent
+    self.separators = separators
+
+  def encode(self, labels):
+    return json.dumps(labels, indent=self.indent, separators=self.separators).encode('utf-8')
+
+  def decode(self, data):
+    return json.loads(data.decode('utf-8'))
+
+  def config(self):
+    return {'format': self.name, 'indent': self.indent, 'separators': self.separators}
+
+
+class CompactJsonLabelEncoder(JsonLabelEncoder):
+  """
+  Json without any whitespace, readable by anything that reads the indented json.
+  """
+  name = 'compact'
+
+  def __init__(self):
+    super().__init__(indent=None, separators=(',', ':'))
+
+
+class BinaryLabelEncoder:
+  """
+  The 'BinaryLabelEncoder' class encodes the labels of a tile in a compact binary
+  `.lbl` format, decoded back into exactly the same dictionary as the json:\n
+    b'LBL1' | uint32 header size | json header | uint32 nodes per label | nodes\n
+  where the header lists [super_class, sub_class, number of labels] in order, and
+  the dtype of the (x, y) nodes (int32 when all of them are integers).
+  """
+  name = 'binary'
+  ext = '.lbl'
+  magic = b'LBL1'
+
+  def encode(self, labels):
+    classes, lengths, nodes = [], [], []
+    for super_class, sub_class_labels in labels.items():
+      if not sub_class_labels:
+        # Keeps super classes without any sub class.
+        classes.append([super_class, None, 0])
+      for sub_class, class_labels in sub_class_labels.items():
+        classes.append([super_class, sub_class, len(class_labels)])
+        for label in class_labels:
+          lengths.append(len(label))
+          nodes.extend(label)
+
+    nodes = np.array(nodes).reshape(-1, 2)
+    if nodes.dtype.kind in 'iu' and (not nodes.size or np.abs(nodes).max() < 2**31):
+      nodes = nodes.astype('<i4')
+    elif nodes.dtype.kind in 'iu':
+      nodes = nodes.astype('<i8')
+    else:
+      nodes = nodes.astype('<f8')
+
+    header = json.dumps({'classes': classes, 'dtype': nodes.dtype.str},
+                        separators=(',', ':')).encode('utf-8')
+    return b''.join([self.magic, struct.pack('<I', len(header)), header,
+                     np.array(lengths, dtype='<u4').tobytes(), nodes.tobytes()])
+
+  def decode(self, data):
+    if data[:4] != self.magic:
+      raise ValueError("Not a binary label file.")
+    if len(data) < 8:
+      raise ValueError("Truncated binary label file.")
+    header_size, = struct.unpack('<I', data[4:8])
+    header = json.loads(data[8:8 + header_size].decode('utf-8'))
+    offset = 8 + header_size
+
+    num_labels = sum(count for _, _, count in header['classes'])
+    lengths = np.frombuffer(data, dtype='<u4', count=num_labels, offset=offset)
+    offset += 4 * num_labels
+    nodes = np.frombuffer(data, dtype=header['dtype'], offset=offset).reshape(-1, 2).tolist()
+
+    labels, label, node = {}, 0, 0
+    for super_class, sub_class, count in header['classes']:
+      sub_class_labels = labels.setdefault(super_class, {})
+      if sub_class is None:
+        continue
+      class_labels = sub_class_labels.setdefault(sub_class, [])
+      for length in lengths[label:label + count]:
+        class_labels.append(nodes[node:node + length])
+        node += int(length)
+      label += count
+    return labels
+
+  def config(self):
+    return {'format': self.name}
+
+
+class MaskEncoder:
+  """
+  The 'MaskEncoder' class encodes the (C, h, w) class masks of an image segmentation
+  tile (see `ImSeg_Dataset`) in a `.npz` file, with each class channel bit-packed
+  (8 pixels per byte), instead of a json list of ints. The classes of interest can be
+  decoded without unpacking the others. Masks not only holding 0s and 1s are stored
+  compressed instead.
+  """
+  name = 'bits'
+  ext = '.npz'
+
+  def encode(self, masks, img_name=None):
+    masks = np.asarray(masks)
+    arrays = {'shape': np.array(masks.shape)}
+    if img_name is not None:
+      arrays['img'] = np.array(img_name)
+
+    buffer = io.BytesIO()
+    if masks.ndim and masks.size and np.array_equal(masks, masks.astype(bool)):
+      channels = masks.reshape(len(masks), -1).astype(bool)
+      np.savez(buffer, bits=np.packbits(channels, axis=1), **arrays)
+    else:
+      np.savez_compressed(buffer, masks=masks, **arrays)
+    return buffer.getvalue()
+
+  def decode(self, data, channels=None, dtype=None):
+    with np.load(io.BytesIO(data)) as npz:
+      if 'masks' in npz:
+        masks = npz['masks'] if channels is None else npz['masks'][channels]
+      else:
+        shape = tuple(int(n) for n in npz['shape'])
+        bits = npz['bits'] if channels is None else npz['bits'][channels]
+        size = int(np.prod(shape[1:]))
+        masks = np.unpackbits(bits, axis=1)[:, :size].reshape((len(bits),) + shape[1:])
+    return masks if dtype is None else masks.astype(dtype, copy=False)
+
+  def config(self):
+    return {'format': self.name}
+
+
+IMAGE_ENCODERS = {encoder.name: encoder
+                  for encoder in [JpegEncoder, PngEncoder, WebpEncoder, NpyEncoder]}
+LABEL_ENCODERS = {encoder.name: encoder
+                  for encoder in [JsonLabelEncoder, CompactJsonLabelEncoder, BinaryLabelEncoder]}
+
+# File extensions of tile images and labels in any of the formats above.
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.webp', '.npy')
+LABEL_EXTS = ('.json', '.lbl')
+# File extensions of image segmentation masks: bit-packed, or json for older datasets.
+MASK_EXTS = ('.npz', '.json')
+
+
+def parse_spec(spec, encoders):
+  """
+  Helper function only. Creates the encoder for a spec like "jpeg:quality=90,subsampling=0",
+  where the options (json values, eg: 90, true) are keyword arguments of the encoder.
+  """
+  name, _, options = spec.partition(':')
+  if name not in encoders:
+    raise ValueError(f"Unknown encoder {name}, expected one of {list(encoders)}")
+
+  kwargs = {}
+  for option in filter(None, options.split(',')):
+    key, _, value = option.partition('=')
+    try:
+      kwargs[key] = json.loads(value)
+    except ValueError:
+      kwargs[key] = value
+  return encoders[name](**kwargs)
+
+
+def image_encoder(spec):
+  """
+  Returns the ImageEncoder for a spec like "jpeg", "jpeg:quality=90,subsampling=0",
+  "png:compress_level=1", "webp:lossless=true" or "npy".
+  """
+  return parse_spec(spec, IMAGE_ENCODERS)
+
+
+def label_encoder(spec):
+  """
+  Returns the label encoder for a spec: "json", "compact" or "binary".
+  """
+  return parse_spec(spec, LABEL_ENCODERS)
+
+
+def read_image(path):
+  """
+  Reads a tile image in any of the formats above as a numpy array.
+  """
+  if path.endswith(NpyEncoder.ext):
+    return np.load(path)
+  return np.array(Image.open(path))
+
+
+def open_image(path):
+  """
+  Opens a tile image in any of the formats above as a PIL Image.
+  """
+  if path.endswith(NpyEncoder.ext):
+    return Image.fromarray(np.load(path))
+  return Image.open(path)
+
+
+def read_labels(path):
+  """
+  Reads the labels of a tile in any of the formats above as a dictionary.
+  Raises ValueError if the file can't be decoded.
+  """
+  if path.endswith(BinaryLabelEncoder.ext):
+    with open(path, 'rb') as f:
+      return BinaryLabelEncoder().decode(f.read())
+  with open(path, 'r') as f:
+    return json.load(f)
+
+
+def read_masks(path, channels=None, dtype=None):
+  """
+  Reads the (C, h, w) class masks of an image segmentation tile, from a `.npz` file of
+  the MaskEncoder or a json file ({"annotation": masks, "img": image name}), only
+  keeping the classes at the indices [channels] if given.
+  Returns:
+  A uint8 array of 0s and 1s, or of [dtype] if given (eg: bool).
+  """
+  if path.endswith(MaskEncoder.ext):
+    with open(path, 'rb') as f:
+      return MaskEncoder().decode(f.read(), channels=channels, dtype=dtype)
+  with open(path, 'r') as f:
+    masks = np.array(json.load(f)['annotation'], dtype=np.uint8)
+  masks = masks if channels is None else masks[channels]
+  return masks if dtype is None else masks.astype(dtype, copy=False)
+
+
+def write_tile_file(directory, index, data, ext, exts):
+  """
+  Writes the encoded bytes [data] of tile [index] to `directory/[index][ext]`, and
+  removes any file of the same tile in another format (of [exts]) left by an earlier run.
+  Returns:
+  The path of the written file.
+  """
+  for other_ext in exts:
+    other_path = os.path.join(directory, f'{index}{other_ext}')
+    if other_ext != ext and os.path.exists(other_path):
+      os.remove(other_path)
+
+  path = os.path.join(directory, f'{index}{ext}')
+  with open(path, 'wb') as f:
+    f.write(data)
+  return path
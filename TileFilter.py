@@ -0,0 +1,189 @@
+## TileFilter decides which tiles of a tile grid are worth saving, before encoding them.
+import numpy as np
+
+
+class TileFilter:
+  """
+  The 'TileFilter' class rejects tiles of a tile grid based on their content, so that
+  empty or nodata tiles are never written (instead of being written, then removed and
+  renumbered with `Dataset.remove_tiles`). A tile is kept only if:\n
+  1) At most `max_nodata` of its pixels are nodata (all RGB channels == `nodata_value`,
+     or a zero alpha channel).\n
+  2) It has at least `min_labels[name]` labels of each class `name`, where `name` is
+     either a super class (eg: "building") or "super_class/sub_class"
+     (eg: "building/hospital"). As in `boxes_in_tile`, a label is in a tile if any
+     of its nodes is.\n
+  3) The entropy (in bits) of the histogram of its grayscale pixel values, quantized to
+     `entropy_bins` levels, is at least `min_entropy`. This rejects flat tiles (eg: all
+     water or cloud).\n
+
+  The statistics are computed for all tiles in a row of tiles at once, with cumulative
+  sums over the pixel columns, so filtering costs far less than encoding the tiles.
+  """
+
+  def __init__(self, max_nodata=None, min_labels=None, min_entropy=None,
+               nodata_value=0, entropy_bins=32):
+    self.max_nodata = max_nodata
+    self.min_labels = min_labels or {}
+    self.min_entropy = min_entropy
+    self.nodata_value = nodata_value
+    self.entropy_bins = entropy_bins
+
+  @staticmethod
+  def from_args(max_nodata=None, min_labels=None, min_entropy=None):
+    """
+    Returns the TileFilter for the command line arguments, where `min_labels` is a
+    list of "class=count" strings, or None if no filter is given.
+    """
+    counts = {}
+    for arg in min_labels or []:
+      name, _, count = arg.partition('=')
+      if not count:
+        raise ValueError(f"Expected class=count for minimum label count, got: {arg}")
+      counts[name] = int(count)
+
+    tile_filter = TileFilter(max_nodata, counts, min_entropy)
+    return tile_filter if tile_filter.is_active() else None
+
+  def is_active(self):
+    """
+    Returns whether this filter can reject any tile.
+    """
+    return self.max_nodata is not None or bool(self.min_labels) or self.min_entropy is not None
+
+  def config(self):
+    """
+    Returns a json serialisable description of the filter (eg: for a Manifest key).
+    """
+    return {
+      'max_nodata': self.max_nodata,
+      'min_labels': self.min_labels,
+      'min_entropy': self.min_entropy,
+      'nodata_value': self.nodata_value,
+      'entropy_bins': self.entropy_bins
+    }
+
+  def keep_grid(self, im_arr, label_coords, row_starts, col_starts, tile_size):
+    """
+    Decides which tiles of a grid to keep.
+    Requires:
+      im_arr: numpy array (or memmap) of shape (h, w, channels) of the entire image\n
+      label_coords: LabelStore of the image's labels in pixels\n
+      row_starts, col_starts: increasing pixel rows and columns at which the tiles of
+        the grid start (in the coordinates of `im_arr` and `label_coords`)\n
+      tile_size: size of the square tiles in pixels, or (h, w) of the tiles\n
+    Returns:
+      A (len(row_starts), len(col_starts)) boolean array, True for tiles to keep.
+    """
+    tile_h, tile_w = TileFilter.tile_shape(tile_size)
+    row_starts = np.asarray(row_starts, dtype=np.int64)
+    col_starts = np.asarray(col_starts, dtype=np.int64)
+    keep = np.ones((len(row_starts), len(col_starts)), dtype=bool)
+    if not keep.size:
+      return keep
+
+    if self.max_nodata is not None or self.min_entropy is not None:
+      for row, row_start in enumerate(row_starts):
+        keep[row] &= self._keep_row(im_arr[row_start:row_start + tile_h], col_starts, tile_w)
+
+    for name, min_count in self.min_labels.items():
+      counts = TileFilter.label_counts(label_coords, name, row_starts, col_starts, tile_size)
+      keep &= counts >= min_count
+    return keep
+
+  def _keep_row(self, band, col_starts, tile_w):
+    """
+    Helper method only. Applies the nodata and entropy filters to all tiles of width
+    `tile_w` starting at `col_starts` in the row of tiles `band`.
+    """
+    width = band.shape[1]
+    col_ends = np.minimum(col_starts + tile_w, width)
+    pixels = (col_ends - col_starts) * band.shape[0]
+    keep = np.ones(len(col_starts), dtype=bool)
+
+    if self.max_nodata is not None:
+      rgb = band[..., :3]
+      nodata = (rgb == self.nodata_value).all(axis=2)
+      if band.shape[2] == 4:
+        nodata |= band[..., 3] == 0
+
+      # Nodata pixels in columns [0, c) are cum[c], so a tile's are a difference of two.
+      cum = np.concatenate([[0], np.cumsum(nodata.sum(axis=0))])
+      nodata_fraction = (cum[col_ends] - cum[col_starts]) / np.maximum(pixels, 1)
+      keep &= nodata_fraction <= self.max_nodata
+
+    if self.min_entropy is not None:
+      gray = band[..., :3].astype(np.float32).mean(axis=2) if band.shape[2] > 1 else band[..., 0]
+      levels = np.clip(gray * (self.entropy_bins / 256.0), 0, self.entropy_bins - 1).astype(np.int64)
+
+      # Histogram of each pixel column, then cumulative over columns like above.
+      col_ids = np.broadcast_to(np.arange(width), levels.shape)
+      col_hists = np.bincount((col_ids * self.entropy_bins + levels).ravel(),
+                              minlength=width * self.entropy_bins).reshape(width, -1)
+      cum = np.concatenate([np.zeros((1, self.entropy_bins), dtype=np.int64),
+                            np.cumsum(col_hists, axis=0)])
+      hists = cum[col_ends] - cum[col_starts]
+
+      p = hists / np.maximum(hists.sum(axis=1, keepdims=True), 1)
+      with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = -np.where(p > 0, p * np.log2(p), 0).sum(axis=1)
+      keep &= entropy >= self.min_entropy
+    return keep
+
+  @staticmethod
+  def tile_shape(tile_size):
+    """
+    Returns (h, w) of tiles of size `tile_size` (an integer, or already (h, w)).
+    """
+    if np.isscalar(tile_size):
+      return int(tile_size), int(tile_size)
+    return int(tile_size[0]), int(tile_size[1])
+
+  @staticmethod
+  def label_counts(label_coords, name, row_starts, col_starts, tile_size):
+    """
+    Counts the labels of class `name` ("super_class" or "super_class/sub_class") with
+    at least one node in each tile of the grid.
+    Returns:
+      A (len(row_starts), len(col_starts)) integer array of label counts.
+    """
+    super_class, _, sub_class = name.partition('/')
+    if super_class not in label_coords.classes:
+      raise ValueError(f"Unknown class for minimum label count: {name}")
+    super_id = list(label_coords.classes).index(super_class)
+    rows = label_coords.super_ids == super_id
+    if sub_class:
+      rows &= label_coords.class_ids == label_coords.classes[super_class].index(sub_class)
+
+    shape = (len(row_starts), len(col_starts))
+    if not rows.any():
+      return np.zeros(shape, dtype=np.int64)
+
+    # Way (label) number of every node of the selected labels.
+    lengths = np.diff(label_coords.offsets)
+    way_of_node = np.repeat(np.arange(len(lengths)), lengths)
+    selected = rows[way_of_node]
+    nodes, way_of_node = np.asarray(label_coords.nodes)[selected], way_of_node[selected]
+
+    # Tiles covering a coordinate x are those with start <= x < start + size.
+    def covering(starts, x, size):
+      last = np.searchsorted(starts, x, side='right') - 1
+      first = np.searchsorted(starts, x - size, side='right')
+      return first, last
+
+    tile_h, tile_w = TileFilter.tile_shape(tile_size)
+    col_first, col_last = covering(col_starts, nodes[:, 0], tile_w)
+    row_first, row_last = covering(row_starts, nodes[:, 1], tile_h)
+
+    # Enumerate every (label, tile) pair, at most span^2 tiles per node.
+    span = int(np.max(np.maximum(col_last - col_first, row_last - row_first), initial=-1)) + 1
+    pairs = []
+    for dr in range(span):
+      for dc in range(span):
+        r, c = row_first + dr, col_first + dc
+        valid = (r <= row_last) & (c <= col_last)
+        pairs.append(way_of_node[valid] * shape[0] * shape[1] + r[valid] * shape[1] + c[valid])
+
+    # Each label only counts once per tile.
+    tiles = np.unique(np.concatenate(pairs)) % (shape[0] * shape[1])
+    return np.bincount(tiles, minlength=shape[0] * shape[1]).reshape(shape)
@@ -0,0 +1,370 @@
+## TileShards packs the samples of a dataset into large shard files, so training reads them sequentially.
+import io
+import os
+import json
+import random
+import tarfile
+import argparse
+import numpy as np
+from PIL import Image
+from Dataset import Dataset
+from BatchPrefetcher import prefetch_map
+from DerivedStore import read_split_index
+import TileEncoder
+
+# Index of the shards of an exported dataset, stored next to them.
+INDEX_FILENAME = 'index.json'
+
+
+class ShardWriter:
+  """
+  The 'ShardWriter' class writes records (samples) into tar shard files of about
+  `shard_bytes` bytes each, `[prefix]-00000.tar`, `[prefix]-00001.tar`, ... in `path`,
+  and the list of shards in `path/index.json` when closed.
+
+  Each record is a key (eg: the tile index) and a dictionary of fields, eg:
+  {'image.jpg': bytes, 'labels.lbl': bytes}, stored as consecutive tar members named
+  `[key].[field]`. A record is never split across shards, and standard tools (tar,
+  WebDataset style loaders) can read the shards.
+  """
+
+  def __init__(self, path, kind, shard_bytes=256 * 2**20, prefix='shard'):
+    self.path = path
+    self.kind = kind
+    self.shard_bytes = shard_bytes
+    self.prefix = prefix
+    self.shards = []
+    self._tar = None
+    os.makedirs(path, exist_ok=True)
+
+    # Shards of an earlier export are replaced.
+    old_index = os.path.join(path, INDEX_FILENAME)
+    if os.path.isfile(old_index):
+      with open(old_index, 'r') as f:
+        for shard in json.load(f)['shards']:
+          if os.path.isfile(os.path.join(path, shard['file'])):
+            os.remove(os.path.join(path, shard['file']))
+      os.remove(old_index)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def _next_shard(self):
+    self._close_shard()
+    name = f'{self.prefix}-{len(self.shards):05d}.tar'
+    self._tar = tarfile.open(os.path.join(self.path, name), 'w', format=tarfile.GNU_FORMAT)
+    self.shards.append({'file': name, 'records': 0, 'bytes': 0, 'keys': []})
+
+  def _close_shard(self):
+    if self._tar is not None:
+      self._tar.close()
+      shard = self.shards[-1]
+      shard['bytes'] = os.path.getsize(os.path.join(self.path, shard['file']))
+      self._tar = None
+
+  def write(self, key, fields):
+    """
+    Writes the record [key] with the dictionary of [fields] (name -> bytes).
+    """
+    key = str(key)
+    assert '.' not in key, "Record keys can't contain '.'"
+    if self._tar is None or self._tar.offset >= self.shard_bytes:
+      self._next_shard()
+
+    for field, data in fields.items():
+      info = tarfile.TarInfo(f'{key}.{field}')
+      info.size = len(data)
+      self._tar.addfile(info, io.BytesIO(data))
+    self.shards[-1]['records'] += 1
+    self.shards[-1]['keys'].append(key)
+
+  def close(self):
+    """
+    Closes the last shard and writes the index of the shards.
+    """
+    self._close_shard()
+    index = {
+      'kind': self.kind,
+      'num_records': sum(shard['records'] for shard in self.shards),
+      'shards': self.shards
+    }
+    tmp_path = os.path.join(self.path, INDEX_FILENAME + '.tmp')
+    with open(tmp_path, 'w') as f:
+      json.dump(index, f)
+    os.replace(tmp_path, os.path.join(self.path, INDEX_FILENAME))
+
+
+class ShardReader:
+  """
+  The 'ShardReader' class streams the records of the shards written by a ShardWriter,
+  reading each shard from start to end (no random reads), in order or shuffled: the
+  order of the shards is shuffled, and the records go through a shuffle buffer of
+  `shuffle_buffer` records, from which a random one is returned as each new one is read.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    with open(os.path.join(path, INDEX_FILENAME), 'r') as f:
+      index = json.load(f)
+    self.kind = index['kind']
+    self.shards = index['shards']
+    self.num_records = index['num_records']
+
+  def __len__(self):
+    return self.num_records
+
+  def records(self, shuffle_shards=False, seed=None):
+    """
+    Yields the (key, dictionary of fields) of every record, reading one shard at a time.
+    """
+    shards = list(self.shards)
+    if shuffle_shards:
+      random.Random(seed).shuffle(shards)
+
+    for shard in shards:
+      key, fields = None, {}
+      with tarfile.open(os.path.join(self.path, shard['file']), 'r|', bufsize=2**20) as tar:
+        for member in tar:
+          member_key, _, field = member.name.partition('.')
+          if member_key != key and fields:
+            yield key, fields
+            fields = {}
+          key = member_key
+          fields[field] = tar.extractfile(member).read()
+      if fields:
+        yield key, fields
+
+  def shuffled_records(self, shuffle_buffer=0, seed=None):
+    """
+    Yields the records shuffled by a buffer of [shuffle_buffer] records (and in shuffled
+    shard order), or in order if [shuffle_buffer] is 0.
+    """
+    if not shuffle_buffer:
+      yield from self.records()
+      return
+
+    rng = random.Random(seed)
+    buffer = []
+    for record in self.records(shuffle_shards=True, seed=rng.random()):
+      if len(buffer) < shuffle_buffer:
+        buffer.append(record)
+        continue
+      i = rng.randrange(shuffle_buffer)
+      yield buffer[i]
+      buffer[i] = record
+    rng.shuffle(buffer)
+    yield from buffer
+
+  def iter_batches(self, batch_size, decode_batch=None, shuffle_buffer=0, seed=None,
+                   workers=4, prefetch=2, processes=False, drop_last=False):
+    """
+    Yields batches of [batch_size] records decoded by `decode_batch(records)` (a list
+    of the `decode_record` dictionaries by default), while [workers] threads (or
+    processes) decode the next batches in the background (see `BatchPrefetcher`).
+    """
+    decode_batch = decode_batch or decode_records
+    return prefetch_map(decode_batch, batches_of(
+                          self.shuffled_records(shuffle_buffer, seed), batch_size, drop_last),
+                        workers=workers, prefetch=prefetch, processes=processes)
+
+
+def batches_of(records, batch_size, drop_last=False):
+  """
+  Helper function only. Yields lists of [batch_size] consecutive [records].
+  """
+  batch = []
+  for record in records:
+    batch.append(record)
+    if len(batch) == batch_size:
+      yield batch
+      batch = []
+  if batch and not drop_last:
+    yield batch
+
+
+def decode_field(field, data):
+  """
+  Decodes the bytes of a record [field] by its extension: images, `.lbl` labels,
+  `.npz` masks or `.npy` arrays.
+  """
+  name, _, ext = field.partition('.')
+  if name == 'image':
+    if ext == 'npy':
+      return np.load(io.BytesIO(data))
+    return np.array(Image.open(io.BytesIO(data)))
+  if ext == 'lbl':
+    return TileEncoder.BinaryLabelEncoder().decode(data)
+  if ext == 'json':
+    return json.loads(data.decode('utf-8'))
+  if ext == 'npz':
+    return TileEncoder.MaskEncoder().decode(data)
+  if ext == 'npy':
+    return np.load(io.BytesIO(data))
+  return data
+
+
+def decode_record(record):
+  """
+  Returns the dictionary of the key and decoded fields (by name, without extension)
+  of a (key, fields) [record], eg: {'key': '12', 'image': array, 'labels': dictionary}.
+  """
+  key, fields = record
+  decoded = {'key': key}
+  for field, data in fields.items():
+    decoded[field.partition('.')[0]] = decode_field(field, data)
+  return decoded
+
+
+def decode_records(records):
+  """
+  Returns the list of decoded [records] (see `decode_record`).
+  """
+  return [decode_record(record) for record in records]
+
+
+def decode_imseg_batch(records, indices_of_interest=None):
+  """
+  Decodes `ImSeg` records into (block of images, block of (h, w, C) masks of the
+  classes at [indices_of_interest]), the format of `ImSeg_Dataset.get_batch`.
+  """
+  images, annotations = [], []
+  for record in decode_records(records):
+    masks = record['masks'] if indices_of_interest is None else record['masks'][indices_of_interest]
+    images.append(record['image'])
+    annotations.append(np.moveaxis(masks, 0, -1))
+  return np.stack(images), np.stack(annotations)
+
+
+def read_file(path):
+  with open(path, 'rb') as f:
+    return f.read()
+
+
+def export_dataset(ds, out_path, shard_bytes=256 * 2**20):
+  """
+  Exports the tiles of Dataset [ds] into shards in [out_path], each record holding the
+  image file's bytes (in its format) and the labels in the binary label format.
+  Returns:
+    The number of records exported.
+  """
+  encoder = TileEncoder.BinaryLabelEncoder()
+  with ShardWriter(out_path, 'tiles', shard_bytes) as writer:
+    for i in range(len(ds)):
+      img_name = ds.img_list[i]
+      ann_path = os.path.join(ds.annotations_path, ds.annotation_list[i])
+      try:
+        labels = TileEncoder.read_labels(ann_path)
+      except ValueError:
+        labels = {}
+      writer.write(ds.tile_indices[i], {
+        'image' + os.path.splitext(img_name)[1]: read_file(os.path.join(ds.images_path, img_name)),
+        'labels.lbl': encoder.encode(labels)
+      })
+  return len(ds)
+
+
+def export_imseg_split(ds, split, out_path, shard_bytes=256 * 2**20):
+  """
+  Exports the [split] ("train", "val" or "test") of ImSeg_Dataset [ds] into shards in
+  [out_path], each record holding the image file's bytes (in its format) and its
+  bit-packed class masks (see `ImSeg_Dataset.sample_files`).
+  Returns:
+    The number of records exported.
+  """
+  with ShardWriter(out_path, 'im_seg', shard_bytes) as writer:
+    for i in range(ds.data_sizes[split]):
+      im_path, ann_path = ds.sample_files(split, i)
+      if ann_path.endswith(TileEncoder.MaskEncoder.ext):
+        masks = read_file(ann_path)
+      else:
+        masks = TileEncoder.MaskEncoder().encode(TileEncoder.read_masks(ann_path))
+      writer.write(i, {
+        'image' + os.path.splitext(im_path)[1]: read_file(im_path),
+        'masks.npz': masks
+      })
+  return ds.data_sizes[split]
+
+
+def export_pixor_split(split_path, out_path, shard_bytes=256 * 2**20):
+  """
+  Exports a PIXOR split [split_path] (eg: `data_path/pixor/train`) into shards in
+  [out_path], each record holding the image's jpeg bytes and its box and class
+  annotation arrays. The tiles are the ones listed in the split's index file
+  (`split_path.json`, see `PIXOR_Dataset.build_dataset`) if it has one, otherwise the
+  files of the split directory.
+  Returns:
+    The number of records exported.
+  """
+  samples = read_split_index(split_path + '.json')
+  if samples is None:
+    num_images = len(os.listdir(os.path.join(split_path, 'images')))
+    samples = [(os.path.join(split_path, 'images', f'{i}.jpg'),
+                os.path.join(split_path, 'box_annotations', f'{i}.npy'),
+                os.path.join(split_path, 'class_annotations', f'{i}.npy'))
+               for i in range(num_images)]
+  with ShardWriter(out_path, 'pixor', shard_bytes) as writer:
+    for i, (img_path, box_path, class_path) in enumerate(samples):
+      writer.write(i, {
+        'image.jpg': read_file(img_path),
+        'boxes.npy': read_file(box_path),
+        'classes.npy': read_file(class_path)
+      })
+  return len(samples)
+
+
+def passed_arguments():
+  parser = argparse.ArgumentParser(
+    description="Script to export a dataset into shards that are read sequentially.")
+  parser.add_argument('-d', '--data_path',
+                      type=str,
+                      required=True,
+                      help='Path to directory where extracted dataset is stored.')
+  parser.add_argument('-c', '--classes_path',
+                      type=str,
+                      default='classes.json',
+                      help='Path to .json file denoting classes of labels used in dataset.')
+  parser.add_argument('-o', '--out_path',
+                      type=str,
+                      default=None,
+                      help='Directory to write the shards to (data_path/shards by default).')
+  parser.add_argument('--shard_mb',
+                      type=float,
+                      default=256,
+                      help='Size of each shard in MB.')
+  parser.add_argument('--im_seg',
+                      action='store_true',
+                      default=False,
+                      help='Export the train/val/test splits of the ImSeg dataset.')
+  parser.add_argument('--pixor',
+                      action='store_true',
+                      default=False,
+                      help='Export the train/val/test splits of the PIXOR dataset.')
+  args = parser.parse_args()
+  return args
+
+
+if __name__ == "__main__":
+  args = passed_arguments()
+  out_path = args.out_path or os.path.join(args.data_path, 'shards')
+  shard_bytes = int(args.shard_mb * 2**20)
+
+  if args.im_seg:
+    from ImSeg.ImSeg_Dataset import ImSeg_Dataset
+    ds = ImSeg_Dataset(args.data_path, classes_path=args.classes_path)
+    for split in ["train", "val", "test"]:
+      split_path = os.path.join(out_path, 'im_seg', split)
+      print(f"Exported {export_imseg_split(ds, split, split_path, shard_bytes)} {split}" +\
+            f" samples to {split_path}")
+  elif args.pixor:
+    for split in ["train", "val", "test"]:
+      split_path = os.path.join(out_path, 'pixor', split)
+      total = export_pixor_split(os.path.join(args.data_path, 'pixor', split), split_path,
+                                 shard_bytes)
+      print(f"Exported {total} {split} samples to {split_path}")
+  else:
+    ds = Dataset(args.data_path, classes_path=args.classes_path)
+    tiles_path = os.path.join(out_path, 'tiles')
+    print(f"Exported {export_dataset(ds, tiles_path, shard_bytes)} tiles to {tiles_path}")
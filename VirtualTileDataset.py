@@ -0,0 +1,173 @@
+## VirtualTileDataset serves tiles on demand from the entire area instead of tile files.
+import os
+import random
+import argparse
+import numpy as np
+from Dataset import Dataset
+from LabelStore import LabelIndex
+from DataPipeline import boxes_in_tile
+
+
+class VirtualTileDataset(Dataset):
+  """
+  The 'VirtualTileDataset' class provides the same interface as 'Dataset' (length,
+  tile size, getting tiles with their labels and batches of them, removing and
+  visualizing tiles), but without any tile files.
+
+  The cleaned entire area is memory-mapped from `raw_data/Entire_Area.npy` (or loaded
+  from `raw_data/Entire_Area.jpg`) together with the labels in `raw_data/annotations.npz`.
+  Each tile is sliced out of the area, and its labels are clipped, when it is accessed.
+  The tiles are either the same grid of [tile_size x tile_size] tiles (with overlap)
+  that `DataPipeline.tile_image` would write, in the same order, or arbitrary windows.
+  Changing the tile size or overlap therefore doesn't need the area to be ingested again.
+  """
+
+  def __init__(self, data_path, tile_size=224, overlap=0, windows=None,
+               classes_path='classes.json', tile_filter=None):
+    """
+    Initializes a virtual dataset over the raw data in data_path, tiled into a grid of
+    [tile_size x tile_size] tiles overlapping by [overlap] pixels (without the tiles
+    rejected by [tile_filter], if given), or into [windows] (a list of 
+    [col_start, col_end, row_start, row_end] pixel ranges) if given.
+    """
+    super().__init__(data_path, classes_path=classes_path)
+
+    # Prefer the lossless memmap, the jpeg is only a fallback for older datasets.
+    area_path = os.path.join(self.raw_data_path, 'Entire_Area.npy')
+    if os.path.isfile(area_path):
+      self.area = np.load(area_path, mmap_mode='r')
+    else:
+      self.area = self.load_entire_area()
+    self.label_coords = self.load_label_store()
+
+    if windows is None:
+      self.set_grid(tile_size, overlap, tile_filter)
+    else:
+      self.set_windows(windows)
+
+  @staticmethod
+  def tile_grid(im_size, tile_size, overlap=0):
+    """
+    Returns the (N, 4) array of [col_start, col_end, row_start, row_end] of the tiles
+    `DataPipeline.tile_image` cuts an image of shape `im_size` into, in index order.
+    """
+    assert overlap < tile_size, "Can't overlap pixels beyond actual tile_size"
+    step = tile_size - overlap
+    height, width = im_size[:2]
+    rows = np.arange(0, height - step, step)
+    cols = np.arange(0, width - step, step)
+    row_starts, col_starts = np.repeat(rows, len(cols)), np.tile(cols, len(rows))
+    return np.stack([col_starts, col_starts + tile_size,
+                     row_starts, row_starts + tile_size], axis=1).astype(np.int64)
+
+  def set_grid(self, tile_size, overlap=0, tile_filter=None):
+    """
+    Tiles the area into a grid of [tile_size x tile_size] tiles overlapping by
+    [overlap] pixels. If a TileFilter [tile_filter] is given, only the tiles it keeps
+    are used (in the same order as `DataPipeline.tile_image` with the filter).
+    """
+    windows = VirtualTileDataset.tile_grid(self.area.shape, tile_size, overlap)
+    if tile_filter:
+      step = tile_size - overlap
+      height, width = self.area.shape[:2]
+      keep = tile_filter.keep_grid(self.area, self.label_coords, range(0, height - step, step),
+                                   range(0, width - step, step), tile_size)
+      windows = windows[keep.ravel()]
+    self.set_windows(windows)
+
+  def set_windows(self, windows):
+    """
+    Uses [windows], a list of [col_start, col_end, row_start, row_end] pixel ranges
+    starting inside the area, as the tiles of the dataset. Like the tiles at the edges
+    of `DataPipeline.tile_image`, windows running over the edge of the area are cut off.
+    """
+    windows = np.asarray(windows, dtype=np.int64).reshape(-1, 4)
+    height, width = self.area.shape[:2]
+    assert (windows[:, 0] >= 0).all() and (windows[:, 0] < width).all() and\
+           (windows[:, 2] >= 0).all() and (windows[:, 2] < height).all(),\
+           "Windows must start inside the entire area."
+    assert (windows[:, 0] < windows[:, 1]).all() and (windows[:, 2] < windows[:, 3]).all(),\
+           "Windows must not be empty."
+    self.windows = windows
+
+    # Bucket the labels by cells of about a window's size, to only clip nearby labels.
+    cell_size = int(np.max(windows[:, [1, 3]] - windows[:, [0, 2]])) if len(windows) else 1
+    self.label_index = LabelIndex(self.label_coords, cell_size)
+
+  def __len__(self):
+    """
+    Returns the number of tiles in the dataset.
+    """
+    return len(self.windows)
+
+  def get_img_size(self):
+    """
+    Gets the size of the first tile in the dataset as (h, w, d).
+    """
+    if not len(self.windows):
+      print("Warning! Your virtual dataset currently has no tiles.")
+      return None
+    col_start, col_end, row_start, row_end = self.windows[0]
+    return (int(row_end - row_start), int(col_end - col_start), self.area.shape[2])
+
+  def get_tile_and_label(self, index):
+    """
+    Slices the tile associated with data index out of the entire area, and clips the
+    labels of the area to it.
+
+    Returns:
+    (tile_array, dictionary_of_buildings)
+    """
+    col_start, col_end, row_start, row_end = self.windows[index].tolist()
+    tile = np.array(self.area[row_start:row_end, col_start:col_end, :])
+    labels_in_tile = boxes_in_tile(self.label_coords, [col_start, col_end, row_start, row_end],
+                                   self.label_index)
+    return (tile, labels_in_tile)
+
+  def remove_tiles(self, indices_to_remove):
+    """
+    Removes the tiles associated with the indices in indices_to_remove. The remaining
+    tiles keep their order, so they are renumbered just like in 'Dataset'.
+
+    Requires: indices_to_remove is a set
+    """
+    keep = [i for i in range(len(self)) if i not in indices_to_remove]
+    self.windows = self.windows[keep]
+    print(f"New length of dataset: {len(self)}")
+
+
+def passed_arguments():
+  parser = argparse.ArgumentParser(
+    description="Script to visualize tiles of any size served straight from the entire area.")
+  parser.add_argument('-d', '--data_path',
+                      type=str,
+                      required=True,
+                      help='Path to directory where extracted dataset is stored.')
+  parser.add_argument('-c', '--classes_path',
+                      type=str,
+                      default='classes.json',
+                      help='Path to .json file denoting classes of labels used in dataset.')
+  parser.add_argument('-s', '--tile_size',
+                      type=int,
+                      default=224,
+                      help='Size of square tile (in pixels).')
+  parser.add_argument('-o', '--overlap',
+                      type=int,
+                      default=0,
+                      help='Amount of overlapping pixels between adjacent tiles.')
+  parser.add_argument('-t', '--tile',
+                      type=int,
+                      default=1,
+                      help='Visualize a random sequence of t tiles in the dataset.')
+  args = parser.parse_args()
+  return args
+
+
+if __name__ == "__main__":
+  args = passed_arguments()
+
+  ds = VirtualTileDataset(args.data_path, tile_size=args.tile_size, overlap=args.overlap,
+                          classes_path=args.classes_path)
+  print(f"{len(ds)} tiles of size {ds.get_img_size()}")
+  for i in random.sample(range(len(ds)), min(args.tile, len(ds))):
+    ds.visualize_tile(i)
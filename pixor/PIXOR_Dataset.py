@@ -1,16 +1,17 @@
 import sys
 sys.path.append('.')
 from Dataset import Dataset
+import TileEncoder
+from DerivedStore import DerivedStore, write_split_index, read_split_index
 from minimum_bounding_box import MinimumBoundingBox
 import os
+import io
 import numpy as np
 import scipy.misc
 import math
 from PIL import Image
 import json
 from lxml import etree
-import random
-from shutil import copyfile
 from functools import reduce
 from scipy.spatial import Delaunay
 from PIL import Image, ImageDraw 
@@ -27,6 +28,10 @@ logging.basicConfig(level=logging.INFO, filename="tile_logfile", filemode="a+",
 
 INDICES_TO_REMOVE = {3, 5, 6, 7, 9, 10, 11, 12, 13, 14, 15, 16, 17, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 35, 37, 39, 40, 42, 43, 45, 46, 49, 50, 51, 52, 53, 54, 55, 56, 57, 63, 64, 65, 72, 73, 74, 75, 76, 77, 79, 81, 86, 96, 97, 98, 100, 101, 103, 108, 110, 116, 117, 118, 119, 120, 121, 124, 125, 126, 138, 139, 140, 142, 147, 148, 149, 150, 151, 155, 160, 173, 174, 175, 176, 178, 197, 198, 199, 200, 201, 222, 223, 229, 230, 245, 247, 268, 269, 270, 291, 292, 293, 299, 370, 409, 410, 414, 432, 433, 434, 449, 455, 456, 457, 458, 471, 472, 478, 479, 480, 481, 482, 501, 503, 504, 505, 506}
 IMAGE_SIZE = 224
+# Name of the DerivedStore of the box and class targets of the tiles, and their extensions.
+TARGETS_STORE = 'pixor_targets'
+BOXES_EXT = '.boxes.npy'
+CLASSES_EXT = '.classes.npy'
 #create mapping for classes to class label
 class_map = {}
 cnt = 1
@@ -71,6 +76,8 @@ class PIXOR_Dataset(Dataset):
 		self.val_path = self.data_path + '/pixor/val'
 		self.test_path = self.data_path + '/pixor/test'
 		self.is_plot = is_plot
+		# Split path -> files of its samples (see `split_index`), read once per split.
+		self.split_indices = {}
 
 		if not os.path.isdir(self.data_path + '/pixor'):
 			print(f"Creating directory to store PIXOR formatted dataset.")
@@ -91,7 +98,7 @@ class PIXOR_Dataset(Dataset):
 			if not os.path.isdir(directory + '/box_annotations'):
 				os.mkdir(directory + '/box_annotations')
 	
-	def build_dataset(self):
+	def build_dataset(self, seed=0):
 		"""
 		IMPORTANT: remove unwanted tiles before running this.
 
@@ -102,93 +109,119 @@ class PIXOR_Dataset(Dataset):
 		Run get_bounding_boxes to convert each set of nodes to a box with 4 corners.
 		Run some method to get each box in terms of center, width, height, heading.
 		For each tile, call boxes_in_tile_pixor in a constrained setting.
-		
-		"""
-
-		data = list(zip(self.img_list, self.annotation_list))
-		random.shuffle(data)
-		shuffled_img, shuffled_annotations = zip(*data)
 
-		train, val, test = self.train_val_test
+		The box and class labels of each tile are saved in the targets DerivedStore
+		(`derived/pixor_targets/`), skipping the tiles already there, and the tiles are
+		split by index without being copied (see `split`). The files copied into the
+		split directories by an earlier build are removed.
+		"""
+		store = self.target_store()
 
-		logging.info("number of tiles: " + str(len(shuffled_img)))
+		logging.info("number of tiles: " + str(len(self.img_list)))
 		# for each tile
-		for i in range(0, len(shuffled_img)):
+		for i, tile_index in enumerate(self.tile_indices):
+			if store.contains(tile_index, BOXES_EXT) and store.contains(tile_index, CLASSES_EXT):
+				continue
 			logging.info("tile " + str(i))
-			img_path = self.images_path + "/" + shuffled_img[i]
-			labels_path = self.annotations_path + "/" + shuffled_annotations[i]
+			img_path = self.images_path + "/" + self.img_list[i]
+			labels_path = self.annotations_path + "/" + self.annotation_list[i]
+			box_labels, class_labels = self.tile_targets(img_path, labels_path)
+
+			for ext, labels in [(CLASSES_EXT, class_labels), (BOXES_EXT, box_labels)]:
+				data = io.BytesIO()
+				np.save(data, labels)
+				store.write(tile_index, ext, data.getvalue())
+
+		self.split(seed)
+
+		for directory in [self.train_path, self.val_path, self.test_path]:
+			for sub_directory in ['images', 'box_annotations', 'class_annotations']:
+				for f in os.listdir(directory + '/' + sub_directory):
+					os.remove(directory + '/' + sub_directory + '/' + f)
+
+	def split(self, seed=0):
+		"""
+		Splits the tiles into train, val and test sets by the hash of their tile index and
+		seed (see `Dataset.split_key`), writing the (image, box annotation, class annotation)
+		paths of the tiles of each split to its index file (`pixor/train.json`, ...).
+		Only the index files are written, so splitting again is instant.
+		"""
+		store = self.target_store()
+		positions = {tile_index: i for i, tile_index in enumerate(self.tile_indices)}
+		splits = Dataset.assign_splits(self.tile_indices, self.train_val_test, seed)
+		for split_name, tiles in splits.items():
+			samples = [(self.images_path + "/" + self.img_list[positions[tile_index]],
+						store.file_path(tile_index, BOXES_EXT), store.file_path(tile_index, CLASSES_EXT))
+					   for tile_index in tiles]
+			write_split_index(getattr(self, split_name + '_path') + '.json', samples)
+			logging.info(split_name + " tiles: " + str(len(samples)))
+		self.split_indices = {}
+
+	def split_index(self, base_path):
+		"""
+		Returns the (image, box annotation, class annotation) paths of the tiles of the split
+		base_path from its index file, read once (None for a split copied by an earlier build).
+		"""
+		if base_path not in self.split_indices:
+			self.split_indices[base_path] = read_split_index(base_path + '.json')
+		return self.split_indices[base_path]
+
+	def target_store(self):
+		"""
+		Returns the DerivedStore of the box and class labels of the tiles, emptied if the
+		classes or the tile size change.
+		"""
+		return DerivedStore(self.data_path, TARGETS_STORE,
+							{'class_map': class_map, 'image_size': IMAGE_SIZE})
 
-			# load data from json format
+	def tile_targets(self, img_path, labels_path):
+		"""
+		Returns the (box labels, class labels) of the tile with the image img_path and the
+		labels labels_path, in any format of TileEncoder (see `boxes_in_pixels`).
+		"""
+		try:
+			labels_in_tile = TileEncoder.read_labels(labels_path)
+		except ValueError:
 			labels_in_tile = {}
-			with open(labels_path, 'r') as filename:
-				try: 
-					labels_in_tile = json.load(filename)
-				except ValueError:
-					labels_in_tile = {}
-				
-			buildings_list = []
-
-			for super_class, sub_class_labels in labels_in_tile.items():
-				for sub_class, labels in sub_class_labels.items(): #labels is all building
-					if super_class == 'building':
-						for label in labels: 
-						#each label is set of points for a particular building
-							buildings_list.append((sub_class, label))
-			
-			# convert each node set to a (bbox as 4 corners)
-			corner_boxes = self.get_rects(buildings_list)
-
-			# convert each (bbox as 4 corners) to a PIXOR box
-			pixor_boxes = self.create_pixor_labels(corner_boxes)
-			# assign to pixels
-			box_labels, class_labels = self.boxes_in_pixels(pixor_boxes, corner_boxes, (IMAGE_SIZE, IMAGE_SIZE))
-
-			if self.is_plot:
-				#ADD PLOTING 
-				im = Image.open(img_path)
-				im_arr = np.array(im)
-				f = plt.figure()
-				#f.add_subplot(1, 2, 1)
-				#plt.imshow(im_arr)
-				#f.add_subplot(1, 2, 2)
-				#plt.imshow(np.squeeze(class_labels))
-				#plt.show(block=True)
-				draw = ImageDraw.Draw(im)
-				for _,points in corner_boxes:
-					p = sorted(points)
-					ps = []
-					ps.append(p[0])
-					ps.append(p[1])
-					ps.append(p[3])
-					ps.append(p[2])
-					draw.polygon(tuple(ps),outline="blue")
-				im.show()
-
-			if i < math.floor(train*len(shuffled_img)):
-				# Copy image to train folder
-				copyfile(f"{self.images_path}/{shuffled_img[i]}", f"{self.train_path}/images/{i}.jpg")
-				print('train image saved at path {self.train_path}/images/{i}.jpg')
-				# Create annotation matrices
-				np.save(self.train_path + "/box_annotations/" + str(i), box_labels)
-				np.save(self.train_path + "/class_annotations/" + str(i), class_labels)
 			
-			elif i < math.floor((train+val)*len(shuffled_img)):
-				# Add to val folder
-				ind = i - math.floor((train)*len(shuffled_img))
-				copyfile(f"{self.images_path}/{shuffled_img[i]}", f"{self.val_path}/images/{ind}.jpg")
-				print('val image saved at path {self.val_path}/images/{ind}.jpg')
-
-				# Create annotation matrices
-				np.save(self.val_path + "/box_annotations/" + str(ind), box_labels)
-				np.save(self.val_path + "/class_annotations/" + str(ind), class_labels)
-
-			else:
-				# Add to test folder
-				ind = i - math.floor((train+val)*len(shuffled_img))
-				copyfile(f"{self.images_path}/{shuffled_img[i]}", f"{self.test_path}/images/{ind}.jpg")
-				print('test image saved at path {self.test_path}/images/{ind}.jpg')
-				np.save(self.test_path + "/box_annotations/" + str(ind), box_labels)
-				np.save(self.test_path + "/class_annotations/" + str(ind), class_labels)
+		buildings_list = []
+
+		for super_class, sub_class_labels in labels_in_tile.items():
+			for sub_class, labels in sub_class_labels.items(): #labels is all building
+				if super_class == 'building':
+					for label in labels: 
+					#each label is set of points for a particular building
+						buildings_list.append((sub_class, label))
+		
+		# convert each node set to a (bbox as 4 corners)
+		corner_boxes = self.get_rects(buildings_list)
+
+		# convert each (bbox as 4 corners) to a PIXOR box
+		pixor_boxes = self.create_pixor_labels(corner_boxes)
+		# assign to pixels
+		box_labels, class_labels = self.boxes_in_pixels(pixor_boxes, corner_boxes, (IMAGE_SIZE, IMAGE_SIZE))
+
+		if self.is_plot:
+			#ADD PLOTING 
+			im = Image.open(img_path)
+			im_arr = np.array(im)
+			f = plt.figure()
+			#f.add_subplot(1, 2, 1)
+			#plt.imshow(im_arr)
+			#f.add_subplot(1, 2, 2)
+			#plt.imshow(np.squeeze(class_labels))
+			#plt.show(block=True)
+			draw = ImageDraw.Draw(im)
+			for _,points in corner_boxes:
+				p = sorted(points)
+				ps = []
+				ps.append(p[0])
+				ps.append(p[1])
+				ps.append(p[3])
+				ps.append(p[2])
+				draw.polygon(tuple(ps),outline="blue")
+			im.show()
+		return box_labels, class_labels
 		
 	def create_pixor_labels(self, corner_labels):
 		""" Input: Set of bounding boxes, where each box is repped as 4 corners.
@@ -349,12 +382,21 @@ class PIXOR_Dataset(Dataset):
 		(tile_array, dictionary_of_buildings)
 		"""
 
+		# The files of the tile, listed in the split's index file if it has one
+		samples = self.split_index(base_path)
+		if samples is not None:
+			img_path, box_path, class_path = samples[index]
+		else:
+			img_path = base_path + '/images/' + str(index) + '.jpg'
+			box_path = base_path + '/box_annotations/' + str(index) + '.npy'
+			class_path = base_path + '/class_annotations/' + str(index) + '.npy'
+
 		# Open the jpeg image and save as numpy array
-		im = Image.open(base_path + '/images/' + str(index) + '.jpg')
+		im = Image.open(img_path)
 		im_arr = np.array(im)
 
 		# Open the json file and parse into dictionary of index -> buildings pairs
-		box_annotation = np.load(base_path + '/box_annotations/' + str(index) + '.npy')
-		class_annotation = np.load(base_path + '/class_annotations/' + str(index) + '.npy')
+		box_annotation = np.load(box_path)
+		class_annotation = np.load(class_path)
 		
 		return np.array([im_arr, box_annotation, class_annotation])
@@ -26,6 +26,8 @@ parser.add_argument('--logfile_name', type=str, default='PIXOR_logfile', help='F
 parser.add_argument('--tile_size', type=int, default=224, help='Size of tile images')
 parser.add_argument('--data_path', type=str, default='data_path', help='Name of data folder')
 parser.add_argument('--num_classes', type=int, default=6, help='number of building classes')
+parser.add_argument('--shards', type=str, default=None, help='Directory of the train/val/test shards exported by TileShards.py --pixor, read instead of the pixor directories')
+parser.add_argument('--shuffle_buffer', type=int, default=1000, help='Number of tiles in the shuffle buffer when reading --shards')
 
 flags = parser.parse_args()
 ##### SETTINGS #####
@@ -13,7 +13,11 @@ import cv2
 import meanAP
 import os
 import os.path as osp
+import functools
 from smooth_L1 import smooth_L1, decode_smooth_L1
+sys.path.append('..')
+from TileShards import ShardReader
+from DerivedStore import read_split_index
 
 
 class PixorModel(object):
@@ -166,18 +170,13 @@ class PixorModel(object):
         per_epoch_box_loss = 0
         per_epoch_class_loss = 0
 
-        TRAIN_LEN = len(os.listdir(os.path.join(train_path, 'images')))
-        batch_indices = np.arange(TRAIN_LEN)
-        np.random.shuffle(batch_indices)
-        
-        # RIGHT NOW IF DOESN'T PERFECTLY DIVIDE IT DOESN'T COVER REMAINING, MIGHT WANT TO CHANGE THIS
-        num_batches = TRAIN_LEN // batch_size
-        # num_batches = 1
-        for batch_number in range(0, num_batches):
-            start_idx = batch_number * batch_size
-            end_idx = start_idx + batch_size
-            batch_images, batch_boxes, batch_classes = get_batch(start_idx, self.flags, train_path)
+        # Read the shards exported by TileShards.py --pixor sequentially if given.
+        if getattr(self.flags, 'shards', None):
+            batches = iter_shard_batches(self.flags, 'train', shuffle_buffer=self.flags.shuffle_buffer)
+        else:
+            batches = iter_batches(self.flags, train_path)
 
+        for batch_images, batch_boxes, batch_classes in batches:
             _, b_loss, c_loss, batch_train_loss, box_preds, unnorm_class_preds = \
             sess.run([self.decode_train_step, self.decode_loss, self.class_loss, self.decode_pixor_loss, self.output_box, self.output_class], 
             feed_dict =
@@ -230,17 +229,45 @@ def get_tile_and_label(index, flags, norm=True):
 
     # Open the jpeg image and save as numpy array
 
-    p = osp.join(path, 'images', f'{index}.jpg')
+    p, box_path, class_path = split_samples(path)[index]
     im = Image.open(p)
     im_arr = np.array(im)
-    im_arr = (im_arr - mean) / std
-
     
-    class_annotation = np.load(osp.join(path, 'class_annotations', f'{index}.npy'))
+    class_annotation = np.load(class_path)
+    # Open the json file and parse into dictionary of index -> buildings pairs
+    box_annotation = np.load(box_path)
+    return normalize_tile_and_label(im_arr, box_annotation, class_annotation, mean, std,
+                                    train_mean, train_std, norm=norm)
+
+
+@functools.lru_cache(maxsize=None)
+def split_samples(path):
+    """
+    Gets the (image, box annotation, class annotation) paths of the tiles of the split
+    in path (eg: data_path/pixor/train): listed in its index file path.json, written by
+    PIXOR_Dataset.build_dataset, or the files of the directory for splits copied by
+    earlier builds.
+    """
+    samples = read_split_index(path + '.json')
+    if samples is not None:
+        return samples
+    length = len(os.listdir(osp.join(path, 'images')))
+    return [(osp.join(path, 'images', f'{i}.jpg'), osp.join(path, 'box_annotations', f'{i}.npy'),
+             osp.join(path, 'class_annotations', f'{i}.npy')) for i in range(length)]
+
+
+def normalize_tile_and_label(im_arr, box_annotation, class_annotation, mean, std,
+                             train_mean, train_std, norm=True):
+    """
+    Normalizes a tile by the image mean and std, and its positive box labels by the
+    box mean and std if norm=True.
+
+    Returns:
+    (tile_array, box_annotation, class_annotation)
+    """
+    im_arr = (im_arr - mean) / std
     if(len(class_annotation.shape) == 2):
             class_annotation = class_annotation[:,:,newaxis]
-    # Open the json file and parse into dictionary of index -> buildings pairs
-    box_annotation = np.load(osp.join(path, 'box_annotations', f'{index}.npy'))
     # normalizing the positive labels if norm=True
     if norm:
         clipped = np.clip(class_annotation, 0, 1)
@@ -262,8 +289,7 @@ def get_batch(start_index, flags, path='', norm=True):
     TILE_SIZE = flags.tile_size
 
     # path = TRAIN_BASE_PATH
-    p = osp.join(path, 'images')
-    length = len(os.listdir(p))
+    length = len(split_samples(path))
     batch_indices = np.arange(length)
 
     batch_images = np.zeros((BATCH_SIZE, TILE_SIZE, TILE_SIZE, 3))
@@ -274,3 +300,39 @@ def get_batch(start_index, flags, path='', norm=True):
 
     return batch_images, batch_boxes, batch_classes
 
+
+def iter_batches(flags, path, norm=True):
+    """
+    Gets the batches of the tiles in path (in order), the same as calling get_batch
+    for each batch.
+    """
+    num_batches = len(split_samples(path)) // flags.batch_size
+    for batch_number in range(num_batches):
+        yield get_batch(batch_number * flags.batch_size, flags, path, norm=norm)
+
+
+def iter_shard_batches(flags, split, norm=True, shuffle_buffer=0):
+    """
+    Gets the batches of the shards of split exported by TileShards.py --pixor in
+    flags.shards, reading them sequentially (shuffled by a buffer of shuffle_buffer tiles).
+
+    Returns:
+    A generator of (batch_images, batch_boxes, batch_classes), like get_batch
+    """
+    BATCH_SIZE = flags.batch_size
+    TILE_SIZE = flags.tile_size
+    mean = np.load('mean.npy')
+    std = np.load('std.npy')
+    train_mean = np.load('train_mean.npy')
+    train_std = np.load('train_std.npy')
+
+    reader = ShardReader(osp.join(flags.shards, split))
+    for records in reader.iter_batches(BATCH_SIZE, shuffle_buffer=shuffle_buffer, drop_last=True):
+        batch_images = np.zeros((BATCH_SIZE, TILE_SIZE, TILE_SIZE, 3))
+        batch_boxes = np.zeros((BATCH_SIZE, TILE_SIZE, TILE_SIZE, 6))
+        batch_classes = np.zeros((BATCH_SIZE, TILE_SIZE, TILE_SIZE, 1))
+        for i, record in enumerate(records):
+            batch_images[i], batch_boxes[i], batch_classes[i] = normalize_tile_and_label(
+                record['image'], record['boxes'], record['classes'], mean, std,
+                train_mean, train_std, norm=norm)
+        yield batch_images, batch_boxes, batch_classes